@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""End to end benchmark of the orchestration of the pipeline. Synthetic runs of increasing sizes are assembled by
+bin/MBBspades with stub tools in place of the bioinformatics tools, and the time no tool was running (the orchestration
+overhead), the peak memory of the pipeline process and the scaling of the wall time with the number of samples are
+compared with a stored baseline e.g.
+python benchmarks/orchestration.py --sizes 10,100 --save
+python benchmarks/orchestration.py --sizes 10,100
+python benchmarks/orchestration.py --sizes 10 --workers 3
+The pipeline and its Python dependencies (Biopython, PyYAML) must be importable, the tools are not needed
+"""
+from argparse import ArgumentParser
+from glob import glob
+from synthetic import createrun
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'mike knowles'
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+repository = os.path.dirname(benchmarks)
+# Metrics compared with the baseline, where a higher value is a regression
+metrics = ('wall', 'overhead', 'persample', 'peakrss')
+
+
+def peakrss(pid):
+    """Peak resident memory of a process in bytes, or 0 if the process has exited"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return 0
+
+
+def busytime(logfiles):
+    """Find the time at least one tool was running from the logs of commands of a run
+    :param logfiles: list of the logs of the commands, one per host or worker
+    :return: seconds at least one command was running, number of commands
+    """
+    intervals = []
+    for logfile in logfiles:
+        started = dict()
+        with open(logfile) as log:
+            for line in log:
+                record = json.loads(line)
+                if record['event'] == 'start':
+                    started[record['pid']] = record['time']
+                elif record['event'] == 'finish' and record['pid'] in started:
+                    intervals.append((started.pop(record['pid']), record['time']))
+    # The union of the intervals of the commands
+    busy, end = 0.0, 0.0
+    for start, finish in sorted(intervals):
+        if finish > end:
+            busy += finish - max(start, end)
+            end = finish
+    return busy, len(intervals)
+
+
+def pipeline(path, threads, memory, runtime, home, workers=0):
+    """Assemble a run with the stub tools
+    :param workers: number of worker processes to run the stages with through the queue of the run. 0 runs the stages
+    in the pipeline process
+    :return: dictionary of the metrics of the run
+    """
+    stubs = os.path.join(benchmarks, 'stubs')
+    environment = dict(os.environ)
+    environment['PATH'] = os.pathsep.join([stubs, environment.get('PATH', '')])
+    environment['PYTHONPATH'] = os.pathsep.join([repository, stubs, environment.get('PYTHONPATH', '')])
+    environment['BLACKBOX_HOME'] = home
+    environment['BLACKBOX_STUB_RUNTIME'] = str(runtime)
+    script = os.path.join(repository, 'bin', 'MBBspades')
+    command = [sys.executable, script, path, '-t', str(threads), '--memory', str(memory), '--restart']
+    # Each worker is given an equal part of the cores and memory, as if each was on its own host
+    workercommand = [sys.executable, script, 'worker', path, '-t', str(max(1, threads // max(1, workers))),
+                     '--memory', str(float(memory) / max(1, workers))]
+    with open(os.path.join(path, 'benchmark.log'), 'wb') as log:
+        start = time.time()
+        process = subprocess.Popen(command + (['--queue'] if workers else []), stdout=log, stderr=subprocess.STDOUT,
+                                   env=environment)
+        processes = []
+        for _ in range(workers):
+            # Workers need the arguments the pipeline writes to the queue once it has read the run
+            while not os.path.isfile(os.path.join(path, 'queue', 'arguments.json')) and process.poll() is None:
+                time.sleep(0.1)
+            processes.append(subprocess.Popen(workercommand, stdout=log, stderr=subprocess.STDOUT, env=environment))
+        peak = 0
+        # The peak memory of the pipeline is only available while the process is running
+        while process.poll() is None:
+            peak = max(peak, peakrss(process.pid))
+            time.sleep(0.1)
+        for worker in processes:
+            worker.wait()
+        wall = time.time() - start
+    assert process.returncode == 0 and not any(worker.returncode for worker in processes), \
+        'The pipeline failed on {}. See {}'.format(path, os.path.join(path, 'benchmark.log'))
+    busy, commands = busytime(glob(os.path.join(path, 'commands.jsonl')) +
+                              glob(os.path.join(path, 'queue', 'commands.*.jsonl')))
+    return {'wall': wall, 'busy': busy, 'overhead': wall - busy, 'commands': commands, 'peakrss': peak}
+
+
+def scaling(results):
+    """Exponent of the growth of the wall time with the number of samples, from the smallest and largest runs"""
+    sizes = sorted(results, key=int)
+    if len(sizes) < 2:
+        return None
+    small, large = sizes[0], sizes[-1]
+    return math.log(results[large]['wall'] / results[small]['wall']) / math.log(float(large) / float(small))
+
+
+def compare(results, baseline, tolerance):
+    """Print the results of each run alongside the baseline
+    :return: list of the metrics that regressed by more than the tolerance
+    """
+    regressions = []
+    print '{:>8} {:>10} {:>10} {:>10} {:>12} {:>10} {:>9}'.format('Samples', 'Wall (s)', 'Busy (s)', 'Overhead',
+                                                                  'Per sample', 'Peak RSS', 'Commands')
+    for size in sorted(results, key=int):
+        result = results[size]
+        print '{:>8} {:>10.1f} {:>10.1f} {:>10.1f} {:>12.3f} {:>9.0f}M {:>9}'.format(
+            size, result['wall'], result['busy'], result['overhead'], result['persample'],
+            result['peakrss'] / 1024.0 ** 2, result['commands'])
+        if size in baseline.get('results', {}):
+            previous = baseline['results'][size]
+            changes = []
+            for metric in metrics:
+                if previous.get(metric):
+                    ratio = result[metric] / previous[metric]
+                    changes.append('{} {:+.0f}%'.format(metric, (ratio - 1) * 100))
+                    if ratio > 1 + tolerance:
+                        regressions.append('{} samples: {} {:.3f} -> {:.3f}'.format(size, metric, previous[metric],
+                                                                                     result[metric]))
+            print '{:>8} vs baseline: {}'.format('', ', '.join(changes))
+    exponent = scaling(results)
+    if exponent is not None:
+        print 'Wall time grows as samples^{:.2f}'.format(exponent)
+        if baseline.get('scaling') and exponent > baseline['scaling'] + tolerance:
+            regressions.append('scaling exponent {:.2f} -> {:.2f}'.format(baseline['scaling'], exponent))
+    return regressions
+
+
+def recordcommit():
+    """The pipeline reads its commit from blackbox/data/git.dat, which is written on install"""
+    gitdat = os.path.join(repository, 'blackbox', 'data', 'git.dat')
+    if not os.path.isfile(gitdat):
+        if not os.path.isdir(os.path.dirname(gitdat)):
+            os.makedirs(os.path.dirname(gitdat))
+        with open(gitdat, 'w') as git:
+            git.write(os.popen('git -C {} rev-parse --short HEAD'.format(repository)).read().rstrip())
+
+
+def main(args):
+    recordcommit()
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='blackbox-benchmark-')
+    results = dict()
+    try:
+        for size in [int(x) for x in args.sizes.split(',')]:
+            reads = os.path.join(workdir, 'reads{}'.format(size))
+            if not os.path.isfile(os.path.join(reads, 'SampleSheet.csv')):
+                print 'Creating a synthetic run of {} samples in {}'.format(size, reads)
+                createrun(reads, size, args.reads)
+            # Every run starts from a folder holding only the files of the sequencer, so no stage is current
+            path = os.path.join(workdir, 'run{}'.format(size))
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            for filename in os.listdir(reads):
+                os.link(os.path.join(reads, filename), os.path.join(path, filename))
+            # Every run starts with an empty cache and memory model
+            home = os.path.join(workdir, 'home{}'.format(size))
+            if os.path.isdir(home):
+                shutil.rmtree(home)
+            print 'Assembling {} samples'.format(size)
+            result = pipeline(path, args.threads, args.memory, args.runtime, home, args.workers)
+            result['persample'] = result['overhead'] / size
+            results[str(size)] = result
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir)
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as baselinefile:
+            baseline = json.load(baselinefile)
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, 'wb') as baselinefile:
+            json.dump({'results': results, 'scaling': scaling(results), 'runtime': args.runtime,
+                       'threads': args.threads, 'reads': args.reads, 'workers': args.workers, 'time': time.time()},
+                      baselinefile,
+                      sort_keys=True, indent=4, separators=(',', ': '))
+        print 'Baseline saved to {}'.format(args.baseline)
+    elif not baseline:
+        print 'No baseline in {}. Run with --save to store these results as the baseline'.format(args.baseline)
+    if regressions:
+        print 'Regressions of more than {:.0f}%:\n  {}'.format(args.tolerance * 100, '\n  '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the orchestration of the pipeline on synthetic runs with stub '
+                                        'tools')
+    parser.add_argument('--sizes', default='10,100,1000', help='Comma-separated numbers of samples of the runs. '
+                        'Default is 10,100,1000')
+    parser.add_argument('--reads', default=1000, type=int, help='Number of read pairs of each sample. Default is 1000')
+    parser.add_argument('--runtime', default=0, type=float, help='Seconds each stub tool runs for. Default is 0, so '
+                        'the wall time is the orchestration alone')
+    parser.add_argument('--threads', default=4, type=int, help='Number of threads of the pipeline. Default is 4')
+    parser.add_argument('--memory', default=8, type=float, help='Memory in GB of the pipeline. Default is 8')
+    parser.add_argument('--workers', default=0, type=int, help='Run the stages with this number of worker processes '
+                        'through the queue of the run (--queue), sharing the threads and memory. Default is 0, which '
+                        'runs the stages in the pipeline process')
+    parser.add_argument('--workdir', help='Folder to create the runs in. Runs already created are reused. Default is '
+                        'a temporary folder that is removed afterwards')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder of the runs')
+    parser.add_argument('--baseline', default=os.path.join(benchmarks, 'baseline.json'),
+                        help='Baseline to compare with. Default is benchmarks/baseline.json')
+    parser.add_argument('--save', action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Fraction a metric may exceed the baseline by '
+                        'before it is reported as a regression. Default is 0.2')
+    sys.exit(main(parser.parse_args()))
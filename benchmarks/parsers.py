@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+"""Microbenchmarks of the pure-Python parsers of the pipeline on large synthetic inputs. Each benchmark is run until
+its timing is stable, and the best time per call is compared with a stored baseline e.g.
+python benchmarks/parsers.py --save
+python benchmarks/parsers.py -k filer,metadata
+"""
+from argparse import ArgumentParser
+from synthetic import samplename, writesamplesheet
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+__author__ = 'mike knowles'
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+# The stub modules of QUAST and ITSx are enough to import the stages that parse their results
+sys.path[:0] = [os.path.join(os.path.dirname(benchmarks), 'blackbox'), os.path.join(benchmarks, 'stubs')]
+# Benchmarks in the order they are run: (name, setup). Each setup receives a temporary folder, and returns the function
+# to time
+registry = []
+
+
+def benchmark(name):
+    """Register the setup of a benchmark"""
+    def register(setup):
+        registry.append((name, setup))
+        return setup
+    return register
+
+
+@benchmark('filer')
+def filerbenchmark(workdir):
+    """accessoryFunctions.filer over 100,000 file names of the naming conventions it handles"""
+    from accessoryFunctions import filer
+    conventions = ('{}_S{}_L001_R1_001.fastq.gz', '{}_R1_001.fastq.gz', '{}_R2.fastq.gz', '{}_1.fastq', '{}.fastq')
+    filenames = [conventions[index % len(conventions)].format(samplename(index // len(conventions)), index)
+                 for index in range(100000)]
+    return lambda: filer(filenames)
+
+
+@benchmark('samplenamer')
+def samplenamerbenchmark(workdir):
+    """runMetadata.samplenamer on the rows of a 384 sample sheet"""
+    from runMetadata import samplenamer
+    rows = [['{} #{}/{}.{}+{}'.format(samplename(index), index, index % 8, index % 12, index % 3), 'S{}'.format(index)]
+            for index in range(384)]
+    return lambda: [samplenamer(row) for row in rows]
+
+
+@benchmark('samplesheet')
+def samplesheetbenchmark(workdir):
+    """runMetadata.Metadata.parsesamplesheet on a 384 sample sheet"""
+    from accessoryFunctions import GenObject
+    from runMetadata import Metadata
+    writesamplesheet(os.path.join(workdir, 'SampleSheet.csv'), 384)
+    passed = GenObject({'path': os.path.join(workdir, ''), 'runinfo': 'NA', 'commit': 'NA',
+                        'customsamplesheet': None})
+    return lambda: Metadata(passed)
+
+
+@benchmark('maxcut')
+def maxcutbenchmark(workdir):
+    """quality.maxcut on the fastqc_data.txt of 2x301 reads with an even base composition, which is read to the end"""
+    from quality import maxcut
+    lines = ['>>Per base sequence content\tpass\n', '#Base\tG\tA\tT\tC\n']
+    lines.extend('{}\t25.0\t25.0\t25.0\t25.0\n'.format(base) for base in range(1, 302))
+    lines.append('>>END_MODULE\n')
+    return lambda: maxcut(iter(lines), 301)
+
+
+@benchmark('metaparse')
+def metaparsebenchmark(workdir):
+    """quastParser.Quast.metaparse on a QUAST report"""
+    from accessoryFunctions import MetadataObject
+    from quastParser import Quast
+    rows = ['# contigs (>= {} bp)'.format(x) for x in (0, 1000, 5000, 10000, 25000, 50000)] + \
+           ['Total length (>= {} bp)'.format(x) for x in (0, 1000, 5000, 10000, 25000, 50000)] + \
+           ['# contigs', 'Largest contig', 'Total length', 'GC (%)', 'N50', 'N75', 'L50', 'L75', "# N's per 100 kbp"]
+    with open(os.path.join(workdir, 'report.tsv'), 'w') as report:
+        report.write('Assembly\tsample\n' + ''.join('{}\t{}\n'.format(row, index * 1000)
+                                                   for index, row in enumerate(rows)))
+    quast = Quast.__new__(Quast)
+    quast.kmers = '21,33,55,77,99,127'
+    sample = MetadataObject()
+    sample.general.quastresults = workdir
+    return lambda: quast.metaparse(sample)
+
+
+@benchmark('analyze')
+def analyzebenchmark(workdir):
+    """qualimapR.QualiMap.analyze on the lines of a Qualimap genome_results.txt"""
+    from qualimapR import QualiMap
+    lines = ['     number of {} = {:,}\n'.format(name, index * 123456) for index, name in
+             enumerate(('bases', 'contigs', 'reads', 'mapped reads', 'secondary alignments', 'duplicated reads'))]
+    lines.extend(['>>>>>>> Coverage per contig\n'] + ['\tNODE_{}\t{}\t{}\t20.0\t5.0\n'.format(x, x * 10, x * 200)
+                                                       for x in range(200)])
+    lines.extend('     {} = {:.4f}\n'.format(name, index / 3.0) for index, name in
+                 enumerate(('mean insert size', 'std insert size', 'mean mapping quality', 'general error rate')))
+    return lambda: [QualiMap.analyze(line) for line in lines]
+
+
+@benchmark('itsparse')
+def itsparsebenchmark(workdir):
+    """its.ITS.parse on the ITSx positions of 10,000 sequences"""
+    from accessoryFunctions import MetadataObject
+    from its import ITS
+    lines = ['NODE_{}\t600 bp.\tSSU: Not found\tITS1: 1-180\t5.8S: 181-338\tITS2: 339-520\tLSU: 521-600\t'
+             'Broken or partial sequence, only partial 5.8S!\n'.format(index) for index in range(10000)]
+    sample = MetadataObject()
+    return lambda: ITS.parse(sample, lines)
+
+
+@benchmark('metadata')
+def metadatabenchmark(workdir):
+    """MetadataObject.__iter__ and json.dump of 1000 samples, as the metadata are written at the end of a run"""
+    from accessoryFunctions import GenObject, MetadataObject
+    samples = []
+    for index in range(1000):
+        sample = MetadataObject()
+        sample.name = samplename(index)
+        for category in ('run', 'general', 'commands', 'software', 'assembly', 'mapping', 'performance'):
+            setattr(sample, category, GenObject(dict(('{}{}'.format(category, field), field * index if field % 2
+                                                      else '/path/{}/{}'.format(sample.name, field))
+                                                     for field in range(30))))
+        sample.general.fastqfiles = ['{}_R{}.fastq.gz'.format(sample.name, direction) for direction in (1, 2)]
+        samples.append(sample)
+    return lambda: json.dumps([dict(sample) for sample in samples], sort_keys=True, indent=4, separators=(',', ': '))
+
+
+def measure(function, repeat, mintime=0.2):
+    """Time a function the way timeit does: the number of calls of each repetition is doubled until a repetition takes
+    at least mintime, and the best repetition is used
+    :return: best and median seconds per call
+    """
+    number = 1
+    while True:
+        start = time.time()
+        for _ in range(number):
+            function()
+        if time.time() - start >= mintime:
+            break
+        number *= 2
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            function()
+        timings.append((time.time() - start) / number)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def main(args):
+    selection = args.k.split(',') if args.k else [name for name, _ in registry]
+    results = dict()
+    workdir = tempfile.mkdtemp(prefix='blackbox-parsers-')
+    # Parsers such as filer print progress dots, which are discarded while they are timed
+    stdout, devnull = sys.stdout, open(os.devnull, 'w')
+    try:
+        for name, setup in registry:
+            if name not in selection:
+                continue
+            try:
+                function = setup(workdir)
+            except ImportError as error:
+                # e.g. qualimapR needs Biopython
+                print '{:<12} skipped: {}'.format(name, error)
+                continue
+            sys.stdout = devnull
+            try:
+                results[name] = measure(function, args.repeat)
+            finally:
+                sys.stdout = stdout
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as baselinefile:
+            baseline = json.load(baselinefile)
+    regressions = []
+    print '{:<12} {:>12} {:>12} {:>12}'.format('Benchmark', 'Best (ms)', 'Median (ms)', 'vs baseline')
+    for name, _ in registry:
+        if name in results:
+            best, median = results[name]
+            change = ''
+            if baseline.get(name):
+                ratio = best / baseline[name]['best']
+                change = '{:+.0f}%'.format((ratio - 1) * 100)
+                if ratio > 1 + args.tolerance:
+                    regressions.append('{}: {:.3f} -> {:.3f} ms'.format(name, baseline[name]['best'] * 1000,
+                                                                        best * 1000))
+            print '{:<12} {:>12.3f} {:>12.3f} {:>12}'.format(name, best * 1000, median * 1000, change)
+    if args.save:
+        baseline.update((name, {'best': best, 'median': median}) for name, (best, median) in results.items())
+        with open(args.baseline, 'wb') as baselinefile:
+            json.dump(baseline, baselinefile, sort_keys=True, indent=4, separators=(',', ': '))
+        print 'Baseline saved to {}'.format(args.baseline)
+    if regressions:
+        print 'Regressions of more than {:.0f}%:\n  {}'.format(args.tolerance * 100, '\n  '.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the pure-Python parsers of the pipeline')
+    parser.add_argument('-k', help='Comma-separated benchmarks to run. Choose from: {}. Default is all'
+                        .format(', '.join(name for name, _ in registry)))
+    parser.add_argument('--repeat', default=5, type=int, help='Number of timed repetitions. Default is 5')
+    parser.add_argument('--baseline', default=os.path.join(benchmarks, 'parsers.json'),
+                        help='Baseline to compare with. Default is benchmarks/parsers.json')
+    parser.add_argument('--save', action='store_true', help='Store the results as the baseline')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Fraction a benchmark may exceed the baseline '
+                        'by before it is reported as a regression. Default is 0.2')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+"""Benchmark of the profiles of the pipeline on a real run with the real tools. The run is assembled once under each
+profile, and the wall time, samples per hour, CPU hours and peak memory of the commands of each stage are reported
+alongside the assembly metrics QUAST recorded for the samples, so the cost of each profile can be weighed against the
+assemblies it produces e.g.
+python benchmarks/profiles.py /path/to/run -t 16 --save
+python benchmarks/profiles.py /path/to/run --profiles fast,standard
+The run folder must hold the files of the sequencer (SampleSheet.csv, RunInfo.xml, GenerateFASTQRunStatistics.xml and
+the fastq files), and is linked into a folder of its own for each profile. Every profile is run without the stage cache
+"""
+from argparse import ArgumentParser
+from glob import glob
+from orchestration import peakrss, recordcommit, repository
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+__author__ = 'mike knowles'
+
+benchmarks = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, repository)
+from blackbox.profiles import profiles
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def commandusage(logfile):
+    """CPU seconds and peak memory of the commands of each stage, from the log of commands of a run
+    :return: dictionary of key: (cpu seconds, peak resident bytes)
+    """
+    usage = dict()
+    with open(logfile) as log:
+        for line in log:
+            record = json.loads(line)
+            if record['event'] == 'finish':
+                cpu, peak = usage.get(record.get('key', 'other'), (0.0, 0))
+                usage[record.get('key', 'other')] = (cpu + record['cpu'], max(peak, record['peakrss']))
+    return usage
+
+
+def assemblies(path):
+    """Assembly metrics of the samples of a run, from the QUAST section of their reports
+    :return: medians of the N50, number of contigs and total length, and the number of samples assembled
+    """
+    metrics = {'N50': [], 'NumContigs': [], 'TotalLength': []}
+    for report in glob(os.path.join(path, '*', '*_metadata.json')):
+        with open(report) as reportfile:
+            assembly = json.load(reportfile).get('assembly', {})
+        for metric in metrics:
+            try:
+                metrics[metric].append(float(assembly[metric]))
+            except (KeyError, TypeError, ValueError):
+                pass
+    result = dict((metric, median(values)) for metric, values in metrics.items())
+    result['assembled'] = len(metrics['N50'])
+    return result
+
+
+def pipeline(path, profile, threads, memory):
+    """Assemble a run under a profile
+    :return: dictionary of the metrics of the run
+    """
+    script = os.path.join(repository, 'bin', 'MBBspades')
+    command = [sys.executable, script, path, '-t', str(threads), '--profile', profile, '--restart', '--nocache']
+    if memory:
+        command += ['--memory', str(memory)]
+    with open(os.path.join(path, 'benchmark.log'), 'wb') as log:
+        start = time.time()
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        peak = 0
+        while process.poll() is None:
+            peak = max(peak, peakrss(process.pid))
+            time.sleep(0.5)
+        wall = time.time() - start
+    assert process.returncode == 0, 'The pipeline failed under the {} profile. See {}'.format(
+        profile, os.path.join(path, 'benchmark.log'))
+    samples = len(glob(os.path.join(path, '*', '*_metadata.json')))
+    usage = commandusage(os.path.join(path, 'commands.jsonl'))
+    return {'wall': wall, 'samples': samples, 'samplesperhour': samples / wall * 3600 if wall else 0,
+            'cpuhours': sum(cpu for cpu, _ in usage.values()) / 3600,
+            'stages': dict((key, {'cpuhours': cpu / 3600, 'peakrss': peakbytes})
+                           for key, (cpu, peakbytes) in usage.items()),
+            'peakrss': max([peakbytes for _, peakbytes in usage.values()] + [peak]),
+            'assembly': assemblies(path)}
+
+
+def report(results):
+    """Print the results of each profile, with the change from the standard profile"""
+    print '{:<10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'Profile', 'Wall (h)', 'Samples/h', 'CPU (h)', 'Peak RSS', 'N50', 'Contigs', 'Length')
+    standard = results.get('standard')
+    for name in sorted(results, key=lambda x: results[x]['wall']):
+        result = results[name]
+        assembly = result['assembly']
+        value = lambda metric, form: form.format(assembly[metric]) if assembly[metric] is not None else '-'
+        print '{:<10} {:>10.2f} {:>10.1f} {:>10.1f} {:>9.1f}G {:>10} {:>10} {:>12}'.format(
+            name, result['wall'] / 3600, result['samplesperhour'], result['cpuhours'],
+            result['peakrss'] / 1024.0 ** 3, value('N50', '{:.0f}'), value('NumContigs', '{:.0f}'),
+            value('TotalLength', '{:.0f}'))
+        if standard and name != 'standard':
+            changes = ['wall {:+.0f}%'.format((result['wall'] / standard['wall'] - 1) * 100),
+                       'CPU {:+.0f}%'.format((result['cpuhours'] / standard['cpuhours'] - 1) * 100)
+                       if standard['cpuhours'] else 'CPU -']
+            if assembly['N50'] and standard['assembly']['N50']:
+                changes.append('N50 {:+.1f}%'.format((assembly['N50'] / standard['assembly']['N50'] - 1) * 100))
+            print '{:<10} vs standard: {}'.format('', ', '.join(changes))
+
+
+def main(args):
+    recordcommit()
+    workdir = args.workdir if args.workdir else tempfile.mkdtemp(prefix='blackbox-profiles-')
+    results = dict()
+    try:
+        for profile in args.profiles.split(','):
+            assert profile in profiles, 'Unknown profile {}. Choose from {}'.format(profile, ', '.join(profiles))
+            # Every profile starts from a folder holding only the files of the sequencer
+            path = os.path.join(workdir, profile)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            os.makedirs(path)
+            for filename in os.listdir(args.run):
+                if os.path.isfile(os.path.join(args.run, filename)):
+                    os.symlink(os.path.abspath(os.path.join(args.run, filename)), os.path.join(path, filename))
+            print 'Assembling {} under the {} profile'.format(args.run, profile)
+            results[profile] = pipeline(path, profile, args.threads, args.memory)
+    finally:
+        if not args.workdir and not args.keep:
+            shutil.rmtree(workdir)
+    report(results)
+    if args.save:
+        with open(args.output, 'wb') as outputfile:
+            json.dump({'profiles': profiles, 'results': results, 'run': os.path.abspath(args.run),
+                       'threads': args.threads, 'time': time.time()},
+                      outputfile, sort_keys=True, indent=4, separators=(',', ': '))
+        print 'Results saved to {}'.format(args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark the profiles of the pipeline on a run with the real tools')
+    parser.add_argument('run', help='Folder of the files of the sequencer of the run to assemble')
+    parser.add_argument('--profiles', default=','.join(sorted(profiles)), help='Comma-separated profiles to run. '
+                        'Default is every profile')
+    parser.add_argument('-t', '--threads', default=4, type=int, help='Number of threads of the pipeline. Default is 4')
+    parser.add_argument('--memory', type=float, help='Memory in GB of the pipeline. Default is the memory available')
+    parser.add_argument('--workdir', help='Folder to run the profiles in. Default is a temporary folder that is '
+                        'removed afterwards')
+    parser.add_argument('--keep', action='store_true', help='Keep the temporary folder of the runs')
+    parser.add_argument('--output', default=os.path.join(benchmarks, 'profiles.json'),
+                        help='File to save the results to. Default is benchmarks/profiles.json')
+    parser.add_argument('--save', action='store_true', help='Save the results, with the settings of each profile')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Startup budget of the command line. Each command is run several times, and fails the budget if its median wall time
+exceeds the budget, or if it imports a heavy dependency that only the stages need e.g.
+python benchmarks/startup.py --budget 0.25
+"""
+from argparse import ArgumentParser
+from orchestration import recordcommit, repository
+import os
+import re
+import subprocess
+import sys
+import time
+
+__author__ = 'mike knowles'
+
+# Dependencies of the stages, which must not be imported before a stage is run
+heavy = ('Bio', 'yaml', 'quast', 'itsx', 'spades', 'spades_init', 'pkg_resources', 'multiprocessing')
+pipeline = os.path.join(repository, 'bin', 'MBBspades')
+# Commands that must start within the budget: (name, arguments of the interpreter)
+commands = [('--version', [pipeline, '--version']),
+            ('--help', [pipeline, '--help']),
+            ('watchers', ['-c', 'from blackbox import fastqCreator, offhours, basicAssembly'])]
+
+
+def imports(arguments, environment):
+    """Find the heavy dependencies imported by a command with the verbose mode of the interpreter"""
+    process = subprocess.Popen([sys.executable, '-v'] + arguments, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               env=environment)
+    _, stderr = process.communicate()
+    modules = set(match.group(1) for match in re.finditer(r'^import (\w+)', stderr, re.MULTILINE))
+    return sorted(modules.intersection(heavy))
+
+
+def wall(arguments, environment, repeat):
+    """Median wall time of a command in seconds"""
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.call([sys.executable] + arguments, stdout=devnull, stderr=devnull, env=environment)
+            timings.append(time.time() - start)
+    timings.sort()
+    return timings[len(timings) // 2]
+
+
+def main(args):
+    recordcommit()
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = os.pathsep.join([repository, environment.get('PYTHONPATH', '')])
+    # The time to start the interpreter alone, which the budget does not control
+    interpreter = wall(['-c', 'pass'], environment, args.repeat)
+    print 'Interpreter alone: {:.3f} s'.format(interpreter)
+    print '{:<12} {:>10} {:>10}  {}'.format('Command', 'Median (s)', 'Budget (s)', 'Heavy imports')
+    failures = []
+    for name, arguments in commands:
+        median = wall(arguments, environment, args.repeat)
+        loaded = imports(arguments, environment)
+        print '{:<12} {:>10.3f} {:>10.3f}  {}'.format(name, median, args.budget, ', '.join(loaded) if loaded else '-')
+        if median > args.budget:
+            failures.append('{} took {:.3f} s'.format(name, median))
+        if loaded:
+            failures.append('{} imported {}'.format(name, ', '.join(loaded)))
+    if failures:
+        print 'Over the startup budget:\n  {}'.format('\n  '.join(failures))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Check the startup time of the command line against a budget')
+    parser.add_argument('--budget', default=0.25, type=float, help='Median seconds each command may take to start, '
+                        'including the interpreter. Default is 0.25')
+    parser.add_argument('--repeat', default=7, type=int, help='Number of runs of each command. Default is 7')
+    sys.exit(main(parser.parse_args()))
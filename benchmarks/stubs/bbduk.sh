@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+"""Stub of bbduk.sh. Copies the reads to the trimmed files uncompressed"""
+import sys
+import stubtool
+
+__author__ = 'mike knowles'
+
+
+def main(args):
+    if '-version' in args or '--version' in args:
+        # The pipeline reads the version from the third line from the end of the output
+        stubtool.out('BBDuk version 37.36\nFor help, please run the shell script with no parameters, or look in '
+                     '/docs/.\n')
+        return
+    pairs = [('in1=', 'out1='), ('in2=', 'out2='), ('in=', 'out=')]
+    stubtool.work('bbduk')
+    reads = 0
+    for source, destination in pairs:
+        if stubtool.option(args, source) and stubtool.option(args, destination):
+            stubtool.copyreads(stubtool.option(args, source), stubtool.option(args, destination))
+            reads += stubtool.reads(stubtool.option(args, source))
+    sys.stderr.write('Input:\t{0} reads\nResult:\t{0} reads (100.00%)\n'.format(reads))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""Stub of the itsx.parallel wrapper of ITSx. Runs the ITSx stub on the whole input rather than on chunks of it"""
+import os
+import subprocess
+
+__author__ = 'mike knowles'
+
+
+class ITSx(object):
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+    def __str__(self):
+        return 'ITSx ' + ' '.join('{}{} {}'.format('-' if len(key) == 1 else '--', key, value)
+                                  for key, value in sorted(self.options.items()))
+
+    def __call__(self, name='ITSx_out', total=0):
+        """Run ITSx with the output files named after the sample
+        :param name: prefix of the output files in the output folder
+        :param total: total length of the input, used by the real wrapper to split the input
+        """
+        command = ['ITSx', '-i', self.options['i'], '-o', os.path.join(self.options['o'], name)]
+        return subprocess.check_call(command)
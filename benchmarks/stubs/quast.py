@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""Stub of QUAST. Writes the report of the assembly with the statistics the pipeline parses"""
+import os
+import sys
+import stubtool
+
+__author__ = 'mike knowles'
+
+
+def main(args):
+    outdir = stubtool.option(args, '-o')
+    valued = ('-o', '-R', '-t', '--threads', '-G', '-O')
+    assemblies = [arg for index, arg in enumerate(args)
+                  if not arg.startswith('-') and (index == 0 or args[index - 1] not in valued)]
+    stubtool.make_path(outdir)
+    stubtool.work('quast')
+    records = stubtool.readfasta(assemblies[0])
+    lengths = sorted((len(sequence) for _, sequence in records), reverse=True)
+    total = sum(lengths)
+    gc = sum(sequence.count('G') + sequence.count('C') for _, sequence in records)
+    # N50 is the length of the contig at which half of the assembly is in contigs at least as long
+    n50, covered = 0, 0
+    for length in lengths:
+        covered += length
+        if covered * 2 >= total:
+            n50 = length
+            break
+    rows = [('Assembly', os.path.splitext(os.path.basename(assemblies[0]))[0]),
+            ('# contigs (>= 0 bp)', len(lengths)), ('# contigs (>= 1000 bp)', len([x for x in lengths if x >= 1000])),
+            ('Total length (>= 0 bp)', total), ('# contigs', len(lengths)),
+            ('Largest contig', lengths[0] if lengths else 0), ('Total length', total),
+            ('GC (%)', '{:.2f}'.format(100.0 * gc / total if total else 0)), ('N50', n50)]
+    with open(os.path.join(outdir, 'report.tsv'), 'w') as report:
+        for key, value in rows:
+            report.write('{}\t{}\n'.format(key, value))
+    with open(os.path.join(outdir, 'report.txt'), 'w') as report:
+        for key, value in rows:
+            report.write('{:<30} {}\n'.format(key, value))
+    with open(os.path.join(outdir, 'quast.log'), 'w') as log:
+        log.write('quast.py {}\n'.format(' '.join(args)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
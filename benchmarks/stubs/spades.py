@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Stub of SPAdes. Writes random contigs, a log with the peak memory and insert size, and corrected reads"""
+import os
+import sys
+import stubtool
+
+__author__ = 'mike knowles'
+
+
+def main(args):
+    outdir = stubtool.option(args, '-o')
+    corrected = os.path.join(outdir, 'corrected')
+    stubtool.make_path(corrected)
+    # The reads of each library
+    libraries = [('left reads', ('--pe1-1', '--mp1-1')), ('right reads', ('--pe1-2', '--mp2-2')),
+                 ('interlaced reads', ('--mp1-12',)), ('single reads', ('--s1',))]
+    reads = [(group, stubtool.option(args, *names)) for group, names in libraries]
+    reads = [(group, fastq) for group, fastq in reads if fastq]
+    stubtool.work('spades')
+    records = stubtool.contigs(' '.join(fastq for _, fastq in reads))
+    stubtool.writefasta(os.path.join(outdir, 'contigs.fasta'), records)
+    stubtool.writefasta(os.path.join(outdir, 'scaffolds.fasta'), records)
+    with open(os.path.join(outdir, 'params.txt'), 'w') as params:
+        params.write('Command line: spades.py {}\n'.format(' '.join(args)))
+    # The corrected reads, and the yaml file listing them
+    with open(os.path.join(corrected, 'corrected.yaml'), 'w') as yaml:
+        yaml.write('- type: paired-end\n  orientation: fr\n')
+        for group, fastq in reads:
+            name = os.path.basename(fastq).split('.')[0] + '.00.0_0.cor.fastq.gz'
+            stubtool.copyreads(fastq, os.path.join(corrected, name))
+            yaml.write('  {}:\n  - {}\n'.format(group, os.path.join(corrected, name)))
+    with open(os.path.join(outdir, 'spades.log'), 'w') as log:
+        log.write('Command line: spades.py {}\n'.format(' '.join(args)))
+        log.write('  0:00:00.512   120M / 1G    INFO    General (pair_info_count.cpp : 191) Insert size = 240.514, '
+                  'deviation = 105.257, left quantile = 142, right quantile = 384, read length = 301\n')
+        log.write('  0:00:01.024    90M / 2G    INFO    General (launch.hpp : 120) SPAdes finished\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
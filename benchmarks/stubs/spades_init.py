@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+"""Stub of the spades_init module of SPAdes"""
+
+__author__ = 'mike knowles'
+
+# Versions from 3.6.2 are run with python3, so report an older version to run the stub with the interpreter on PATH
+spades_version = ''
+
+
+def init():
+    global spades_version
+    spades_version = '3.5.0\n'
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Behaviour shared by the stub tools used to benchmark the orchestration of the pipeline without the real
+bioinformatics tools. Each stub accepts the command line the pipeline builds, sleeps for a configurable time, and
+writes the outputs the pipeline parses.
+
+Configured with environment variables:
+BLACKBOX_STUB_RUNTIME             seconds every tool runs for. Default 0
+BLACKBOX_STUB_<TOOL>_RUNTIME      seconds a single tool runs for e.g. BLACKBOX_STUB_SPADES_RUNTIME=30
+BLACKBOX_STUB_CONTIGS             number of contigs in each assembly. Default 20
+BLACKBOX_STUB_CONTIGLENGTH        length of each contig. Default 5000
+"""
+import gzip
+import os
+import random
+import sys
+import time
+
+__author__ = 'mike knowles'
+
+
+def work(tool):
+    """Run for the configured time of a tool"""
+    runtime = os.environ.get('BLACKBOX_STUB_{}_RUNTIME'.format(tool.upper()),
+                             os.environ.get('BLACKBOX_STUB_RUNTIME', '0'))
+    time.sleep(float(runtime))
+
+
+def option(args, *names):
+    """Find the value of the first of the named options in a list of arguments e.g. option(args, '-o', '--output')
+    Supports both '-o value' and 'key=value' styles"""
+    for index, arg in enumerate(args):
+        for name in names:
+            if name.endswith('=') and arg.startswith(name):
+                return arg[len(name):]
+            if arg == name and index + 1 < len(args):
+                return args[index + 1]
+    return None
+
+
+def make_path(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+
+def fastqopen(fastq):
+    return gzip.open(fastq, 'rb') if fastq.endswith('.gz') else open(fastq, 'rb')
+
+
+def readlength(fastq):
+    """Length of the first read of a fastq file"""
+    with fastqopen(fastq) as handle:
+        handle.readline()
+        return len(handle.readline().rstrip())
+
+
+def reads(fastq):
+    """Number of reads in a fastq file"""
+    with fastqopen(fastq) as handle:
+        return sum(1 for _ in handle) // 4
+
+
+def copyreads(source, destination):
+    """Copy the reads of a fastq file, decompressing or compressing them to match the destination"""
+    with fastqopen(source) as inputfile:
+        output = gzip.open(destination, 'wb') if destination.endswith('.gz') else open(destination, 'wb')
+        with output:
+            for line in inputfile:
+                output.write(line)
+
+
+def contigs(seed):
+    """Create the contigs of a synthetic assembly
+    :param seed: seed of the random sequences, so the same inputs create the same assembly
+    :return: list of (name, sequence)
+    """
+    count = int(os.environ.get('BLACKBOX_STUB_CONTIGS', 20))
+    length = int(os.environ.get('BLACKBOX_STUB_CONTIGLENGTH', 5000))
+    generator = random.Random(seed)
+    return [('NODE_{}_length_{}_cov_20.0_ID_{}'.format(index + 1, length, index * 2 + 1),
+             ''.join(generator.choice('ACGT') for _ in range(length))) for index in range(count)]
+
+
+def writefasta(filename, records):
+    with open(filename, 'w') as fasta:
+        for name, sequence in records:
+            fasta.write('>{}\n'.format(name))
+            for start in range(0, len(sequence), 60):
+                fasta.write(sequence[start:start + 60] + '\n')
+
+
+def readfasta(filename):
+    """Read the records of a fasta file
+    :return: list of (name, sequence)
+    """
+    records = []
+    with open(filename) as fasta:
+        for line in fasta:
+            if line.startswith('>'):
+                records.append([line[1:].strip(), []])
+            elif records:
+                records[-1][1].append(line.strip())
+    return [(name, ''.join(sequence)) for name, sequence in records]
+
+
+def out(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""Create synthetic MiSeq run folders with a sample sheet, run information, run statistics and paired gzipped fastq
+files for each sample e.g.
+python benchmarks/synthetic.py /tmp/run100 --samples 100
+"""
+from argparse import ArgumentParser
+import gzip
+import os
+import random
+
+__author__ = 'mike knowles'
+
+runname = '160101_M00000_0001_000000000-BENCH'
+
+samplesheet = """[Header]
+IEMFileVersion,4
+Investigator Name,Benchmark
+Experiment Name,{run}
+Date,1/1/2016
+Workflow,GenerateFASTQ
+Application,FASTQ Only
+Assay,Nextera XT
+Description,Synthetic run
+Chemistry,Amplicon
+
+[Reads]
+{length}
+{length}
+
+[Settings]
+ReverseComplement,0
+Adapter,CTGTCTCTTATACACATCT
+
+[Data]
+Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description
+"""
+
+runinfo = """<?xml version="1.0"?>
+<RunInfo Version="2">
+  <Run Id="{run}" Number="1">
+    <Flowcell>000000000-BENCH</Flowcell>
+    <Instrument>M00000</Instrument>
+    <Date>160101</Date>
+    <Reads>
+      <Read Number="1" NumCycles="{length}" IsIndexedRead="N" />
+      <Read Number="2" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="3" NumCycles="8" IsIndexedRead="Y" />
+      <Read Number="4" NumCycles="{length}" IsIndexedRead="N" />
+    </Reads>
+  </Run>
+</RunInfo>
+"""
+
+
+def samplename(index):
+    return '2016-SEQ-{:04d}'.format(index + 1)
+
+
+def writesamplesheet(filename, samples, length=150):
+    """Write a sample sheet of a run of synthetic samples"""
+    with open(filename, 'w') as sheet:
+        sheet.write(samplesheet.format(run=runname, length=length))
+        for index in range(samples):
+            sheet.write('{0},{0},,,N7{1:02d},ACGTACGT,S5{1:02d},TGCATGCA,BENCH,\n'.format(samplename(index),
+                                                                                       index % 96))
+
+
+def writereads(filename, reads, length, genome, generator):
+    """Write gzipped fastq reads sampled from a genome"""
+    quality = 'I' * length
+    with gzip.open(filename, 'wb') as fastq:
+        for read in range(reads):
+            start = generator.randint(0, len(genome) - length)
+            fastq.write('@M00000:1:000000000-BENCH:1:1101:{}:1000 1:N:0:1\n{}\n+\n{}\n'
+                        .format(read, genome[start:start + length], quality))
+
+
+def createrun(path, samples, reads=1000, length=150, seed=0):
+    """Create a synthetic MiSeq run folder
+    :param path: folder of the run
+    :param samples: number of samples
+    :param reads: number of read pairs of each sample
+    :param length: length of the reads
+    :param seed: seed of the random bases, so the same arguments create the same run
+    """
+    generator = random.Random(seed)
+    # The reads of every sample are sampled from the same random genome
+    genome = ''.join(generator.choice('ACGT') for _ in range(100000))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    writesamplesheet(os.path.join(path, 'SampleSheet.csv'), samples, length)
+    with open(os.path.join(path, 'RunInfo.xml'), 'w') as info:
+        info.write(runinfo.format(run=runname, length=length))
+    with open(os.path.join(path, 'GenerateFASTQRunStatistics.xml'), 'w') as statistics:
+        statistics.write('<?xml version="1.0"?>\n<StatisticsGenerateFASTQ>\n  <RunStats>\n'
+                         '    <NumberOfClustersPF>{}</NumberOfClustersPF>\n  </RunStats>\n'
+                         '  <OverallSamples>\n'.format(reads * samples))
+        for index in range(samples):
+            statistics.write('    <SummarizedSampleStatistics>\n      <SampleNumber>{0}</SampleNumber>\n'
+                             '      <SampleID>{1}</SampleID>\n      <SampleName>{1}</SampleName>\n'
+                             '      <NumberOfClustersPF>{2}</NumberOfClustersPF>\n'
+                             '    </SummarizedSampleStatistics>\n'.format(index + 1, samplename(index), reads))
+        statistics.write('  </OverallSamples>\n</StatisticsGenerateFASTQ>\n')
+    for index in range(samples):
+        for direction in ('R1', 'R2'):
+            writereads(os.path.join(path, '{}_S{}_L001_{}_001.fastq.gz'.format(samplename(index), index + 1,
+                                                                               direction)),
+                       reads, length, genome, generator)
+    return path
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Create a synthetic MiSeq run folder')
+    parser.add_argument('path', help='Folder of the run')
+    parser.add_argument('--samples', default=10, type=int, help='Number of samples. Default is 10')
+    parser.add_argument('--reads', default=1000, type=int, help='Number of read pairs of each sample. Default is 1000')
+    parser.add_argument('--length', default=150, type=int, help='Length of the reads. Default is 150')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the random bases. Default is 0')
+    arguments = parser.parse_args()
+    createrun(arguments.path, arguments.samples, arguments.reads, arguments.length, arguments.seed)
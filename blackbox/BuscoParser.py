@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from accessoryFunctions import *
 from glob import iglob
+from progress import board
 import os
 import shutil
 
@@ -8,59 +9,49 @@ __author__ = 'mikeknowles,akoziol'
 
 
 class Busco(object):
-    def buscoprocess(self):
-        from threading import Thread
+    def __call__(self):
+        """Run BUSCO on every assembled sample in a multi-threaded fashion"""
+        printtime('Running BUSCO {} for gene discovery metrics'.format(self.version.split(",")[0]), self.start)
         os.chdir(self.path)
-        # Find the fasta files for each sample
-        # Only make as many threads are there are samples with fasta files
-        for i in range(len([sample.general for sample in self.metadata if sample.general.bestassemblyfile != "NA"])):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.analyze, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.metadata:
-            # Save augustus, blast and BUSCO versions
-            sample.software.BUSCO, sample.software.Blastn, sample.software.Augustus, sample.software.python3 = \
-                self.version, self.blast, self.augustus, self.pyversion
-            if sample.general.bestassemblyfile != "NA":
-                sample.general.buscoresults = '{}/busco_results'.format(sample.general.outputdirectory)
-                buscotemp = os.path.join(sample.general.buscoresults, "run_{}".format(sample.name))
-                sample.commands.BUSCO = "python3 {} -in {} -o {} -l /accessoryfiles/{} -m genome". \
-                    format(self.executable, sample.general.bestassemblyfile, sample.name, self.lineage)
-                self.qqueue.put((sample, buscotemp))
-            else:
-                sample.commands.BUSCO = "NA"
-        self.qqueue.join()
+        # Run BUSCO on each sample in the pool
+        with WorkerPool(self.allocator.cores) as pool:
+            pool.map(self.run, self.metadata)
 
-    def analyze(self):
-        """Run the quast command in a multi-threaded fashion"""
-        while True:
-            sample, temp = self.qqueue.get()
-            summary = 'short_summary_{}'.format(sample.name)
-            tempfile, moved = [os.path.join(x, summary) for x in [temp, sample.general.buscoresults]]
-            # Make sure assembled data exists and BUSCO results do not exist
-            if sample.general.bestassemblyfile != 'NA' and map(os.path.isfile, [tempfile, moved]) == [False] * 2:
-                if os.path.isdir(temp):  # force incomplete BUSCO runs
-                    sample.commands.BUSCO += " -f"
-                else:
-                    make_path(sample.general.buscoresults)
-                execute(sample.commands.BUSCO, cwd=sample.general.buscoresults)
-            if os.path.isfile(tempfile):
-                for tempfolder in iglob(os.path.join(temp, '*')):
-                    shutil.move(tempfolder, sample.general.buscoresults)
-                os.rmdir(temp)
-            if os.path.isfile(moved):
-                self.metaparse(sample, moved)
-            # Signal to the queue that the job is done
-            self.qqueue.task_done()
+    def run(self, sample):
+        """Create and run the BUSCO command for a single sample, and parse the short summary"""
+        # Save augustus, blast and BUSCO versions
+        sample.software.BUSCO, sample.software.Blastn, sample.software.Augustus, sample.software.python3 = \
+            self.version, self.blast, self.augustus, self.pyversion
+        if sample.general.bestassemblyfile == "NA":
+            sample.commands.BUSCO = "NA"
+            return
+        sample.general.buscoresults = '{}/busco_results'.format(sample.general.outputdirectory)
+        temp = os.path.join(sample.general.buscoresults, "run_{}".format(sample.name))
+        sample.commands.BUSCO = "python3 {} -in {} -o {} -l /accessoryfiles/{} -m genome". \
+            format(self.executable, sample.general.bestassemblyfile, sample.name, self.lineage)
+        summary = 'short_summary_{}'.format(sample.name)
+        tempfile, moved = [os.path.join(x, summary) for x in [temp, sample.general.buscoresults]]
+        # Make sure assembled data exists and BUSCO results do not exist
+        if map(os.path.isfile, [tempfile, moved]) == [False] * 2:
+            if os.path.isdir(temp):  # force incomplete BUSCO runs
+                sample.commands.BUSCO += " -f"
+            else:
+                make_path(sample.general.buscoresults)
+            with self.allocator.lease('busco', memory=2 * 1024 ** 3) as lease:
+                sample.commands.BUSCO += " -c {}".format(lease.cores)
+                execute(sample.commands.BUSCO, sample=sample, key='busco', cwd=sample.general.buscoresults)
+        if os.path.isfile(tempfile):
+            for tempfolder in iglob(os.path.join(temp, '*')):
+                shutil.move(tempfolder, sample.general.buscoresults)
+            os.rmdir(temp)
+        if os.path.isfile(moved):
+            self.metaparse(sample, moved)
 
     @staticmethod
     def metaparse(sample, resfile):
         pc = lambda x: x if x[0].isupper() else x.title()
         if not os.path.isfile(resfile):
-            print "There was an issue getting the metadata from {0:s}".format(sample.name)
+            board.message("There was an issue getting the metadata from {0:s}".format(sample.name))
         else:
             busco = dict()
             # Open BUSCO short_summary file and make list of key value pairs then add those the assembly metadata
@@ -78,22 +69,17 @@ class Busco(object):
             # sample.assembly = GenObject(busco)
 
     def __init__(self, inputobject):
-        from Queue import Queue
-        from Bio.Blast.Applications import NcbiblastnCommandline
         from distutils import spawn
         # Find blastn and augustus version
         self.version = "v1.1b1"
-        self.augustus = " ".join(get_version(['augustus', '--version']).split()[:2])
-        self.blast = NcbiblastnCommandline(version=True)()[0].replace('\n', ' ').rstrip()
+        self.augustus = inputobject.tools.version('augustus')
+        self.blast = inputobject.tools.version('blastn')
         self.metadata = inputobject.runmetadata.samples
         # Retrieve abspath of BUSCO executable using spawn
         self.executable = os.path.abspath(spawn.find_executable("BUSCO_{}.py".format(self.version)))
-        self.pyversion = get_version(['python3', '-c', 'import sys; print(sys.version)']).rstrip()
+        self.pyversion = inputobject.tools.version('python3')
         self.start = inputobject.starttime
-        self.threads = inputobject.cpus
+        self.allocator = inputobject.allocator
         self.path = inputobject.path
-        self.qqueue = Queue()
-        printtime('Running BUSCO {} for gene discovery metrics'.format(self.version.split(",")[0]), self.start)
         # Testing with bacterial HMMs
         self.lineage = inputobject.clade
-        self.buscoprocess()
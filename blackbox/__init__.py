@@ -1,4 +1,6 @@
 #!/usr/bin/env python
 __author__ = 'mike knowles'
 __all__ = ['accessoryFunctions', 'basicAssembly', 'fastqCreator', 'fastqmover', 'metadataprinter', 'metadataReader',
-           'offhours', 'quality', 'quastParser', 'runMetadata', 'spadesRun', 'BuscoParser', 'qualimapR', 'its']
+           'offhours', 'quality', 'quastParser', 'runMetadata', 'spadesRun', 'BuscoParser', 'qualimapR', 'its',
+           'scheduler', 'spadesMemory', 'stageCache', 'journal', 'trace', 'profiler', 'tools', 'broker', 'workqueue',
+           'stageRuntime', 'planExport', 'progress', 'profiles']
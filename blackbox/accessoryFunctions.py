@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 from subprocess import Popen, PIPE, STDOUT
+from contextlib import contextmanager
+from threading import Lock, local
 import os
 import errno
+import time
 
 __author__ = 'adamkoziol,mikeknowles'
 
@@ -30,6 +33,12 @@ def get_version(exe):
     return Popen(exe, stdout=PIPE, stderr=STDOUT).stdout.read()
 
 
+def blackboxhome():
+    """Folder for files shared between runs of the pipeline e.g. the peak memory of previous assemblies. Set with the
+    BLACKBOX_HOME environment variable, defaults to ~/.blackbox"""
+    return os.environ.get('BLACKBOX_HOME', os.path.join(os.path.expanduser('~'), '.blackbox'))
+
+
 def make_dict():
     """Makes Perl-style dictionaries"""
     from collections import defaultdict
@@ -37,93 +46,649 @@ def make_dict():
 
 
 def printtime(string, start):
-    """Prints a string in bold with the elapsed time
+    """Prints a string in bold with the elapsed time, above the progress board once it is started
     :param string: a string to be printed in bold
     :param start: integer of the starting time
     """
     import time
+    from progress import board
     m, s = divmod(time.time() - start, 60)
     h, m = divmod(m, 60)
     strtime = "{0:0.0f}hr {1:0.0f}m {2:0.03f}s".format(h, m, s) if h else "{0:0.0f}m {1:0.03f}s".format(m, s)
-    print('\n\033[1m' + "[Elapsed Time: {}] {}".format(strtime, string) + '\033[0m')
+    board.message('\033[1m' + "[Elapsed Time: {}] {}".format(strtime, string) + '\033[0m')
 
 
-# Initialise globalcount
-globalcount = 0
+def proctree():
+    """Find the processes of every process group from /proc
+    :return: dictionary of process group id: list of process ids
+    """
+    groups = dict()
+    for pid in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if pid.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat:
+                    fields = stat.read()
+            except IOError:
+                # The process exited
+                continue
+            # The command name is in brackets and may contain spaces. It is followed by the state, the parent process
+            # id and the process group id
+            groups.setdefault(int(fields[fields.rindex(')') + 2:].split()[2]), []).append(int(pid))
+    return groups
 
 
-def dotter():
-    """Prints formatted time to stdout at the start of a line, as well as a "."
-    whenever the length of the line is equal or lesser than 80 "." long"""
-    import time
-    import sys
-    # Use a global variable
-    global globalcount
-    if globalcount <= 80:
-        sys.stdout.write('.')
-        globalcount += 1
-    else:
-        sys.stdout.write('\n[{0:s}] .'.format(time.strftime("%H:%M:%S")))
-        globalcount = 1
+def procfields(pid, name, separator=':'):
+    """Read the fields of a /proc/<pid>/<name> file e.g. io or status into a dictionary"""
+    fields = dict()
+    try:
+        with open('/proc/{}/{}'.format(pid, name)) as proc:
+            for line in proc:
+                if separator in line:
+                    key, value = line.split(separator, 1)
+                    fields[key.strip()] = value.strip()
+    except IOError:
+        pass
+    return fields
+
+
+def cputicks(pid):
+    """Clock ticks of user and system time used by a process, or None if the process has exited"""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            # The command name is in parentheses and may contain spaces, so the fields are counted from its end
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except (IOError, IndexError):
+        return None
+    return int(fields[11]) + int(fields[12])
+
+
+def processsnapshot(pid):
+    """State of a process for the record of a stalled command
+    :return: dictionary of the name, state and command line of the process, the kernel function it sleeps in, its
+    current system call, and its kernel stack, which can only be read by root
+    """
+    status = procfields(pid, 'status')
+    snapshot = {'pid': pid, 'name': status.get('Name', ''), 'state': status.get('State', '')}
+    for name in ('cmdline', 'wchan', 'syscall', 'stack'):
+        try:
+            with open('/proc/{}/{}'.format(pid, name)) as proc:
+                snapshot[name] = proc.read().replace('\0', ' ').strip()
+        except (IOError, OSError):
+            snapshot[name] = ''
+    return snapshot
+
+
+class Child(object):
+    """A subprocess started by the ProcessMonitor, and the resources used by it and its descendants"""
+
+    def sample(self, pids):
+        """Record the memory and input/output of the processes of the process group of the subprocess
+        :param pids: list of process ids in the process group
+        """
+        now = time.time()
+        ticks = sum(self.ticks.values())
+        rss = 0
+        for pid in pids:
+            status = procfields(pid, 'status')
+            # VmRSS and VmHWM are in kB
+            rss += int(status.get('VmRSS', '0 kB').split()[0]) * 1024
+            self.peakprocessrss = max(self.peakprocessrss, int(status.get('VmHWM', '0 kB').split()[0]) * 1024)
+            io = procfields(pid, 'io')
+            if io:
+                # Keep the last values of every process, as the counters are lost once a process exits
+                self.io[pid] = (int(io['read_bytes']), int(io['write_bytes']), int(io['rchar']), int(io['wchar']))
+            processticks = cputicks(pid)
+            if processticks is not None:
+                self.ticks[pid] = processticks
+        self.peakrss = max(self.peakrss, rss)
+        # Current memory, and the cpu used since the last sample as a percentage of a core
+        self.rss = rss
+        self.cpu = 100.0 * (sum(self.ticks.values()) - ticks) / os.sysconf('SC_CLK_TCK') / max(now - self.sampled, 1e-3)
+        self.sampled = now
+
+    def progress(self):
+        """Measures of the progress of the subprocess and its descendants
+        :return: clock ticks of cpu time, characters read and written, and the size of the output file
+        """
+        try:
+            size = os.path.getsize(self.outfile) if self.outfile else 0
+        except OSError:
+            size = 0
+        return sum(self.ticks.values()), sum(io[2] + io[3] for io in self.io.values()), size
+
+    def reap(self, status, rusage):
+        """Record the exit status and the resource usage returned by wait4. A status of None is a subprocess reaped
+        elsewhere, which keeps the exit code Popen found, if any"""
+        if status is None:
+            self.returncode = self.process.returncode
+        else:
+            self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self.process.returncode = self.returncode
+        self.rusage = rusage
+        self.end = time.time()
+
+    def pause(self, stop):
+        """Stop the process group of the subprocess with SIGSTOP, or continue it with SIGCONT, and keep the time it
+        spent stopped"""
+        import signal
+        try:
+            os.killpg(self.process.pid, signal.SIGSTOP if stop else signal.SIGCONT)
+        except OSError:
+            # The process group has exited
+            pass
+        if stop and self.stopped is None:
+            self.stopped = time.time()
+        elif not stop and self.stopped is not None:
+            self.suspended += time.time() - self.stopped
+            self.stopped = None
+
+    def usage(self):
+        """Resources used by the subprocess and its descendants
+        :return: dictionary of the wall time, cpu time (s), peak memory, bytes read and written, and the time the
+        subprocess was suspended, which is included in the wall time
+        """
+        rusage = self.rusage
+        readbytes, writebytes, readchars, writechars = [sum(values) for values in zip(*self.io.values())] \
+            if self.io else (0, 0, 0, 0)
+        return {'wall': round((self.end if self.end else time.time()) - self.start, 3),
+                'user': round(rusage.ru_utime, 3) if rusage else 0,
+                'system': round(rusage.ru_stime, 3) if rusage else 0,
+                'cpu': round(rusage.ru_utime + rusage.ru_stime, 3) if rusage else 0,
+                # ru_maxrss is the largest single process (in kB), peakrss is the largest sum over the process group
+                'maxrss': max(self.peakprocessrss, rusage.ru_maxrss * 1024 if rusage else 0),
+                'peakrss': self.peakrss,
+                # Block counts of wait4 cover the descendants that exited between samples of /proc
+                'readbytes': max(readbytes, rusage.ru_inblock * 512 if rusage else 0),
+                'writebytes': max(writebytes, rusage.ru_oublock * 512 if rusage else 0),
+                'readchars': readchars,
+                'writechars': writechars,
+                'suspended': round(self.suspended + ((self.end if self.end else time.time()) - self.stopped
+                                                     if self.stopped else 0), 3),
+                'returncode': self.returncode}
+
+    def __init__(self, process, sentinel, command, labels=None, lease=None, outfile=''):
+        from threading import Event
+        self.process = process
+        self.command = command if type(command) is not list else ' '.join(command)
+        self.outfile = outfile
+        self.labels = labels if labels else dict()
+        # Lease the subprocess runs under, and its placement
+        self.lease = lease
+        self.placement = lease.placement() if lease else dict()
+        # Seconds the subprocess spent stopped, and the time it was last stopped if it is stopped
+        self.suspended = 0.0
+        self.stopped = None
+        # Read end of a pipe whose write end is only held by the subprocess and its descendants, and the time the pipe
+        # reached end-of-file
+        self.sentinel = sentinel
+        self.closed = None
+        self.finished = Event()
+        self.returncode = None
+        # Traceback of the monitor thread if it gave up watching the subprocess
+        self.error = None
+        self.start = time.time()
+        self.end = None
+        self.rusage = None
+        self.peakrss = 0
+        self.peakprocessrss = 0
+        self.io = dict()
+        # Resident memory and cpu % at the last sample of the process group, and the time of the sample
+        self.rss = 0
+        self.cpu = 0.0
+        self.sampled = self.start
+        # Whether the process group was killed for exceeding the memory ceiling of its lease
+        self.exceeded = False
+        # Clock ticks of every process, the time and measures of the last progress, and whether the process group was
+        # killed for making no progress within the stall window, with the state of its processes when it was killed
+        self.ticks = dict()
+        self.mark = (self.start, 0, 0, 0)
+        self.stalled = False
+        self.snapshot = []
+
+
+# Numbers of the ioprio_set system call, which Python does not wrap, on each architecture
+ioprioset = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'ppc64': 273, 'ppc64le': 273}
+
+
+def cpumask(cpus):
+    """cpu_set_t of a list of cpus for sched_setaffinity, sized for at least the 1024 cpus of glibc"""
+    import ctypes
+    bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    mask = (ctypes.c_ulong * (max(max(cpus) + 1, 1024) // bits + 1))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    return mask
+
+
+def setaffinity(pids, cpus):
+    """Pin every thread of running processes to a list of cpus"""
+    import ctypes
+    mask = cpumask(cpus)
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            threads = os.listdir('/proc/{}/task'.format(pid))
+        except OSError:
+            # The process has exited
+            continue
+        for thread in threads:
+            libc.sched_setaffinity(int(thread), ctypes.sizeof(mask), mask)
+
+
+def placer(lease):
+    """Prepare the placement of the commands of a job in the subprocess, between fork and exec. ctypes is loaded, and
+    the cpu mask is built, beforehand, so the subprocess only makes system calls
+    :param lease: Lease with the cpus to pin the commands to, their niceness, their I/O priority and their address
+    space limit
+    :return: function that places the process that calls it
+    """
+    import ctypes
+    import platform
+    import resource
+    calls = []
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        libc = None
+    if lease.cpus and hasattr(os, 'sched_setaffinity'):
+        calls.append(lambda: os.sched_setaffinity(0, lease.cpus))
+    elif lease.cpus and libc:
+        mask = cpumask(lease.cpus)
+        calls.append(lambda: libc.sched_setaffinity(0, ctypes.sizeof(mask), mask))
+    if lease.nice:
+        calls.append(lambda: os.nice(lease.nice))
+    if lease.ioprio is not None and libc and platform.machine() in ioprioset:
+        # IOPRIO_WHO_PROCESS 1 of the calling process 0, in IOPRIO_CLASS_BE 2
+        number, priority = ioprioset[platform.machine()], 2 << 13 | lease.ioprio
+        calls.append(lambda: libc.syscall(number, 1, 0, priority))
+    if lease.addressspace:
+        # Only the soft limit is lowered, within the hard limit of the pipeline
+        hard = resource.getrlimit(resource.RLIMIT_AS)[1]
+        limit = lease.addressspace if hard == resource.RLIM_INFINITY else min(lease.addressspace, hard)
+        calls.append(lambda: resource.setrlimit(resource.RLIMIT_AS, (limit, hard)))
+
+    def place():
+        for call in calls:
+            try:
+                call()
+            except (OSError, ValueError, resource.error):
+                # The command still runs, unplaced, e.g. if the cpus are not in the cpuset of the pipeline
+                pass
+    return place
+
+
+class ProcessMonitor(object):
+    """Runs subprocesses with their output sent straight to a file, and waits on every running subprocess from a single
+    thread. The thread blocks in select on a pipe inherited by each subprocess, which reaches end-of-file when the
+    subprocess exits, and samples the subprocesses once per second, sending their CPU and memory use to the progress
+    board. Each subprocess is started in its own process group, so cancelling a subprocess kills its children as well"""
+
+    def start(self, command, outfile="", labels=None, **kwargs):
+        """Start a subprocess
+        :param command: the command to be executed. Split with shlex unless it is a list, or shell=True
+        :param outfile: optional file to append the standard output and standard error of the command to
+        :param labels: optional dictionary added to the records of the command in the log e.g. the name of the sample
+        :return: Child
+        """
+        import fcntl
+        import subprocess
+        if type(command) is not list and "shell" not in kwargs:
+            import shlex
+            command = shlex.split(command)
+        output = open(outfile, 'ab') if outfile else open(os.devnull, 'wb')
+        # Place the subprocess according to the lease held by the calling thread
+        lease = getattr(held, 'lease', None)
+        place = placer(lease) if lease else None
+        # Subprocesses started by other threads must not inherit the pipe of this subprocess, so the pipe is created
+        # and the subprocess is started under the lock, and the pipe is only inherited by this subprocess
+        with self.lock:
+            sentinel, inherited = os.pipe()
+            for fd in sentinel, inherited:
+                fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+            def preexec():
+                # Run the subprocess in a new process group, and keep the write end of the pipe open across exec
+                os.setsid()
+                fcntl.fcntl(inherited, fcntl.F_SETFD, fcntl.fcntl(inherited, fcntl.F_GETFD) & ~fcntl.FD_CLOEXEC)
+                if place:
+                    place()
+            try:
+                process = subprocess.Popen(command, stdout=output, stderr=STDOUT, preexec_fn=preexec, **kwargs)
+            except OSError:
+                os.close(sentinel)
+                raise
+            finally:
+                os.close(inherited)
+                output.close()
+            child = Child(process, sentinel, command, labels, lease, outfile)
+            self.children.append(child)
+            if lease and lease.suspended:
+                # The job was suspended before it started this command
+                child.pause(True)
+            self.watch()
+        self.log(child, 'start')
+        return child
+
+    def pause(self, lease, stop, cpus=None):
+        """Stop or continue the subprocesses running under a lease
+        :param lease: Lease of the subprocesses
+        :param stop: True to stop the subprocesses, False to continue them
+        :param cpus: optional list of cpus to pin the subprocesses to before they are continued
+        """
+        with self.lock:
+            lease.suspended = stop
+            children = [child for child in self.children if child.lease is lease]
+            groups = proctree() if cpus and children else dict()
+            for child in children:
+                if cpus:
+                    setaffinity(groups.get(child.process.pid, []), cpus)
+                child.pause(stop)
+        for child in children:
+            self.log(child, 'suspend' if stop else 'resume')
+
+    def running(self, lease):
+        """True if subprocesses are running under a lease, and would be stopped by pausing it"""
+        with self.lock:
+            return any(child.lease is lease for child in self.children)
+
+    def watch(self):
+        """Start the monitor thread if it is not running, or wake it up to watch a new subprocess"""
+        from threading import Thread
+        if self.thread is None:
+            self.thread = Thread(target=self.monitor)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        else:
+            os.write(self.wakeup[1], b'.')
 
+    def monitor(self):
+        """Wait for the subprocesses to exit, and send the resources they use to the progress board every second while
+        any are running. An error in a pass of the thread is reported, and the subprocesses are watched again. After
+        too many errors in a row, the subprocesses are killed and every wait on them ends with a MonitorError"""
+        from progress import board
+        import traceback
+        lastsample, errors = time.time(), 0
+        while True:
+            try:
+                running, lastsample = self.poll(lastsample)
+                errors = 0
+            except Exception:
+                errors += 1
+                error = traceback.format_exc()
+                board.message('The process monitor failed ({} of {} errors in a row):\n{}'.format(errors, self.errors,
+                                                                                                  error))
+                if errors >= self.errors:
+                    self.abandon(error)
+                    return
+                time.sleep(1)
+                continue
+            if not running:
+                return
 
-def execute(command, outfile="", **kwargs):
+    def poll(self, lastsample):
+        """A single pass of the monitor thread: reap the subprocesses that exited, and sample the running subprocesses
+        if a second has passed since they were last sampled
+        :param lastsample: time the subprocesses were last sampled
+        :return: False once no subprocesses are left, and the time the subprocesses were last sampled
+        """
+        from progress import board
+        import select
+        with self.lock:
+            if not self.children:
+                # Exit once idle. The thread is started again with the next subprocess
+                self.thread = None
+                board.usage([])
+                return False, lastsample
+            sentinels = [child.sentinel for child in self.children if child.sentinel is not None]
+            # A subprocess usually cannot be reaped yet when its pipe reaches end-of-file, as it is still exiting,
+            # so it is polled every 10 ms for a second after. Subprocesses that closed the pipe without exiting
+            # are then checked every second
+            closing = any(child.sentinel is None and time.time() - child.closed < 1 for child in self.children)
+        # Block until a subprocess exits, or a second has passed to sample the subprocesses
+        readable = select.select(sentinels + [self.wakeup[0]], [], [], 0.01 if closing else 1)[0]
+        if self.wakeup[0] in readable:
+            os.read(self.wakeup[0], 1024)
+        with self.lock:
+            for child in list(self.children):
+                if child.sentinel in readable and not os.read(child.sentinel, 1024):
+                    # End-of-file: stop selecting on the pipe
+                    os.close(child.sentinel)
+                    child.sentinel = None
+                    child.closed = time.time()
+                # Reap the subprocess with its resource usage, which includes the descendants it waited for
+                try:
+                    pid, status, rusage = os.wait4(child.process.pid, os.WNOHANG)
+                except OSError as exception:
+                    if exception.errno != errno.ECHILD:
+                        raise
+                    # The subprocess was reaped elsewhere, so its exit status and resource usage are unknown
+                    pid, status, rusage = child.process.pid, None, None
+                if pid:
+                    if child.sentinel is not None:
+                        os.close(child.sentinel)
+                        child.sentinel = None
+                    child.reap(status, rusage)
+                    self.children.remove(child)
+                    child.finished.set()
+            children = list(self.children)
+        if time.time() - lastsample >= 1:
+            lastsample = time.time()
+            # Sample the memory and input/output of the process group of every running subprocess
+            groups = proctree()
+            for child in children:
+                child.sample(groups.get(child.process.pid, []))
+                if child.lease and child.lease.ceiling and child.peakrss > child.lease.ceiling and \
+                        not child.exceeded:
+                    self.exceed(child)
+                if self.stall and not child.stalled and self.idle(child):
+                    # The snapshot may wait for Java processes to print their threads, so it is taken in its own
+                    # thread while the other subprocesses are watched
+                    from threading import Thread
+                    child.stalled = True
+                    unstick = Thread(target=self.unstick, args=(child, groups.get(child.process.pid, [])))
+                    unstick.setDaemon(True)
+                    unstick.start()
+            # The cores of a lease shared by several subprocesses are counted once
+            leases = set()
+            commands = []
+            for child in children:
+                commands.append((child.labels.get('sample', child.labels.get('key', '')), child.cpu, child.rss,
+                                 child.lease.cores if child.lease and id(child.lease) not in leases else 0))
+                leases.add(id(child.lease))
+            board.usage(commands)
+        return True, lastsample
+
+    def abandon(self, error):
+        """Kill the process groups of every subprocess once the monitor thread can no longer watch them, and end every
+        wait on them with the error, so the stages fail rather than wait forever
+        :param error: formatted traceback of the last error of the monitor thread
+        """
+        import signal
+        with self.lock:
+            children, self.children = self.children, []
+            self.thread = None
+        for child in children:
+            try:
+                os.killpg(child.process.pid, signal.SIGKILL)
+            except OSError:
+                # The process group has exited
+                pass
+            if child.sentinel is not None:
+                os.close(child.sentinel)
+                child.sentinel = None
+            child.error = error
+            child.end = time.time()
+            child.finished.set()
+
+    def idle(self, child):
+        """Find whether a subprocess made no progress within the stall window. A subprocess progresses while it reads,
+        writes or its output file grows, or while it uses more than 1% of a core over the window, which tells a busy
+        process from e.g. the timers of an idle JVM. Stopped subprocesses are not idle"""
+        now = time.time()
+        ticks, characters, size = child.progress()
+        marked, markticks, markcharacters, marksize = child.mark
+        if child.stopped is not None or characters != markcharacters or size != marksize or \
+                ticks - markticks >= self.stall / 100.0 * os.sysconf('SC_CLK_TCK'):
+            child.mark = (now, ticks, characters, size)
+            return False
+        return now - marked > self.stall
+
+    def unstick(self, child, pids):
+        """Record the state of the processes of a stalled subprocess, then kill its process group. Java processes are
+        sent SIGQUIT first, which prints the stacks of their threads to the output file of the command"""
+        import signal
+        child.snapshot = [processsnapshot(pid) for pid in pids]
+        java = [process['pid'] for process in child.snapshot if process['name'] == 'java']
+        for pid in java:
+            try:
+                os.kill(pid, signal.SIGQUIT)
+            except OSError:
+                pass
+        if java:
+            time.sleep(2)
+        self.log(child, 'stall')
+        try:
+            os.killpg(child.process.pid, signal.SIGKILL)
+        except OSError:
+            # The process group has exited
+            pass
+
+    def exceed(self, child):
+        """Kill the process group of a subprocess that exceeded the memory ceiling of its lease, before it crowds out
+        the other jobs of the host"""
+        import signal
+        child.exceeded = True
+        try:
+            os.killpg(child.process.pid, signal.SIGKILL)
+        except OSError:
+            # The process group has exited
+            pass
+        self.log(child, 'ceiling')
+
+    def wait(self, child):
+        """Block until a subprocess exits
+        :return: the exit code of the subprocess
+        """
+        child.finished.wait()
+        self.log(child, 'finish')
+        if child.error:
+            raise MonitorError('{} was killed, as the process monitor failed:\n{}'.format(child.command, child.error))
+        return child.returncode
+
+    def log(self, child, event):
+        """Append the launch, or the resource usage of a subprocess to the run-level log of commands"""
+        import json
+        if self.logfile:
+            record = {'event': event, 'time': time.time(), 'command': child.command, 'pid': child.process.pid}
+            if event == 'finish':
+                record.update(child.usage())
+            elif event == 'start' and child.placement:
+                record['placement'] = child.placement
+            elif event == 'ceiling':
+                record.update(peakrss=child.peakrss, ceiling=child.lease.ceiling)
+            elif event == 'stall':
+                record.update(window=self.stall, snapshot=child.snapshot)
+            record.update(child.labels)
+            with self.loglock:
+                with open(self.logfile, 'ab') as log:
+                    log.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def terminate(self, child, grace=10):
+        """Kill the process group of a subprocess, first with SIGTERM, then with SIGKILL after the grace period"""
+        import signal
+        for sig in signal.SIGTERM, signal.SIGKILL:
+            try:
+                os.killpg(child.process.pid, sig)
+                # A stopped process group only handles SIGTERM once it is continued
+                os.killpg(child.process.pid, signal.SIGCONT)
+            except OSError:
+                # The process group has exited
+                pass
+            if child.finished.wait(grace):
+                break
+        return child.returncode
+
+    def cancel(self, grace=10):
+        """Kill the process groups of every running subprocess"""
+        with self.lock:
+            children = list(self.children)
+        for child in children:
+            self.terminate(child, grace)
+
+    def __init__(self):
+        from threading import Lock
+        self.lock = Lock()
+        self.children = []
+        self.thread = None
+        # Pipe to wake the monitor thread when a subprocess is started
+        self.wakeup = os.pipe()
+        # Optional JSON lines file recording every command launched, and the resources it used
+        self.logfile = ''
+        self.loglock = Lock()
+        # Seconds a subprocess may make no progress before it is killed. 0 disables the watchdog
+        self.stall = 0
+        # Errors in a row after which the monitor thread gives up on the subprocesses
+        self.errors = 10
+
+
+class StalledError(Exception):
+    """Raised when a command made no progress within the stall window of the ProcessMonitor, and was killed"""
+    pass
+
+
+class MonitorError(Exception):
+    """Raised when the ProcessMonitor could no longer watch a command, and killed it"""
+    pass
+
+
+# Single monitor for every subprocess of the pipeline
+monitor = ProcessMonitor()
+# Lock for the performance sections of the metadata, which are written by the stages of a sample at the same time
+accountlock = Lock()
+
+
+def execute(command, outfile="", sample=None, key="", **kwargs):
     """
-    Allows for dots to be printed to the terminal while waiting for a long system call to run
+    Run a command under the ProcessMonitor and wait for it to finish
     :param command: the command to be executed
-    :param outfile: optional string of an output file
-    from https://stackoverflow.com/questions/4417546/constantly-print-subprocess-output-while-process-is-running
+    :param outfile: optional string of an output file to append the standard output and error of the command to
+    :param sample: optional sample metadata object to add the resources used by the command to
+    :param key: name of the command in the performance and placement sections of the sample e.g. 'spades'
+    :return: the exit code of the command. StalledError is raised if the command was killed for making no progress
     """
-    import sys
-    import time
-    # Initialise count
-    count = 0
-    # Initialise the starting time
-    start = int(time.time())
-    maxtime = 0
-    # Removing Shell=True to prevent excess memory use thus shlex split if needed
-    if type(command) is not list and "shell" not in kwargs:
-        import shlex
-        command = shlex.split(command)
-    # Run the commands - direct stdout to PIPE and stderr to stdout
-    # DO NOT USE subprocess.PIPE if not writing it!
-    if outfile:
-        process = Popen(command, stdout=PIPE, stderr=STDOUT, **kwargs)
-    else:
-        devnull = open(os.devnull, 'wb')
-        process = Popen(command, stdout=devnull, stderr=STDOUT, **kwargs)
-    # Write the initial time
-    sys.stdout.write('[{:}] '.format(time.strftime('%H:%M:%S')))
-    # Create the output file - if not provided, then nothing should happen
-    writeout = open(outfile, "ab+") if outfile else ""
-    # Poll process for new output until finished
-    while True:
-        # If an output file name is provided
-        if outfile:
-            # Get stdout into a variable
-            nextline = process.stdout.readline()
-            # Print stdout to the file
-            writeout.write(nextline)
-        # Break from the loop if the command is finished
-        if process.poll() is not None:
-            break
-        # Adding sleep commands slowed down this method when there was lots of output. Difference between the start time
-        # of the analysis and the current time. Action on each second passed
-        currenttime = int(time.time())
-        if currenttime - start > maxtime:
-            # Set the max time for each iteration
-            maxtime = currenttime - start
-            # Print up to 80 dots on a line, with a one second delay between each dot
-            if count <= 80:
-                sys.stdout.write('.')
-                count += 1
-            # Once there are 80 dots on a line, start a new line with the the time
-            else:
-                sys.stdout.write('\n[{:}] .'.format(time.strftime('%H:%M:%S')))
-                count = 1
-    # Close the output file
-    writeout.close() if outfile else ""
-    sys.stdout.write('\n')
+    child = monitor.start(command, outfile, labels=dict(sample=sample.name, key=key) if sample else dict(key=key),
+                          **kwargs)
+    returncode = monitor.wait(child)
+    # Count the commands of the stage run by the thread, and the time they spent suspended
+    held.commands = getattr(held, 'commands', 0) + 1
+    held.paused = getattr(held, 'paused', 0) + child.usage()['suspended']
+    if sample:
+        account(sample, key, child.usage())
+        if child.placement:
+            setattr(sample.placement, key, child.placement)
+    if child.stalled:
+        raise StalledError('{} made no progress for {:g} minutes, and was killed'
+                           .format(child.command, monitor.stall / 60.0))
+    return returncode
+
+
+def account(sample, key, usage):
+    """Add the resources used by a command to the performance section of the metadata of a sample. The resources of
+    commands run under the same key are added together, with the peak memory being the largest of the commands"""
+    with accountlock:
+        previous = dict(sample.performance).get(key)
+        if isinstance(previous, dict):
+            usage = dict((field, max(value, previous.get(field, 0)) if field in ('maxrss', 'peakrss')
+                          else value or previous.get(field, 0) if field == 'returncode'
+                          else round(value + previous.get(field, 0), 3) if isinstance(value, float)
+                          else value + previous.get(field, 0)) for field, value in usage.items())
+            usage['commands'] = previous.get('commands', 1) + 1
+        else:
+            usage['commands'] = 1
+        setattr(sample.performance, key, usage)
 
 
 def filer(filelist, extension='fastq'):
@@ -155,7 +720,6 @@ def filer(filelist, extension='fastq'):
         # .fastq is the last option
         else:
             fileset.add(re.split(".{}".format(extension), seqfile)[0])
-        dotter()
     return fileset
 
 
@@ -236,6 +800,748 @@ class MetadataObject(object):
                         print attr, value
 
 
+def loadmetadata(jsondata, metadata=None):
+    """Create a sample metadata object from the dictionary of a metadata object, as written to JSON
+    :param jsondata: dictionary of the categories of the sample
+    :param metadata: optional metadata object to update rather than creating a new object
+    :return: the metadata object
+    """
+    metadata = metadata if metadata else MetadataObject()
+    # Initialise the metadata categories as GenObjects created using the appropriate key
+    for attr in jsondata:
+        if not isinstance(jsondata[attr], dict):
+            setattr(metadata, attr, jsondata[attr])
+        else:
+            setattr(metadata, attr, GenObject(jsondata[attr]))
+    return metadata
+
+
+# Placement of the commands of each kind of job: (pinned to cpus of their own, niceness, best-effort I/O priority from
+# 0 to 7 or None to keep the default). Assemblies are pinned to disjoint cpus on as few NUMA nodes as possible, while
+# the quality control stages, which mostly stream reads from and to disk, run at a lower CPU and I/O priority so they
+# yield to the assemblies. Other jobs run unchanged
+priorities = {'spades': (True, 0, None), 'fastqc': (False, 10, 7), 'trim': (False, 10, 7), 'qualimap': (False, 10, 7)}
+# Memory ceilings of each kind of job, as multiples of the memory reserved for the job: (resident memory of its process
+# group, address space of each of its processes). A job that exceeds its resident ceiling is killed rather than left to
+# crowd out the other jobs, and the address space limit makes runaway allocations fail within the process. Only jobs
+# whose memory is predicted are limited, as e.g. Java tools map far more address space than they use
+ceilings = {'spades': (1.25, 2)}
+# Address space each process of a limited job may always map beyond the memory reserved for the job. Allocators such as
+# the jemalloc of SPAdes reserve far more address space than they keep resident, in an arena for each thread, so small
+# reservations would otherwise fail their allocations. The resident ceiling still holds the job to its reservation
+addressfloor = 8 * 1024 ** 3
+# Priority classes of samples, from the most urgent. Jobs of more urgent samples are admitted first, and may suspend
+# the preemptible jobs of less urgent samples to free their cores and memory
+priorityclasses = ['urgent', 'routine', 'low']
+# Kinds of long jobs that may be suspended. Short jobs such as FastQC are left to finish. Only the subprocesses of a job
+# are stopped, so a job is only suspended while it runs a subprocess under the ProcessMonitor
+preemptible = ('spades', 'busco', 'its')
+# Lease held by each thread, which places the commands the thread runs while it holds the lease, the priority of the
+# sample whose stage the thread runs, and the time the stage spent waiting for leases or suspended
+held = local()
+
+
+def samplepriority(sample, urgent=()):
+    """Priority class of a sample
+    :param sample: sample metadata object
+    :param urgent: names of the samples that are urgent e.g. from the command line
+    :return: 'urgent' if the sample is listed, otherwise the Priority column of the sample sheet, or 'routine'
+    """
+    if sample.name in urgent:
+        return 'urgent'
+    # The run section is only read if it exists, as reading a missing section of a MetadataObject creates it
+    run = sample.datastore.get('run')
+    value = str(dict(run).get('Priority', '')).lower() if isinstance(run, GenObject) else ''
+    return value if value in priorityclasses else 'routine'
+
+
+def rank(sample):
+    """Rank of the priority class of a sample, from 0 for the most urgent"""
+    value = dict(sample.general).get('priority') if isinstance(sample.datastore.get('general'), GenObject) else None
+    return priorityclasses.index(value if value in priorityclasses else 'routine')
+
+
+@contextmanager
+def priority(sample, order=0):
+    """Context manager to lease the jobs of the calling thread at the priority of a sample
+    :param sample: sample metadata object
+    :param order: key that orders the waiting jobs of the same kind of samples of the same priority e.g. the predicted
+    runtime of the sample, so the shortest are granted first
+    """
+    previous = getattr(held, 'priority', None), getattr(held, 'order', 0)
+    held.priority, held.order = rank(sample), order
+    try:
+        yield
+    finally:
+        held.priority, held.order = previous
+
+
+@contextmanager
+def stagetimer(sample, stage):
+    """Context manager to record the runtime of a stage of a sample in the runtime section of its metadata, with the
+    largest number of cores leased by the stage. The time spent waiting for leases, or with commands suspended, is left
+    out. Stages that ran no commands and computed no outputs, e.g. were restored from the cache, are not recorded. Tools
+    run within the pipeline rather than as commands are counted by the outputs they computed through the StageCache"""
+    held.paused, held.commands, held.cores, held.computed = 0.0, 0, 0, 0
+    start = time.time()
+    yield
+    if held.commands or held.computed:
+        setattr(sample.runtime, stage, {'seconds': round(time.time() - start - held.paused, 3), 'cores': held.cores})
+
+
+class Lease(object):
+    """Cores and memory granted to a single job by the ResourceAllocator, and the placement of its commands"""
+
+    def placement(self):
+        """Record of the placement of the commands of the job, for the metadata of the sample
+        :return: dictionary of the pinned cpus and their NUMA nodes, the niceness, the I/O priority and the memory
+        ceiling. Empty if the commands run unchanged
+        """
+        record = dict()
+        if self.cpus:
+            record['cpus'] = cpuranges(self.cpus)
+            record['nodes'] = self.nodes
+        if self.nice:
+            record['nice'] = self.nice
+        if self.ioprio is not None:
+            record['ionice'] = 'best-effort {}'.format(self.ioprio)
+        if self.ceiling:
+            record['ceiling'] = '{:.1f}G'.format(self.ceiling / 1024.0 ** 3)
+        return record
+
+    def __init__(self, name, cores, memory, token=None, cpus=None, nodes=None, nice=0, ioprio=None, priority=1):
+        self.name = name
+        self.cores = cores
+        self.memory = memory
+        # Token of the lease of the same cores and memory from the HostBroker, if the host is shared
+        self.token = token
+        # Cpus the commands of the job are pinned to, and their NUMA nodes. Empty if the commands are not pinned
+        self.cpus = cpus if cpus else []
+        self.nodes = nodes if nodes else []
+        self.nice = nice
+        self.ioprio = ioprio
+        # Bytes of resident memory the process group of each command may use, and of address space each process may
+        # map. 0 if unlimited
+        resident, address = ceilings.get(name, (0, 0)) if memory else (0, 0)
+        self.ceiling = int(memory * resident)
+        self.addressspace = max(int(memory * address), int(memory) + addressfloor) if address else 0
+        # Rank of the priority class of the sample, and whether the commands of the job are stopped to make room for a
+        # more urgent job
+        self.priority = priority
+        self.suspended = False
+        self.started = time.time()
+
+
+class ResourceAllocator(object):
+    """Central budget of cores and memory shared by the subprocesses of every stage. Jobs are admitted once their
+    minimum number of cores and their memory fit in what is free, and the number of threads of each job is computed
+    from the free cores divided by the jobs of the same kind still to be run. The last remaining jobs of a stage are
+    therefore handed the cores freed by the jobs that have finished. Jobs of more urgent samples are admitted first, and
+    suspend the preemptible jobs of less urgent samples if they do not fit"""
+
+    def demand(self, name, count):
+        """Register the number of jobs of a kind that are waiting to be started
+        :param name: name of the kind of job e.g. 'spades'
+        :param count: number of jobs to add (or remove once started if negative) to the number of waiting jobs
+        """
+        with self.condition:
+            self.expected[name] = max(0, self.expected.get(name, 0) + count)
+            self.condition.notify_all()
+
+    def grant(self, name, mincores, maxcores, memory, waiting):
+        """Find the number of cores to grant to a job, or 0 if the job does not fit in the free resources
+        :param waiting: (priority, order, name) of the job
+        """
+        priority, order, _ = waiting
+        mincores = min(mincores, self.cores)
+        # Jobs requesting more memory than the total budget are run on their own
+        memory = min(memory, self.memory) if self.memory else 0
+        if self.freecores < mincores or (self.memory and self.freememory < memory):
+            return 0
+        # Waiting jobs of more urgent samples, and suspended jobs of samples as urgent, are admitted first, then the
+        # waiting jobs of the same kind in order e.g. of the shortest sample first
+        if any(x[0] < priority or (x[0] == priority and x[2] == name and x[1] < order) for x in self.waiting) or \
+                any(x.priority <= priority for x in self.suspended):
+            return 0
+        # Share the free cores between this job and the waiting jobs of the same kind
+        share = 1 + self.expected.get(name, 0)
+        return max(mincores, min(maxcores, self.freecores // share))
+
+    def acquire(self, name, mincores=1, maxcores=None, memory=0):
+        """Block until the job fits in the budget
+        :param name: name of the kind of job e.g. 'spades'
+        :param mincores: minimum number of cores the job requires
+        :param maxcores: maximum number of cores the job can use. Defaults to every core
+        :param memory: bytes of memory to reserve for the job
+        :return: Lease with the number of cores and memory granted
+        """
+        maxcores = maxcores if maxcores else self.cores
+        pin, nice, ioprio = priorities.get(name, (False, 0, None)) if self.placement else (False, 0, None)
+        # The priority of the sample whose stage the thread is running
+        priority = getattr(held, 'priority', None)
+        priority = priorityclasses.index('routine') if priority is None else priority
+        waiting, started = (priority, getattr(held, 'order', 0), name), time.time()
+        with self.condition:
+            self.waiting.append(waiting)
+            try:
+                cores, token, cpus = self.grant(name, mincores, maxcores, memory, waiting), None, []
+                while True:
+                    if not cores and self.preempt(mincores, memory, priority):
+                        cores = self.grant(name, mincores, maxcores, memory, waiting)
+                    if cores and self.broker:
+                        # Lease the cores from the host as well, which grants fewer cores while other runs share the
+                        # host. The broker places pinned jobs, as it knows the cpus pinned by every run
+                        token, cores, cpus = self.broker.acquire(name, min(mincores, cores), cores, memory, pin)
+                    if cores:
+                        break
+                    # Other pipelines cannot notify the condition when they release a lease, so the host is polled.
+                    # Preemptible jobs of less urgent samples that run no subprocess yet cannot be suspended, and are
+                    # polled until they start one
+                    idle = any(lease.priority > priority and lease.name in preemptible and not lease.suspended
+                               for lease in self.running)
+                    self.condition.wait(self.interval if self.broker or idle else None)
+                    cores = self.grant(name, mincores, maxcores, memory, waiting)
+            finally:
+                self.waiting.remove(waiting)
+            held.paused = getattr(held, 'paused', 0) + time.time() - started
+            held.cores = max(getattr(held, 'cores', 0), cores)
+            memory = min(memory, self.memory) if self.memory else memory
+            if pin and not self.broker:
+                # The job runs unpinned if too few cpus are free e.g. more threads than cpus were requested
+                cpus = placecores(self.freecpus, cores, self.nodes)
+                self.freecpus.difference_update(cpus)
+            self.freecores -= cores
+            self.freememory -= memory
+            self.jobs += 1
+            self.record()
+            lease = Lease(name, cores, memory, token, cpus, sorted(set(self.nodes.get(cpu, 0) for cpu in cpus)), nice,
+                          ioprio, priority)
+            self.running.append(lease)
+            return lease
+
+    def release(self, lease):
+        """Return the cores and memory of a finished job to the budget"""
+        with self.condition:
+            self.running.remove(lease)
+            if lease.suspended:
+                # The cores and memory of a suspended job were returned when it was suspended
+                self.suspended.remove(lease)
+                lease.suspended = False
+            else:
+                self.freecores += lease.cores
+                self.freememory += lease.memory
+                if not lease.token:
+                    self.freecpus.update(lease.cpus)
+            if lease.token:
+                self.broker.release(lease.token)
+            self.jobs -= 1
+            self.resume()
+            self.record()
+            self.condition.notify_all()
+
+    def preempt(self, mincores, memory, priority):
+        """Suspend the running preemptible jobs of less urgent samples, the least urgent and most recent first, until a
+        job fits in the budget
+        :return: True if jobs were suspended
+        """
+        mincores = min(mincores, self.cores)
+        memory = min(memory, self.memory) if self.memory else 0
+        victims = sorted([lease for lease in self.running if lease.priority > priority and not lease.suspended and
+                          lease.name in preemptible and monitor.running(lease)],
+                         key=lambda x: (-x.priority, -x.started))
+        freecores, freememory, chosen = self.freecores, self.freememory, []
+        for lease in victims:
+            if freecores >= mincores and (not self.memory or freememory >= memory):
+                break
+            chosen.append(lease)
+            freecores += lease.cores
+            freememory += lease.memory
+        # Nothing is suspended unless it lets the job start
+        if not chosen or freecores < mincores or (self.memory and freememory < memory):
+            return False
+        for lease in chosen:
+            self.suspended.append(lease)
+            self.freecores += lease.cores
+            self.freememory += lease.memory
+            if lease.token:
+                self.broker.suspend(lease.token)
+            else:
+                self.freecpus.update(lease.cpus)
+            monitor.pause(lease, True)
+        self.record()
+        if self.broker and not self.resumer:
+            # Other runs cannot notify the condition when they release a lease, so the host is polled to resume
+            from threading import Thread
+            self.resumer = Thread(target=self.poll)
+            self.resumer.setDaemon(True)
+            self.resumer.start()
+        return True
+
+    def resume(self):
+        """Continue the suspended jobs, the most urgent and oldest first, once their cores and memory are free again and
+        no more urgent job is waiting. Jobs whose cpus were given to other jobs are pinned to free cpus"""
+        for lease in sorted(self.suspended, key=lambda x: (x.priority, x.started)):
+            if any(x[0] < lease.priority for x in self.waiting) or self.freecores < lease.cores or \
+                    (self.memory and self.freememory < lease.memory):
+                break
+            cpus = lease.cpus
+            if self.broker:
+                resumed, cpus = self.broker.resume(lease.token, bool(lease.cpus))
+                if not resumed:
+                    break
+            elif lease.cpus:
+                cpus = lease.cpus if self.freecpus.issuperset(lease.cpus) \
+                    else placecores(self.freecpus, len(lease.cpus), self.nodes)
+                self.freecpus.difference_update(cpus)
+            self.suspended.remove(lease)
+            self.freecores -= lease.cores
+            self.freememory -= lease.memory
+            # A job that cannot be pinned again runs on every cpu of the pipeline
+            repin = (cpus if cpus else self.cpus) if cpus != lease.cpus else None
+            lease.cpus, lease.nodes = cpus, sorted(set(self.nodes.get(cpu, 0) for cpu in cpus))
+            monitor.pause(lease, False, repin)
+            self.record()
+
+    def poll(self):
+        """Try to resume the suspended jobs until every suspended job is resumed"""
+        with self.condition:
+            while self.suspended:
+                self.condition.wait(self.interval)
+                self.resume()
+            self.resumer = None
+
+    def record(self):
+        """Record the cores, memory and jobs in use, to show how busy the budget was over time"""
+        self.history.append((time.time(), self.cores - self.freecores, self.memory - self.freememory, self.jobs))
+
+    @contextmanager
+    def lease(self, name, mincores=1, maxcores=None, memory=0):
+        """Context manager to acquire resources for a job, and release them once the job is finished. The commands run
+        by the thread while it holds the lease are placed according to the lease"""
+        lease = self.acquire(name, mincores, maxcores, memory)
+        previous, held.lease = getattr(held, 'lease', None), lease
+        try:
+            yield lease
+        finally:
+            held.lease = previous
+            self.release(lease)
+
+    def __init__(self, cores, memory=0, broker=None, interval=2, placement=True):
+        """
+        :param cores: total number of cores that can be used by the pipeline
+        :param memory: total bytes of memory that can be used by the pipeline. 0 disables the memory budget
+        :param broker: optional HostBroker to lease every job from as well, when the host is shared with other runs
+        :param interval: seconds between attempts to lease a waiting job from the broker
+        :param placement: False to run every command unpinned at the default priorities
+        """
+        from threading import Condition
+        self.cores = max(1, int(cores))
+        self.memory = int(memory)
+        self.freecores = self.cores
+        self.freememory = self.memory
+        self.expected = dict()
+        self.condition = Condition()
+        # Number of jobs holding a lease, and the (time, cores, memory, jobs) in use after every change
+        self.jobs = 0
+        self.history = []
+        self.broker = broker
+        self.interval = interval
+        # Free cpus to pin jobs to, and the NUMA node of each cpu
+        self.placement = placement
+        self.cpus = allowedcpus()
+        self.freecpus = set(self.cpus) if placement else set()
+        self.nodes = numanodes() if placement else dict()
+        # Leases held by running jobs, the leases of the jobs that are suspended, and the priorities of waiting jobs
+        self.running = []
+        self.suspended = []
+        self.waiting = []
+        # Thread polling the broker to resume suspended jobs
+        self.resumer = None
+
+
+class CancelledError(Exception):
+    """Raised when the result of a cancelled job is requested"""
+    pass
+
+
+class Future(object):
+    """Result of a job submitted to a WorkerPool"""
+    pending, running, finished, cancelled = 'pending', 'running', 'finished', 'cancelled'
+
+    def cancel(self):
+        """Cancel the job if it has not started
+        :return: True if the job was cancelled
+        """
+        with self.condition:
+            if self.state == self.pending:
+                self.state = self.cancelled
+                self.condition.notify_all()
+            return self.state == self.cancelled
+
+    def start(self):
+        """Mark the job as running, unless it was cancelled
+        :return: False if the job was cancelled
+        """
+        with self.condition:
+            if self.state == self.cancelled:
+                return False
+            self.state = self.running
+            return True
+
+    def finish(self, result=None, error=None):
+        """Store the result, or the (type, value, traceback) of the exception raised by the job"""
+        with self.condition:
+            self.value, self.error = result, error
+            self.state = self.finished
+            self.condition.notify_all()
+
+    def done(self):
+        return self.state in (self.finished, self.cancelled)
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish or be cancelled
+        :return: True if the job is done
+        """
+        with self.condition:
+            if not self.done():
+                self.condition.wait(timeout)
+            return self.done()
+
+    def exception(self, timeout=None):
+        """Exception raised by the job, or None"""
+        if not self.wait(timeout):
+            raise RuntimeError('Job did not finish within {} seconds'.format(timeout))
+        if self.state == self.cancelled:
+            raise CancelledError()
+        return self.error[1] if self.error else None
+
+    def result(self, timeout=None):
+        """Wait for the result of the job. Exceptions raised by the job are raised again with their traceback"""
+        if self.exception(timeout):
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+    def __init__(self):
+        from threading import Condition
+        self.condition = Condition()
+        self.state = self.pending
+        self.value = None
+        self.error = None
+
+
+def _remote(function, args, kwargs):
+    """Run a job in a process of a WorkerPool. Exceptions are returned with their formatted traceback, as traceback
+    objects cannot be sent between processes"""
+    import traceback
+    try:
+        return True, function(*args, **kwargs)
+    except Exception as exception:
+        return False, (exception, traceback.format_exc())
+
+
+class WorkerPool(object):
+    """Bounded pool of workers that run submitted jobs and return a Future for each job. Workers are threads by default,
+    which suits jobs that wait on subprocesses. With processes=True, each job is run in a pool of processes instead, so
+    the function and its arguments must be picklable. Workers exit once the pool is shut down"""
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a job
+        :return: Future of the job
+        """
+        from threading import Thread
+        future = Future()
+        with self.lock:
+            assert not self.closed, 'Cannot submit jobs to a pool that was shut down'
+            self.futures.append(future)
+            # Start another worker, up to the size of the pool, if every worker is busy
+            if len(self.threads) < self.workers and self.idle == 0:
+                thread = Thread(target=self.worker)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+            else:
+                self.idle -= 1
+        self.queue.put((future, function, args, kwargs))
+        return future
+
+    def worker(self):
+        """Run jobs from the queue until the pool is shut down"""
+        import sys
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            future, function, args, kwargs = job
+            if future.start():
+                if self.processes:
+                    success, value = self.processes.apply(_remote, (function, args, kwargs))
+                    if success:
+                        future.finish(value)
+                    else:
+                        exception, remotetraceback = value
+                        # Keep the traceback of the process with the exception
+                        exception.remotetraceback = remotetraceback
+                        future.finish(error=(type(exception), exception, None))
+                else:
+                    try:
+                        future.finish(function(*args, **kwargs))
+                    except Exception:
+                        future.finish(error=sys.exc_info())
+            with self.lock:
+                self.idle += 1
+
+    def map(self, function, iterable):
+        """Run the function on every item, and wait for every job to finish
+        :return: list of results in the order of the items. The first exception raised by a job is raised once every job
+        is finished
+        """
+        futures = [self.submit(function, item) for item in iterable]
+        for future in futures:
+            future.wait()
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop accepting jobs, and stop the workers once the queued jobs are finished
+        :param wait: wait for the workers to exit
+        :param cancel: cancel the jobs that have not started
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            threads = list(self.threads)
+        if cancel:
+            for future in self.futures:
+                future.cancel()
+        for _ in threads:
+            self.queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+        if self.processes:
+            self.processes.close()
+            if wait:
+                self.processes.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Cancel the queued jobs if the block raised an exception
+        self.shutdown(cancel=exc_type is not None)
+
+    def __init__(self, workers=None, processes=False):
+        """
+        :param workers: maximum number of jobs to run at once. Defaults to the number of cores available to the pipeline
+        :param processes: True to run the jobs in processes rather than threads
+        """
+        from threading import Lock
+        from Queue import Queue
+        self.workers = max(1, int(workers if workers else availablecpus()))
+        self.queue = Queue()
+        self.lock = Lock()
+        self.threads = []
+        self.futures = []
+        self.idle = 0
+        self.closed = False
+        if processes:
+            from multiprocessing import Pool
+            self.processes = Pool(self.workers)
+        else:
+            self.processes = None
+
+
+def totalmemory():
+    """Total physical memory of the system in bytes"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return 0
+
+
+def readfirstline(filename):
+    """First line of a file with the whitespace stripped, or None if the file cannot be read"""
+    try:
+        with open(filename) as text:
+            return text.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cpuids(text):
+    """Cpus in a list of ranges such as 0-3,8,10-11"""
+    cpus = []
+    for item in text.split(','):
+        if '-' in item:
+            first, last = item.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        elif item.strip():
+            cpus.append(int(item))
+    return cpus
+
+
+def cpulist(text):
+    """Number of cpus in a list of ranges such as 0-3,8,10-11"""
+    return len(cpuids(text))
+
+
+def cpuranges(cpus):
+    """List of ranges such as 0-3,8,10-11 of a list of cpus"""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def allowedcpus():
+    """Cpus the pipeline may be scheduled on, which reflects its affinity and the cpuset of its cgroup"""
+    status = procfields('self', 'status')
+    return cpuids(status['Cpus_allowed_list']) if 'Cpus_allowed_list' in status else []
+
+
+def numanodes():
+    """NUMA node of each cpu of the host
+    :return: dictionary of cpu: node. Empty if the host does not report its NUMA nodes
+    """
+    from glob import glob
+    nodes = dict()
+    for folder in glob('/sys/devices/system/node/node[0-9]*'):
+        value = readfirstline(os.path.join(folder, 'cpulist'))
+        if value:
+            for cpu in cpuids(value):
+                nodes[cpu] = int(os.path.basename(folder)[len('node'):])
+    return nodes
+
+
+def placecores(free, count, nodes):
+    """Choose the cpus of a pinned job from the free cpus, on as few NUMA nodes as possible. A job that fits on a single
+    node is placed on the node with the fewest free cpus that fit it, which keeps the emptier nodes for larger jobs
+    :param free: set of free cpus
+    :param count: number of cpus to choose
+    :param nodes: NUMA node of each cpu, from numanodes()
+    :return: sorted list of cpus, or an empty list if fewer cpus are free
+    """
+    if not count or count > len(free):
+        return []
+    bynode = dict()
+    for cpu in sorted(free):
+        bynode.setdefault(nodes.get(cpu, 0), []).append(cpu)
+    fitting = [node for node in bynode if len(bynode[node]) >= count]
+    if fitting:
+        return bynode[min(fitting, key=lambda x: (len(bynode[x]), x))][:count]
+    # Spread the job over the nodes with the most free cpus
+    cpus = []
+    for node in sorted(bynode, key=lambda x: (-len(bynode[x]), x)):
+        cpus.extend(bynode[node][:count - len(cpus)])
+    return sorted(cpus)
+
+
+def cgroupfolders():
+    """Folders of the cgroups of the pipeline process, from its own cgroup up to the root of each hierarchy, as the
+    limits of every ancestor also apply to the process
+    :return: dictionary of controller e.g. 'memory', or '' for the unified cgroup v2 hierarchy: list of folders
+    """
+    # Mount points of the hierarchies: controller: (root of the hierarchy that is mounted, mount point)
+    mounts = dict()
+    try:
+        with open('/proc/self/mountinfo') as mountinfo:
+            for line in mountinfo:
+                fields = line.split()
+                # The optional fields of a mount end with a single dash
+                separator = fields.index('-')
+                fstype, options = fields[separator + 1], fields[separator + 3]
+                if fstype == 'cgroup2':
+                    mounts[''] = (fields[3], fields[4])
+                elif fstype == 'cgroup':
+                    for controller in options.split(','):
+                        mounts.setdefault(controller, (fields[3], fields[4]))
+        with open('/proc/self/cgroup') as cgroup:
+            memberships = [line.rstrip('\n').split(':', 2) for line in cgroup]
+    except (IOError, OSError, ValueError, IndexError):
+        return dict()
+    folders = dict()
+    for _, controllers, path in memberships:
+        for controller in controllers.split(',') if controllers else ['']:
+            if controller not in mounts:
+                continue
+            root, mountpoint = mounts[controller]
+            # Inside a container, only the part of the hierarchy below the cgroup of the container may be mounted
+            if path == root or path.startswith(root.rstrip('/') + '/'):
+                folder = os.path.join(mountpoint, os.path.relpath(path, root))
+            else:
+                folder = mountpoint
+            folder = os.path.normpath(folder)
+            ancestors = [folder]
+            while folder != mountpoint and folder.startswith(mountpoint):
+                folder = os.path.dirname(folder)
+                ancestors.append(folder)
+            folders[controller] = [x for x in ancestors if os.path.isdir(x)]
+    return folders
+
+
+def resourcelimits():
+    """Cores and memory available to the pipeline. Inside a container, the cores in the cpuset and CPU quota, and the
+    memory limit of the cgroup (v1 or v2) are used rather than those of the host
+    :return: dictionary of the host cores and memory, the limits that were found, and the effective cores and memory
+    """
+    from multiprocessing import cpu_count
+    from math import ceil
+    folders = cgroupfolders()
+    hostcpus, hostmemory = cpu_count(), totalmemory()
+    # Cores the process may be scheduled on, which reflects the cpuset of the cgroup and the affinity of the process
+    cpuset = len(allowedcpus()) or None
+    cpusetfiles = [os.path.join(x, 'cpuset.cpus.effective') for x in folders.get('', [])[:1]]
+    cpusetfiles += [os.path.join(x, y) for x in folders.get('cpuset', [])[:1] for y in ('cpuset.effective_cpus',
+                                                                                          'cpuset.cpus')]
+    for filename in cpusetfiles:
+        value = readfirstline(filename)
+        if value:
+            cpuset = min(cpuset, cpulist(value)) if cpuset else cpulist(value)
+            break
+    # CPU quota of the cgroup and its ancestors in cores e.g. 2.5 for --cpus=2.5
+    quotas = []
+    for folder in folders.get('', []):
+        value = readfirstline(os.path.join(folder, 'cpu.max'))
+        if value and not value.startswith('max'):
+            quota, period = value.split()[:2]
+            quotas.append(float(quota) / float(period))
+    for folder in folders.get('cpu', []):
+        quota, period = readfirstline(os.path.join(folder, 'cpu.cfs_quota_us')), \
+            readfirstline(os.path.join(folder, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0:
+            quotas.append(float(quota) / float(period))
+    cpuquota = min(quotas) if quotas else None
+    # Memory limit of the cgroup and its ancestors. Unlimited cgroup v1 hierarchies report a limit near 2^63
+    limits = []
+    for folder in folders.get('', []):
+        value = readfirstline(os.path.join(folder, 'memory.max'))
+        if value and value.isdigit():
+            limits.append(int(value))
+    for folder in folders.get('memory', []):
+        value = readfirstline(os.path.join(folder, 'memory.limit_in_bytes'))
+        if value and value.isdigit():
+            limits.append(int(value))
+    limits = [x for x in limits if not hostmemory or x < hostmemory]
+    memorylimit = min(limits) if limits else None
+    cpus = min([hostcpus] + ([cpuset] if cpuset else []) + ([int(ceil(cpuquota))] if cpuquota else []))
+    return {'cgroup': 'v2' if '' in folders and not any(x for x in folders if x) else 'v1' if folders else 'none',
+            'hostcpus': hostcpus, 'cpuset': cpuset, 'cpuquota': cpuquota, 'cpus': max(1, cpus),
+            'hostmemory': hostmemory, 'memorylimit': memorylimit, 'memory': memorylimit if memorylimit else hostmemory}
+
+
+def availablecpus():
+    """Number of cores the pipeline may use, which is limited by the cpuset and CPU quota of a container"""
+    return resourcelimits()['cpus']
+
+
+def availablememory():
+    """Bytes of memory the pipeline may use, which is limited by the memory limit of a container"""
+    return resourcelimits()['memory']
+
+
 def logstr(*args):
     yield "{}\n".__add__("-".__mul__(60).__add__("\n")).__mul__(len(args)).format(*args)
 
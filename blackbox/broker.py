@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+from accessoryFunctions import allowedcpus, cpuranges, numanodes, placecores, resourcelimits
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock
+import errno
+import fcntl
+import getpass
+import json
+import os
+import socket
+import tempfile
+import time
+import uuid
+
+__author__ = 'mike knowles'
+
+
+def runfile(path, run):
+    """Lock file that a run holds an exclusive flock on for as long as it is alive"""
+    return os.path.join(path, 'run.{}.lock'.format(run))
+
+
+def runalive(path, run):
+    """Whether a run of the lease table is alive. The flock of its lock file is released by the kernel when the run
+    exits, however it exits, so unlike a pid this does not depend on the PID namespace of the run. The lock file of a
+    dead run is removed
+    :param path: folder of the lease table
+    :param run: identity of the run
+    """
+    try:
+        descriptor = os.open(runfile(path, run), os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as exception:
+            if exception.errno in (errno.EAGAIN, errno.EACCES):
+                return True
+            raise
+        try:
+            os.remove(runfile(path, run))
+        except OSError:
+            # The lock file of a run of another user cannot be removed from the sticky folder
+            pass
+        return False
+    finally:
+        os.close(descriptor)
+
+
+def hostidentity():
+    """Boot id of the kernel, which is shared by every container of the host whatever its hostname. The hostname if
+    the boot id is not available"""
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as bootid:
+            return bootid.read().strip()
+    except IOError:
+        return socket.gethostname()
+
+
+def brokerpath():
+    """Folder of the lease table shared by the pipelines of a host. Set with the BLACKBOX_BROKER environment variable,
+    defaults to a folder in the temporary folder of the host, as the home folder may be shared between hosts"""
+    return os.environ.get('BLACKBOX_BROKER', os.path.join(tempfile.gettempdir(), 'blackbox-broker'))
+
+
+class HostBroker(object):
+    """Cores and memory of a host, leased by every pipeline running on the host. The leases are kept in a JSON table
+    that is only read and written while holding an exclusive lock on a lock file, so no daemon is needed. Runs that have
+    exited are removed from the table, with their leases, by the next run to lock it. Runs share the cores fairly: while
+    another run is waiting, a run may only grow to its share of the cores, and a run holding nothing may always start a
+    job of its minimum size once the cores are free"""
+
+    @contextmanager
+    def table(self):
+        """Lock the lease table, and write it back once it has been changed. The table is rewritten in place while it is
+        locked, as files of other users cannot be replaced in a sticky folder"""
+        with self.lock:
+            descriptor = os.open(self.tablefile, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(descriptor, fcntl.LOCK_EX)
+                if os.fstat(descriptor).st_uid == os.getuid():
+                    # Let every user of the host read and write the table, whatever the umask of its creator
+                    os.fchmod(descriptor, 0o666)
+                tablefile = os.fdopen(os.dup(descriptor), 'r+')
+                try:
+                    try:
+                        table = json.loads(tablefile.read())
+                    except ValueError:
+                        table = {'runs': {}, 'leases': {}}
+                    # Remove the runs that have exited, and their leases
+                    for run in table['runs'].keys():
+                        if run != self.run and not runalive(self.path, run):
+                            del table['runs'][run]
+                    for token, lease in table['leases'].items():
+                        if lease['run'] not in table['runs']:
+                            del table['leases'][token]
+                    yield table
+                    tablefile.seek(0)
+                    tablefile.truncate()
+                    json.dump(table, tablefile, sort_keys=True, indent=4, separators=(',', ': '))
+                finally:
+                    tablefile.close()
+            finally:
+                # Closing the descriptor releases the lock
+                os.close(descriptor)
+
+    def register(self, path):
+        """Add the pipeline to the runs of the host
+        :param path: run folder of the pipeline, shown in the list of leases
+        """
+        with self.table() as table:
+            table['runs'][self.run] = {'pid': os.getpid(), 'path': path, 'user': getpass.getuser(), 'time': time.time(),
+                                       'waiting': None}
+
+    def acquire(self, name, mincores, maxcores, memory, pin=False):
+        """Lease cores and memory from the host if they are free, and the run is within its fair share
+        :param name: name of the kind of job e.g. 'spades'
+        :param mincores: minimum number of cores the job requires
+        :param maxcores: maximum number of cores to lease
+        :param memory: bytes of memory to lease
+        :param pin: True to choose cpus for the job that are not pinned by any lease of the host
+        :return: token of the lease, the number of cores leased and the cpus chosen, or None, 0 and no cpus if the job
+        must wait
+        """
+        mincores = min(mincores, self.cores)
+        memory = min(memory, self.memory) if self.memory else 0
+        with self.table() as table:
+            if self.run not in table['runs']:
+                # The run was removed, as if it had exited e.g. the table was deleted
+                table['runs'][self.run] = {'pid': os.getpid(), 'path': '', 'user': getpass.getuser(),
+                                           'time': time.time(), 'waiting': None}
+            # Suspended jobs hold neither cores nor memory until they are resumed
+            leases = [lease for lease in table['leases'].values() if not lease.get('suspended')]
+            freecores = self.cores - sum(lease['cores'] for lease in leases)
+            freememory = self.memory - sum(lease['memory'] for lease in leases)
+            held = sum(lease['cores'] for lease in leases if lease['run'] == self.run)
+            # Runs waiting for cores, and runs holding cores, share the cores of the host
+            waiting = [run for run, record in table['runs'].items() if record['waiting'] and run != self.run]
+            if waiting:
+                active = set(waiting + [lease['run'] for lease in leases] + [self.run])
+                allowed = min(freecores, max(self.cores // len(active) - held, 0 if held else mincores))
+            else:
+                allowed = freecores
+            if allowed < mincores or (self.memory and freememory < memory):
+                # Mark the run as waiting, so the other runs stop growing beyond their share
+                table['runs'][self.run]['waiting'] = table['runs'][self.run]['waiting'] or time.time()
+                return None, 0, []
+            cores = min(maxcores, allowed)
+            pinned = set(cpu for lease in leases for cpu in lease.get('cpus', []))
+            cpus = placecores(set(self.cpus) - pinned, cores, self.nodes) if pin else []
+            token = '{}-{}'.format(self.run, next(self.counter))
+            table['leases'][token] = {'run': self.run, 'name': name, 'cores': cores, 'memory': memory, 'cpus': cpus,
+                                      'time': time.time()}
+            table['runs'][self.run]['waiting'] = None
+            return token, cores, cpus
+
+    def suspend(self, token):
+        """Return the cores, memory and cpus of a lease whose job was suspended to the host"""
+        with self.table() as table:
+            if token in table['leases']:
+                table['leases'][token]['suspended'] = True
+
+    def resume(self, token, pin=False):
+        """Lease the cores and memory of a suspended job again once they are free. The fair share does not apply, as
+        the job was already started
+        :param token: token of the lease of the job
+        :param pin: True to pin the job to cpus that are not pinned by any lease of the host, preferably its own
+        :return: True if the job may be resumed, and its cpus
+        """
+        with self.table() as table:
+            lease = table['leases'].get(token)
+            if not lease:
+                # The lease was removed, as if the run had exited e.g. the table was deleted
+                return True, []
+            leases = [x for x in table['leases'].values() if not x.get('suspended')]
+            if self.cores - sum(x['cores'] for x in leases) < lease['cores'] or \
+                    (self.memory and self.memory - sum(x['memory'] for x in leases) < lease['memory']):
+                return False, []
+            pinned = set(cpu for x in leases for cpu in x.get('cpus', []))
+            if pin and pinned.intersection(lease.get('cpus', [])):
+                lease['cpus'] = placecores(set(self.cpus) - pinned, lease['cores'], self.nodes)
+            lease['suspended'] = False
+            return True, lease.get('cpus', []) if pin else []
+
+    def release(self, token):
+        """Return the cores and memory of a lease to the host"""
+        with self.table() as table:
+            table['leases'].pop(token, None)
+
+    def close(self):
+        """Remove the pipeline and its leases from the table"""
+        with self.table() as table:
+            table['runs'].pop(self.run, None)
+            for token, lease in table['leases'].items():
+                if lease['run'] == self.run:
+                    del table['leases'][token]
+        if self.alive is not None:
+            try:
+                os.remove(runfile(self.path, self.run))
+            except OSError:
+                pass
+            # Closing the descriptor releases the lock
+            os.close(self.alive)
+            self.alive = None
+
+    def leases(self):
+        """Runs and leases of the host
+        :return: the table of runs and leases
+        """
+        with self.table() as table:
+            return table
+
+    def __init__(self, path=None, cores=None, memory=None):
+        """
+        :param path: folder of the lease table. Defaults to brokerpath()
+        :param cores: number of cores of the host. Defaults to the cores available to the pipeline
+        :param memory: bytes of memory of the host. Defaults to the memory available to the pipeline
+        """
+        limits = resourcelimits()
+        self.path = path if path else brokerpath()
+        self.cores = int(cores) if cores else limits['cpus']
+        self.memory = int(memory) if memory else limits['memory']
+        # Cpus that jobs may be pinned to, and the NUMA node of each cpu
+        self.cpus = allowedcpus()
+        self.nodes = numanodes()
+        # Each host has its own table, as the folder may be on a file system shared between hosts. The host is named by
+        # its boot id, so that containers of the host with different hostnames share a table
+        self.tablefile = os.path.join(self.path, 'leases.{}.json'.format(hostidentity()))
+        # Runs are named by a uuid rather than their pid, as pids are only unique within a PID namespace
+        self.run = uuid.uuid4().hex
+        self.alive = None
+        self.counter = count()
+        # Threads of the pipeline lock the table one at a time, as flock does not exclude threads of the same process
+        self.lock = Lock()
+        try:
+            # The folder is shared by every user of the host, so it is sticky like /tmp
+            os.makedirs(self.path)
+            os.chmod(self.path, 0o1777)
+        except OSError as exception:
+            if exception.errno != errno.EEXIST:
+                raise
+        # Hold the lock file of the run until it is closed or exits, before it is added to the table, so that the other
+        # runs only see it as dead once it has exited
+        self.alive = os.open(runfile(self.path, self.run), os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.alive, fcntl.LOCK_EX)
+
+
+def printleases(broker):
+    """Print the runs of the host and their leases"""
+    table = broker.leases()
+    leases = table['leases'].values()
+    # Suspended jobs hold neither cores nor memory
+    active = [lease for lease in leases if not lease.get('suspended')]
+    print 'Host: {} cores, {:.1f} GB. Leased: {} cores, {:.1f} GB'.format(
+        broker.cores, broker.memory / 1024.0 ** 3, sum(lease['cores'] for lease in active),
+        sum(lease['memory'] for lease in active) / 1024.0 ** 3)
+    now = time.time()
+    for run in sorted(table['runs'], key=lambda x: table['runs'][x]['time']):
+        record = table['runs'][run]
+        held = [lease for lease in leases if lease['run'] == run]
+        print '\n{} ({}) {}{}'.format(record.get('pid', run), record['user'], record['path'],
+                                      ' waiting {:.0f} s'.format(now - record['waiting']) if record['waiting'] else '')
+        for lease in sorted(held, key=lambda x: x['time']):
+            print '    {:<10} {:>4} cores {:>8.1f} GB {:>8.0f} s  {}{}'.format(
+                lease['name'], lease['cores'], lease['memory'] / 1024.0 ** 3, now - lease['time'],
+                cpuranges(lease.get('cpus', [])), ' suspended' if lease.get('suspended') else '')
@@ -92,8 +92,8 @@ class CreateFastq(object):
             # Call configureBclToFastq.pl
             printtime('Running bcl2fastq', self.start)
             # Run the commands
-            execute(bclcall, '{}/bcl.log'.format(self.fastqdestination), shell=True)
-            execute(nohupcall, '{}/nohup.log'.format(self.fastqdestination), shell=True)
+            execute(bclcall, '{}/bcl.log'.format(self.fastqdestination), key='bcl2fastq', shell=True)
+            execute(nohupcall, '{}/nohup.log'.format(self.fastqdestination), key='nohup', shell=True)
         # Populate the metadata
         for sample in self.metadata.samples:
             sample.commands.nohupcall = nohupcall
@@ -11,7 +11,8 @@ class FastqMover(object):
         import os
         import time
         from accessoryFunctions import relativesymlink
-        print "\r[{:}] Moving fastq files".format(time.strftime("%H:%M:%S"))
+        from progress import board
+        board.message("[{:}] Moving fastq files".format(time.strftime("%H:%M:%S")))
         # Iterate through each sample
         for sample in self.metadata.runmetadata.samples:
             # Retrieve the output directory
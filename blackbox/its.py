@@ -1,40 +1,36 @@
 #!/usr/bin/env python
-from threading import Thread
 from accessoryFunctions import *
 from itsx.parallel import ITSx
+from stageCache import StageCache
+from tools import ToolRegistry
+import json
 import os
+import sys
 
 __author__ = 'mike knowles'
 
+# The wrapper runs ITSx on chunks of the assembly in parallel. It is run in a process of its own, so the ProcessMonitor
+# places, accounts, suspends and watches ITSx and its chunks like any other command
+wrapper = 'import json, sys\nfrom itsx.parallel import ITSx\n' \
+          'ITSx(**json.loads(sys.argv[1]))(name=sys.argv[2], total=int(sys.argv[3]))'
+
 
 class ITS(object):
     def __init__(self, inputobject):
-        from Queue import Queue
-        self.metadata = [sample for sample in inputobject.runmetadata.samples
-                         if os.path.isfile(sample.general.bestassemblyfile)]
+        self.metadata = inputobject.runmetadata.samples
         self.start = inputobject.starttime
-        self.threads = int(inputobject.cpus)
+        self.allocator = inputobject.allocator
+        self.cache = inputobject.cache
         self.path = inputobject.path
-        self.smallqueue = Queue()
         self.hmm = inputobject.hmm
-        with open(which("ITSx")) as f:
-            for line in f:
-                if line.startswith("$app_version"):
-                    self.version = line.split('=')[1].strip()[1:-2]
-                    break
+        self.version = inputobject.tools.version('itsx')
+
+    def __call__(self):
+        """Run ITSx on every sample with an assembly in a multi-threaded fashion"""
         printtime('Performing ITSx {} analysis'.format(self.version), self.start)
-        for _ in range(len(self.metadata)):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.run, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for i in self.metadata:
-            i.general.ITSxresults = '{}/ITSx_results'.format(i.general.outputdirectory)
-            make_path(i.general.ITSxresults)
-            self.smallqueue.put(i)
-        self.smallqueue.join()
+        # Run ITSx on each sample with an assembly in the pool
+        with WorkerPool(self.allocator.cores) as pool:
+            pool.map(self.run, [sample for sample in self.metadata if os.path.isfile(sample.general.bestassemblyfile)])
 
     @staticmethod
     def parse(sample, pos):
@@ -49,27 +45,51 @@ class ITS(object):
                     k, v = ele.split(": ")
                     main((sample.ITS, k), "{}[{}]".format(contig, v.replace('-', ':')))
 
-    def run(self):
-        while True:
-            sample = self.smallqueue.get()
-            sample.software.ITSx = self.version
-            positions, summary = [os.path.join(sample.general.ITSxresults, sample.name + f)
-                                  for f in ['.positions.txt', '.summary.txt']]
-            sample.commands.ITSx = ITSx(o=sample.general.ITSxresults,
-                                        i=sample.general.bestassemblyfile,
-                                        cpu=self.threads,
-                                        N=2, t=self.hmm,
-                                        detailed_results="T",
-                                        preserve="T")
-            if not all(map(os.path.isfile, [positions, summary])):
-                sample.commands.ITSx(name=sample.name, total=int(sample.assembly.TotalLength))
-            if all(map(os.path.isfile, [positions, summary])):
-                if os.stat([positions, summary][0]).st_size:
-                    with open([positions, summary][0]) as pos:
-                        self.parse(sample, pos)
-            else:
-                printtime("ERROR: No output generated for " + sample.name, self.start)
-            self.smallqueue.task_done()
+    @staticmethod
+    def itsx(sample, options):
+        """Run the ITSx wrapper on the assembly of a single sample as a monitored command
+        :param sample: sample metadata object
+        :param options: options of the wrapper
+        """
+        import itsx
+        # The command finds the wrapper where the pipeline found it
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(itsx.__file__))),
+                                                     environment.get('PYTHONPATH', '')])
+        execute([sys.executable, '-c', wrapper, json.dumps(options), sample.name, str(assemblylength(sample))],
+                os.path.join(sample.general.ITSxresults, 'ITSx.log'), sample, 'ITSx', env=environment)
+
+    def run(self, sample):
+        """Run ITSx on the assembly of a single sample, and parse the positions of the ITS regions"""
+        sample.general.ITSxresults = '{}/ITSx_results'.format(sample.general.outputdirectory)
+        make_path(sample.general.ITSxresults)
+        sample.software.ITSx = self.version
+        positions, summary = [os.path.join(sample.general.ITSxresults, sample.name + f)
+                              for f in ['.positions.txt', '.summary.txt']]
+        with self.allocator.lease('its', memory=1024 ** 3) as lease:
+            options = dict(o=sample.general.ITSxresults, i=sample.general.bestassemblyfile, cpu=lease.cores, N=2,
+                           t=self.hmm, detailed_results="T", preserve="T")
+            sample.commands.ITSx = ITSx(**options)
+            # Run ITSx unless the results of the same assembly are current or cached
+            self.cache.run(sample, 'itsx', lambda: self.itsx(sample, options),
+                           [sample.general.bestassemblyfile], sample.commands.ITSx, self.version,
+                           sample.general.ITSxresults, map(os.path.basename, [positions, summary]), '*')
+        if all(map(os.path.isfile, [positions, summary])):
+            if os.stat([positions, summary][0]).st_size:
+                with open([positions, summary][0]) as pos:
+                    self.parse(sample, pos)
+        else:
+            printtime("ERROR: No output generated for " + sample.name, self.start)
+
+
+def assemblylength(sample):
+    """Total length of the assembly of a sample. Uses the QUAST results if they are available, otherwise the length is
+    read directly from the assembly, as ITSx may be run before, or alongside QUAST"""
+    try:
+        return int(sample.assembly.TotalLength)
+    except (KeyError, ValueError):
+        with open(sample.general.bestassemblyfile) as assembly:
+            return sum(len(line.strip()) for line in assembly if not line.startswith('>'))
 
 
 if __name__ == '__main__':
@@ -84,8 +104,11 @@ if __name__ == '__main__':
     # metadata.cpus = cpu_count()
     metadata.cpus = 4
     metadata.hmm = "F,O"
+    metadata.allocator = ResourceAllocator(metadata.cpus)
+    metadata.cache = StageCache()
+    metadata.tools = ToolRegistry()
     metadata.starttime = time()
     metadata.runmetadata.samples = MetadataReader(metadata).samples
-    ITS(metadata)
+    ITS(metadata)()
     # metadata.runmetadata.samples[0].commands.Blast = NcbiblastnCommandline(help=True)
     # print json.dumps(dict(metadata.runmetadata.samples[0]), indent=4, sort_keys=True)
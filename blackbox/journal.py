@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+from accessoryFunctions import loadmetadata
+from threading import Lock
+import json
+import os
+import sqlite3
+import time
+
+__author__ = 'mike knowles'
+
+schema = """
+CREATE TABLE IF NOT EXISTS nodes (sample TEXT, stage TEXT, state TEXT, queued REAL, started REAL, finished REAL,
+                                  attempts INTEGER DEFAULT 0, error TEXT, PRIMARY KEY (sample, stage));
+CREATE TABLE IF NOT EXISTS transitions (id INTEGER PRIMARY KEY, sample TEXT, stage TEXT, state TEXT, time REAL);
+CREATE TABLE IF NOT EXISTS samples (name TEXT PRIMARY KEY, position INTEGER, metadata TEXT, time REAL);
+"""
+
+
+class Journal(object):
+    """Per-run SQLite journal of every (sample, stage) transition, and of the metadata of each sample. Each transition
+    is recorded in its own transaction, so the journal is consistent if the pipeline dies, and a run is resumed from
+    the journal without scanning the sample folders"""
+
+    # Node states
+    queued, running, done, skipped, failed = 'queued', 'running', 'done', 'skipped', 'failed'
+
+    def queue(self, samples, stages):
+        """Record the samples of the run and queue their stages. Stages that are already done are left untouched
+        :param samples: list of sample metadata objects
+        :param stages: list of stage names to run
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            for position, sample in enumerate(samples):
+                self.connection.execute('INSERT OR IGNORE INTO samples VALUES (?, ?, ?, ?)',
+                                        (sample.name, position, json.dumps(dict(sample)), now))
+                for stage in stages:
+                    if self.state(sample.name, stage) not in (self.done, self.skipped):
+                        self.connection.execute('INSERT OR REPLACE INTO nodes (sample, stage, state, queued, attempts) '
+                                                'VALUES (?, ?, ?, ?, COALESCE((SELECT attempts FROM nodes WHERE '
+                                                'sample = ? AND stage = ?), 0))',
+                                                (sample.name, stage, self.queued, now, sample.name, stage))
+                        self.record(sample.name, stage, self.queued, now)
+
+    def transition(self, sample, stage, state, error=None, snapshot=True):
+        """Record the transition of a node, and the metadata of the sample once the node is finished
+        :param sample: sample metadata object
+        :param stage: name of the stage
+        :param state: new state of the node
+        :param error: optional traceback of a failed node
+        :param snapshot: False if other stages of the sample are still modifying its metadata
+        """
+        now = time.time()
+        with self.lock, self.connection:
+            if state == self.running:
+                self.connection.execute('UPDATE nodes SET state = ?, started = ?, attempts = attempts + 1 '
+                                        'WHERE sample = ? AND stage = ?', (state, now, sample.name, stage))
+            else:
+                self.connection.execute('UPDATE nodes SET state = ?, finished = ?, error = ? WHERE sample = ? '
+                                        'AND stage = ?', (state, now, error, sample.name, stage))
+            self.record(sample.name, stage, state, now)
+            if snapshot and state != self.running:
+                self.connection.execute('UPDATE samples SET metadata = ?, time = ? WHERE name = ?',
+                                        (json.dumps(dict(sample)), now, sample.name))
+
+    def record(self, sample, stage, state, now):
+        self.connection.execute('INSERT INTO transitions (sample, stage, state, time) VALUES (?, ?, ?, ?)',
+                                (sample, stage, state, now))
+
+    def state(self, sample, stage):
+        row = self.connection.execute('SELECT state FROM nodes WHERE sample = ? AND stage = ?',
+                                      (sample, stage)).fetchone()
+        return row[0] if row else None
+
+    def finished(self):
+        """Find the nodes that do not need to be run again. A node is only finished if the metadata of its sample was
+        recorded after the node finished
+        :return: dictionary of (sample name, stage): state
+        """
+        with self.lock:
+            rows = self.connection.execute('SELECT nodes.sample, nodes.stage, nodes.state FROM nodes JOIN samples ON '
+                                           'nodes.sample = samples.name WHERE nodes.state IN (?, ?) AND '
+                                           'nodes.finished <= samples.time', (self.done, self.skipped)).fetchall()
+        return dict(((sample, stage), state) for sample, stage, state in rows)
+
+    def samples(self):
+        """Create the sample metadata objects recorded in the journal
+        :return: list of sample metadata objects in the order of the run
+        """
+        samples = []
+        with self.lock:
+            rows = self.connection.execute('SELECT metadata FROM samples ORDER BY position').fetchall()
+        for row in rows:
+            # Create the metadata objects
+            samples.append(loadmetadata(json.loads(row[0])))
+        return samples
+
+    def transitions(self, since=0):
+        """List the transitions recorded since a time
+        :return: list of (sample, stage, state, time) in the order they were recorded
+        """
+        with self.lock:
+            return self.connection.execute('SELECT sample, stage, state, time FROM transitions WHERE time >= ? '
+                                           'ORDER BY id', (since,)).fetchall()
+
+    def status(self):
+        """List every node in the journal
+        :return: list of (sample, stage, state, started, finished, attempts, error) in the order of the run
+        """
+        with self.lock:
+            return self.connection.execute('SELECT nodes.sample, stage, state, started, finished, attempts, error '
+                                           'FROM nodes LEFT JOIN samples ON nodes.sample = samples.name ORDER BY '
+                                           'samples.position, queued, started').fetchall()
+
+    def __init__(self, path, restart=False):
+        """
+        :param path: folder of the run. The journal is stored in blackbox.sqlite in this folder
+        :param restart: True to discard the journal of a previous run
+        """
+        self.journalfile = os.path.join(path, 'blackbox.sqlite')
+        if restart and os.path.isfile(self.journalfile):
+            os.unlink(self.journalfile)
+        self.lock = Lock()
+        # The journal is written from the threads of every stage, and each write is serialised with the lock
+        self.connection = sqlite3.connect(self.journalfile, timeout=60, check_same_thread=False)
+        self.connection.executescript(schema)
+
+
+def status(path):
+    """Print the state, and duration of every stage of every sample in the journal of a run
+    :param path: folder of the run
+    """
+    journalfile = os.path.join(path, 'blackbox.sqlite')
+    assert os.path.isfile(journalfile), u'No journal in {0!r:s}'.format(path)
+    rows = Journal(path).status()
+    now = time.time()
+    counts = dict()
+    print '{:<30} {:<10} {:<8} {:>10} {:>8}'.format('Sample', 'Stage', 'State', 'Duration', 'Attempts')
+    for sample, stage, state, started, finished, attempts, error in rows:
+        counts[state] = counts.get(state, 0) + 1
+        # Running nodes are timed up to now
+        if state == Journal.running:
+            duration = now - started
+        else:
+            duration = finished - started if started and finished else 0
+        print '{:<30} {:<10} {:<8} {:>10} {:>8}'.format(sample, stage, state,
+                                                         time.strftime('%H:%M:%S', time.gmtime(duration)),
+                                                         attempts if attempts else 0)
+    print ', '.join('{} {}'.format(counts[state], state) for state in sorted(counts))
+    for sample, stage, state, started, finished, attempts, error in rows:
+        if state == Journal.failed and error:
+            print '\n{} {} failed:\n{}'.format(sample, stage, error.rstrip())
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+from accessoryFunctions import GenObject, loadmetadata, make_path, printtime, priority, stagetimer
+from profiles import settings
+from workqueue import changes, merge, writejson
+import json
+import os
+import pipes
+import traceback
+
+__author__ = 'mike knowles'
+
+# Memory leased by the commands of each stage, per fastq file for FastQC. The memory of an assembly is predicted from
+# its reads instead, and trimming leases the java heap of the profile of the sample along with the overhead of the JVM
+reservations = {'fastqc': 250 * 1024 ** 2, 'trim': 512 * 1024 ** 2, 'quast': 1024 ** 3, 'qualimap': 1536 * 1024 ** 2,
+                'its': 1024 ** 3, 'busco': 2 * 1024 ** 3}
+
+# Script run by every task of a job array. The launcher provides the task number, and the dependencies of each job are
+# listed in jobs.tsv for launchers that support them
+arrayscript = r'''#!/bin/sh
+# Runs a job of the plan of the run in {path}: the job given as the first argument, or the task of a job array e.g.
+#   sbatch --array=1-{jobs} {script}
+#   qsub -t 1-{jobs} {script}
+#   bsub -J "blackbox[1-{jobs}]" {script}
+# Each job waits for the jobs it depends on, and fails if one of them failed, so the tasks may start in any order
+plan={plan}
+task=${{1:-${{SLURM_ARRAY_TASK_ID:-${{SGE_TASK_ID:-${{PBS_ARRAY_INDEX:-${{PBS_ARRAYID:-$LSB_JOBINDEX}}}}}}}}}}
+line=$(awk -F '\t' -v task="$task" '$1 == task' "$plan/jobs.tsv")
+if [ -z "$line" ]; then
+    echo "No job $task in $plan/jobs.tsv" >&2
+    exit 1
+fi
+for dependency in $(printf '%s\n' "$line" | cut -f 5 | tr ',' ' '); do
+    name=$(awk -F '\t' -v task="$dependency" '$1 == task {{print $2}}' "$plan/jobs.tsv")
+    while [ ! -f "$plan/changes/$name.json" ]; do
+        if [ -f "$plan/failed/$name.json" ]; then
+            echo "$name failed, so job $task is not run" >&2
+            exit 1
+        fi
+        sleep 30
+    done
+done
+exec sh -c "$(printf '%s\n' "$line" | cut -f 6)"
+'''
+
+
+class Plan(object):
+    """Execution plan of a run, exported for an external scheduler rather than run by the pipeline. Every (sample,
+    stage) node becomes a job running the stage with 'MBBspades node', with the threads and memory it requests. The
+    jobs are written as a Makefile, and as a job array script with the jobs listed in jobs.tsv. Each job reads the
+    metadata of its sample as exported, merged with the metadata changed by the stages of the sample that finished,
+    and writes the metadata it changed to its own file, so the jobs of a sample may run at the same time on different
+    hosts. The last job of each sample writes the JSON report of the sample, which MetadataReader reads"""
+
+    # Memory of the Python process running a stage, added to the memory of the commands of the stage
+    overhead = 512 * 1024 ** 2
+
+    def write(self, schedule, threads, command, commandline):
+        """Write the plan of the nodes of a schedule that are not finished
+        :param schedule: Scheduler of the run
+        :param threads: number of threads of a job that uses every core it is given, e.g. an assembly
+        :param command: list of the interpreter and the script of the pipeline, which runs the jobs
+        :param commandline: command line arguments of the run, which the jobs run the stages with
+        """
+        from spadesMemory import MemoryModel
+        memorymodel = MemoryModel()
+        writejson(commandline, self.path, 'arguments.json', self.temporary)
+        jobs, tasks = [], dict()
+        for sample in sorted(set(node[0] for node in schedule.nodes), key=lambda x: schedule.key((x, None))):
+            metadata = schedule.samples[sample]
+            stages = [stage for stage in schedule.selected if schedule.state[(sample, stage)] == schedule.pending]
+            if not stages:
+                continue
+            fastqfiles = dict(metadata.general).get('fastqfiles')
+            fastqfiles = fastqfiles if isinstance(fastqfiles, list) else []
+            for stage in stages + ['metadata']:
+                if stage == 'spades':
+                    # The trimmed reads do not exist yet, so the memory is predicted from the raw reads, with the
+                    # k-mers of the profile of the sample up to the read length as in the assembly
+                    run = metadata.datastore.get('run')
+                    readlength = int(dict(run).get('forwardlength', 0)) if isinstance(run, GenObject) else 0
+                    sized = [kmer for kmer in settings(metadata)['kmers'].split(',') if int(kmer) <= readlength]
+                    memory = memorymodel.predict(metadata, fastqfiles, sized) if fastqfiles and sized else 0
+                else:
+                    memory = reservations.get(stage, 0) * (max(1, len(fastqfiles)) if stage == 'fastqc' else 1)
+                    if stage == 'trim':
+                        memory += settings(metadata)['heap'] * 1024 ** 2
+                # FastQC runs a thread per file, and the metadata report needs a single thread. Other stages are
+                # given the most cores they were granted in previous runs, if they were run before
+                cores = 1 if stage == 'metadata' else min(threads, len(fastqfiles)) if stage == 'fastqc' else \
+                    min(threads, (schedule.model.maxcores(stage) if schedule.model else None) or threads)
+                requires = stages if stage == 'metadata' else \
+                    [x for x in schedule.stages[stage].requires if x in stages]
+                name = '{}.{}'.format(metadata.name, stage)
+                tasks[name] = len(jobs) + 1
+                jobs.append({'name': name, 'sample': metadata.name, 'stage': stage, 'threads': max(1, cores),
+                             'memory': (memory + self.overhead) / 1024.0 ** 3,
+                             'requires': ['{}.{}'.format(metadata.name, x) for x in requires]})
+            # The jobs read the metadata of the sample as it is now
+            writejson(dict(metadata), self.samples, metadata.name + '.json', self.temporary)
+        for job in jobs:
+            job['command'] = '{} node {} {} {} -t {} --memory {:.2f} > {} 2>&1'.format(
+                ' '.join(pipes.quote(x) for x in command), pipes.quote(self.run), pipes.quote(job['sample']),
+                job['stage'], job['threads'], job['memory'],
+                pipes.quote(os.path.join(self.logs, job['name'] + '.log')))
+        self.makefile(jobs)
+        self.jobarray(jobs, tasks)
+        printtime('Wrote the plan of {} jobs to {}'.format(len(jobs), self.path), self.start)
+
+    def makefile(self, jobs):
+        """Write the jobs as the rules of a Makefile. The target of each job is the file of the metadata it changed,
+        which is only written once the job succeeded, so make -j runs the jobs in parallel in the order of their
+        dependencies, and runs the failed jobs again"""
+        target = lambda name: os.path.join(self.changes, name + '.json')
+        with open(os.path.join(self.path, 'Makefile'), 'wb') as makefile:
+            makefile.write('# Plan of the run in {0}, exported by MBBspades e.g.\n#   make -j 8 -k -f {1}\n'
+                           '.PHONY: all\nall: {2}\n'.format(self.run, os.path.join(self.path, 'Makefile'),
+                                                            ' '.join(target(job['name']) for job in jobs
+                                                                     if job['stage'] == 'metadata')))
+            for job in jobs:
+                makefile.write('\n# {}: {} threads, {:.2f} GB\n{}: {}\n\t{}\n'.format(
+                    job['name'], job['threads'], job['memory'], target(job['name']),
+                    ' '.join(target(name) for name in job['requires']), job['command']))
+
+    def jobarray(self, jobs, tasks):
+        """Write the jobs to jobs.tsv, one per task, with the tasks they depend on, and the script that runs a task"""
+        with open(os.path.join(self.path, 'jobs.tsv'), 'wb') as jobsfile:
+            jobsfile.write('task\tname\tthreads\tmemory (GB)\tdependencies\tcommand\n')
+            for job in jobs:
+                jobsfile.write('{}\t{}\t{}\t{:.2f}\t{}\t{}\n'.format(
+                    tasks[job['name']], job['name'], job['threads'], job['memory'],
+                    ','.join(str(tasks[name]) for name in job['requires']), job['command']))
+        script = os.path.join(self.path, 'array.sh')
+        with open(script, 'wb') as arrayfile:
+            arrayfile.write(arrayscript.format(path=self.run, plan=pipes.quote(self.path), jobs=len(jobs),
+                                               script=script))
+        os.chmod(script, 0o755)
+
+    def load(self, name, stages):
+        """Create the metadata of a sample as exported, merged with the metadata changed by its finished stages
+        :param name: name of the sample
+        :param stages: names of the stages of the pipeline, in order
+        """
+        with open(os.path.join(self.samples, name + '.json')) as samplefile:
+            sample = loadmetadata(json.load(samplefile))
+        for stage in stages:
+            changesfile = os.path.join(self.changes, '{}.{}.json'.format(name, stage))
+            if os.path.isfile(changesfile):
+                with open(changesfile) as result:
+                    merge(sample, json.load(result)['changes'])
+        return sample
+
+    def node(self, name, stage, stages):
+        """Run a stage of a sample of the plan, and write the metadata it changed
+        :param name: name of the sample
+        :param stage: name of the stage
+        :param stages: list of the Stage objects of the pipeline
+        :return: True if the stage finished, or was skipped
+        """
+        stages = dict((x.name, x) for x in stages)
+        filename = '{}.{}.json'.format(name, stage)
+        for folder in (self.changes, self.failed):
+            if os.path.isfile(os.path.join(folder, filename)):
+                os.unlink(os.path.join(folder, filename))
+        sample = self.load(name, [x for x in self.order if x in stages])
+        # The metadata are compared as they are written to JSON
+        before = json.loads(json.dumps(dict(sample)))
+        try:
+            if stages[stage].condition(sample):
+                printtime('{}: starting {}'.format(name, stage), self.start)
+                with priority(sample), stagetimer(sample, stage):
+                    stages[stage].setup().run(sample)
+                state = 'done'
+            else:
+                # e.g. no assembly was created. The stages that require it decide whether they run
+                printtime('{}: {} skipped'.format(name, stage), self.start)
+                state = 'skipped'
+        except Exception:
+            error = traceback.format_exc()
+            printtime('{}: {} failed\n{}'.format(name, stage, error), self.start)
+            writejson({'state': 'failed', 'error': error}, self.failed, filename, self.temporary)
+            return False
+        writejson({'state': state, 'changes': changes(before, json.loads(json.dumps(dict(sample))))}, self.changes,
+                  filename, self.temporary)
+        return True
+
+    def arguments(self):
+        """Command line arguments of the run the plan was exported from"""
+        argumentsfile = os.path.join(self.path, 'arguments.json')
+        assert os.path.isfile(argumentsfile), u'No plan was exported with --export in {0!r:s}'.format(self.run)
+        with open(argumentsfile) as arguments:
+            return json.load(arguments)
+
+    def __init__(self, path, start=0, order=()):
+        """
+        :param path: folder of the run. The plan is written to the plan folder of the run
+        :param start: starting time of the analysis
+        :param order: names of the stages of the pipeline in order, in which the metadata they changed are merged
+        """
+        self.run = path
+        self.path = os.path.join(path, 'plan')
+        self.start = start
+        self.order = list(order) + ['metadata']
+        self.samples = os.path.join(self.path, 'samples')
+        self.changes = os.path.join(self.path, 'changes')
+        self.failed = os.path.join(self.path, 'failed')
+        self.logs = os.path.join(self.path, 'logs')
+        self.temporary = os.path.join(self.path, 'tmp')
+        for folder in (self.samples, self.changes, self.failed, self.logs, self.temporary):
+            make_path(folder)
+
+
+class Report(object):
+    """Last job of each sample of a plan, which writes the metadata of the sample to its JSON report"""
+
+    def run(self, sample):
+        from metadataprinter import MetadataPrinter
+        self.pipeline.runmetadata.samples = [sample]
+        MetadataPrinter(self.pipeline)
+
+    def __init__(self, inputobject):
+        self.pipeline = inputobject
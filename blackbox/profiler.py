@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+from contextlib import contextmanager
+from threading import Lock
+import os
+
+__author__ = 'mike knowles'
+
+
+def typecounts():
+    """Count the objects tracked by the garbage collector by type"""
+    import gc
+    counts = dict()
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def rss():
+    """Current resident memory of the pipeline process in bytes"""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def maxrss():
+    """Peak resident memory of the pipeline process in bytes"""
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageProfiler(object):
+    """Opt-in profiler of the Python code of the pipeline. Each stage is run under cProfile in the thread that runs it,
+    and the profiles of every sample are merged into one <stage>.pstats file per stage. Python 2 has no tracemalloc, so
+    the objects left alive by a stage are counted by type with the garbage collector instead, and written with the
+    growth of the resident memory and the peak memory of the pipeline to <stage>.allocations.txt. Stages run at the
+    same time share the process, so their counts overlap"""
+
+    @contextmanager
+    def profile(self, name):
+        """Profile the code run in this thread within the context under the name of a stage
+        :param name: name of the stage e.g. 'spades'
+        """
+        if not self.enabled:
+            yield
+            return
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        before, resident = typecounts(), rss()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            after, resident = typecounts(), rss() - resident
+            with self.lock:
+                # Merge the profile of every sample of the stage
+                if name in self.stats:
+                    self.stats[name].add(profile)
+                else:
+                    self.stats[name] = pstats.Stats(profile)
+                growth = self.growth.setdefault(name, dict())
+                for objtype in after:
+                    growth[objtype] = growth.get(objtype, 0) + after[objtype] - before.get(objtype, 0)
+                self.calls[name] = self.calls.get(name, 0) + 1
+                self.resident[name] = self.resident.get(name, 0) + resident
+
+    def write(self, top=25):
+        """Write the profile and the allocation report of each stage to the profile folder
+        :param top: number of object types listed in the allocation reports
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            peak = maxrss()
+            for name in sorted(self.stats):
+                self.stats[name].dump_stats(os.path.join(self.path, '{}.pstats'.format(name)))
+                growth = sorted(self.growth[name].items(), key=lambda x: -x[1])[:top]
+                with open(os.path.join(self.path, '{}.allocations.txt'.format(name)), 'wb') as report:
+                    report.write('Stage: {}\nProfiled runs: {}\nResident memory grown: {:.1f} MB\nPeak memory of the '
+                                 'pipeline: {:.1f} MB\n\n'.format(name, self.calls[name],
+                                                                 self.resident[name] / 1024.0 ** 2, peak / 1024.0 ** 2))
+                    report.write('{:<40} {:>12}\n'.format('Object type', 'Objects left'))
+                    for objtype, count in growth:
+                        report.write('{:<40} {:>12}\n'.format(objtype, count))
+
+    def __init__(self, path=None):
+        """
+        :param path: folder to write the profiles to. Profiling is disabled if no folder is given
+        """
+        self.path = path
+        self.enabled = bool(path)
+        self.lock = Lock()
+        self.stats = dict()
+        self.growth = dict()
+        self.calls = dict()
+        self.resident = dict()
+        if self.enabled and not os.path.isdir(self.path):
+            os.makedirs(self.path)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+from accessoryFunctions import GenObject
+
+__author__ = 'mike knowles'
+
+# Settings of the stages under each profile:
+#   kmers: k-mer sizes of the assembly, before those longer than the reads are dropped
+#   careful: run SPAdes with --careful, which corrects mismatches and short indels in the contigs
+#   hdist: Hamming distance of the adapter k-mers matched by bbduk
+#   heap: java heap of bbduk in MB
+#   retrim: run FastQC on the trimmed reads, and trim the reads again if the report shows biased ends
+#   gage: run QUAST with --gage when a reference genome is provided
+#   reads: reads (or pairs) mapped to the assembly for Qualimap, 0 maps every corrected read
+# 'fast' is for surveillance throughput: the k-mers SPAdes picks itself for 150 bp reads, no mismatch correction, exact
+# adapter matches, a single trimming pass and a subset of the reads mapped. 'standard' is the pipeline as it ran before
+# profiles, and 'thorough' is for reference genomes, matching adapters with up to two mismatches from the first pass
+profiles = {'fast': {'kmers': '21,33,55,77', 'careful': False, 'hdist': 0, 'heap': 1024, 'retrim': False,
+                     'gage': False, 'reads': 1000000},
+            'standard': {'kmers': '21,33,55,77,99,127', 'careful': True, 'hdist': 1, 'heap': 1024, 'retrim': True,
+                         'gage': True, 'reads': 0},
+            'thorough': {'kmers': '21,33,55,77,99,127', 'careful': True, 'hdist': 2, 'heap': 2048, 'retrim': True,
+                         'gage': True, 'reads': 0}}
+default = 'standard'
+
+
+def sampleprofile(sample, profile=default):
+    """Profile of a sample
+    :param sample: sample metadata object
+    :param profile: profile of the run
+    :return: the Profile column of the sample sheet if it names a profile, otherwise the profile of the run
+    """
+    # The run section is only read if it exists, as reading a missing section of a MetadataObject creates it
+    run = sample.datastore.get('run')
+    value = str(dict(run).get('Profile', '')).lower() if isinstance(run, GenObject) else ''
+    return value if value in profiles else profile
+
+
+def record(sample, profile, command, kmers=None):
+    """Record the profile of a sample, and the settings of its stages, in sample.commands.pipeline
+    :param sample: sample metadata object
+    :param profile: name of the profile
+    :param command: command line of the pipeline
+    :param kmers: optional k-mer sizes given on the command line, which replace those of the profile
+    """
+    stagesettings = dict(profiles[profile])
+    if kmers:
+        stagesettings['kmers'] = kmers
+    sample.general.profile = profile
+    sample.commands.pipeline = {'command': list(command), 'profile': profile, 'settings': stagesettings}
+
+
+def settings(sample):
+    """Settings of the stages of a sample, as recorded with its profile. Samples without a profile, e.g. read from the
+    reports of an earlier version, use the default profile"""
+    commands = sample.datastore.get('commands')
+    pipeline = dict(commands).get('pipeline') if isinstance(commands, GenObject) else None
+    if isinstance(pipeline, dict) and isinstance(pipeline.get('settings'), dict):
+        return pipeline['settings']
+    return dict(profiles[default])
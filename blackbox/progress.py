@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+from Queue import Queue, Empty
+from threading import Thread
+import os
+import sys
+import time
+
+__author__ = 'mike knowles'
+
+
+def hms(seconds):
+    """Format seconds as h:mm:ss"""
+    seconds = max(0, int(seconds))
+    return '{:d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class ProgressBoard(object):
+    """Progress of the run, drawn by a single thread from the events of the runner: the messages of the pipeline, the
+    stages that start and finish, and the resources of the running commands, which the ProcessMonitor sends once per
+    second. On a terminal, every running sample has a row with its stages, elapsed time, ETA, CPU and memory below the
+    messages, and the rows are redrawn after each event. Otherwise, the messages and a line for every finished stage are
+    written as a plain log. Until the board is started, messages are written straight to the output"""
+
+    def message(self, text):
+        """Write a message of the pipeline above the board"""
+        if self.thread:
+            self.post('message', text=text)
+        else:
+            self.stream.write(text + '\n')
+            self.stream.flush()
+
+    def expect(self, samples):
+        """Set the number of samples the run is expected to finish"""
+        self.post('expect', samples=samples)
+
+    def started(self, sample, stage, work=None):
+        """A stage of a sample started
+        :param sample: name of the sample
+        :param stage: name of the stage
+        :param work: optional predicted core-seconds of the stage, to estimate when it finishes
+        """
+        self.post('start', sample=sample, stage=stage, work=work)
+
+    def finished(self, sample, stage, state):
+        """A stage of a sample finished, with its state e.g. 'done' or 'failed'"""
+        self.post('finish', sample=sample, stage=stage, state=state)
+
+    def completed(self, sample):
+        """Every stage of a sample finished"""
+        self.post('complete', sample=sample)
+
+    def usage(self, commands):
+        """Resources of the running commands
+        :param commands: list of (sample, cpu %, resident bytes, cores leased) of every running command
+        """
+        if self.thread and self.live:
+            self.post('usage', commands=commands)
+
+    def post(self, event, **fields):
+        if self.thread:
+            self.events.put((time.time(), event, fields))
+
+    def apply(self, now, event, fields):
+        """Update the board with an event"""
+        if event == 'message':
+            self.pending.append(fields['text'])
+        elif event == 'expect':
+            self.expected = fields['samples']
+        elif event == 'start':
+            row = self.rows.setdefault(fields['sample'], {'start': now, 'stages': {}, 'cpu': 0.0, 'rss': 0, 'cores': 0})
+            row['stages'][fields['stage']] = (now, fields['work'])
+        elif event == 'finish':
+            row = self.rows.get(fields['sample'])
+            start = row['stages'].pop(fields['stage'], (now, None))[0] if row else now
+            self.stages += 1
+            if row and not row['stages']:
+                del self.rows[fields['sample']]
+            if not self.live:
+                self.pending.append('[{}] {}: {} {} in {}. {}'.format(time.strftime('%H:%M:%S'), fields['sample'],
+                                                                       fields['stage'], fields['state'],
+                                                                       hms(now - start), self.summary(now)))
+        elif event == 'complete':
+            self.completions += 1
+        elif event == 'usage':
+            for row in self.rows.values():
+                row['cpu'], row['rss'], row['cores'] = 0.0, 0, 0
+            for sample, cpu, rss, cores in fields['commands']:
+                if sample in self.rows:
+                    row = self.rows[sample]
+                    row['cpu'], row['rss'], row['cores'] = row['cpu'] + cpu, row['rss'] + rss, row['cores'] + cores
+
+    def summary(self, now):
+        """Number of samples finished, and the samples finished per hour since the board was started. Workers of a
+        queue are not told the samples of the run, and count the stages they finished instead"""
+        hours = max((now - self.begin) / 3600.0, 1e-6)
+        if not self.expected:
+            return '{} stages finished, {:.1f} stages/hour'.format(self.stages, self.stages / hours)
+        return '{} of {} samples finished, {:.1f} samples/hour'.format(self.completions, self.expected,
+                                                                        self.completions / hours)
+
+    def board(self, now):
+        """Lines of the board"""
+        lines = ['{:<30} {:<24} {:>9} {:>9} {:>6} {:>9}'.format('Sample', 'Stages', 'Elapsed', 'ETA', 'CPU%', 'RSS')]
+        for sample in sorted(self.rows, key=lambda x: self.rows[x]['start']):
+            row = self.rows[sample]
+            # A stage is predicted to take its core-seconds over the cores leased by its commands
+            remaining = [work / max(1, row['cores']) - (now - start) for start, work in row['stages'].values()
+                         if work and row['cores']]
+            lines.append('{:<30} {:<24} {:>9} {:>9} {:>5.0f}% {:>6.1f} GB'.format(
+                sample[:30], ','.join(sorted(row['stages']))[:24], hms(now - row['start']),
+                hms(max(remaining)) if remaining else '-', row['cpu'], row['rss'] / 1024.0 ** 3))
+        lines.append(self.summary(now))
+        return lines
+
+    def draw(self):
+        """Write the pending messages, and redraw the board below them on a terminal"""
+        output = []
+        if self.live and self.drawn:
+            # Move to the first line of the board, and clear it to the end of the screen
+            output.append('\033[{}A\r\033[J'.format(self.drawn))
+        output.extend(text + '\n' for text in self.pending)
+        self.pending = []
+        if self.live:
+            lines = self.board(time.time())
+            output.extend(line + '\n' for line in lines)
+            self.drawn = len(lines)
+        self.stream.write(''.join(output))
+        self.stream.flush()
+
+    def render(self):
+        """Apply the events as they arrive, and draw the board once for the events that arrived together"""
+        while True:
+            events = [self.events.get()]
+            try:
+                while True:
+                    events.append(self.events.get_nowait())
+            except Empty:
+                pass
+            for now, event, fields in events:
+                if event == 'stop':
+                    self.draw()
+                    return
+                self.apply(now, event, fields)
+            self.draw()
+
+    def start(self, stream=None):
+        """Start drawing the board
+        :param stream: output to draw the board to. Defaults to the standard output. The board is only drawn on a
+        terminal, other outputs are written a plain log
+        """
+        self.stream = stream if stream else sys.stdout
+        self.live = self.stream.isatty() and os.environ.get('TERM', 'dumb') != 'dumb'
+        self.begin = time.time()
+        self.thread = Thread(target=self.render)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Write the messages that are still pending, and stop drawing the board"""
+        if self.thread:
+            self.post('stop')
+            self.thread.join(5)
+            self.thread = None
+
+    def __init__(self):
+        self.stream = sys.stdout
+        self.live = False
+        self.thread = None
+        self.events = Queue()
+        self.begin = time.time()
+        # Running samples: name: start, running stages and their (start, predicted core-seconds), and the cpu %,
+        # resident memory and cores of their commands
+        self.rows = dict()
+        # Messages to write above the board, the number of lines of the board on the terminal, the samples expected
+        # and finished, and the stages finished
+        self.pending = []
+        self.drawn = 0
+        self.expected = 0
+        self.completions = 0
+        self.stages = 0
+
+
+# Single board for the progress of the pipeline
+board = ProgressBoard()
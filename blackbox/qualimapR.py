@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 from accessoryFunctions import *
 from bowtie import *
+from profiles import settings
+from stageCache import StageCache
+from tools import ToolRegistry
 from Bio.Sequencing.Applications import SamtoolsViewCommandline, SamtoolsSortCommandline
 
 try:
@@ -12,138 +15,135 @@ __author__ = 'mike knowles'
 
 class QualiMap(object):
     def __init__(self, inputobject):
-        from Queue import Queue
-        self.bowversion = Bowtie2CommandLine(version=True)()[0].split('\n')[0].split()[-1]
-        self.samversion = get_version(['samtools', '--version']).split('\n')[0].split()[1]
-        self.version = get_version(['qualimap', '--help']).split('\n')[3].split()[1]
+        self.bowversion = inputobject.tools.version('bowtie2')
+        self.samversion = inputobject.tools.version('samtools')
+        self.version = inputobject.tools.version('qualimap')
         self.metadata = inputobject.runmetadata.samples
         self.start = inputobject.starttime
-        self.threads = inputobject.cpus
+        self.allocator = inputobject.allocator
+        self.cache = inputobject.cache
         self.path = inputobject.path
-        self.bowqueue = Queue()
-        self.qqueue = Queue()
+
+    def __call__(self):
+        """Exectute Bowtie2, SAMtools and Qualimap on call"""
         printtime('Aligning reads with Bowtie2 {} for Qualimap'.format(self.bowversion.split(",")[0]), self.start)
-        self.bowtie()
+        # Map the reads of each sample in the pool
+        with WorkerPool(self.allocator.cores) as pool:
+            pool.map(self.run, self.metadata)
 
-    def bowtie(self):
-        from threading import Thread
-        for i in range(len([sample.general for sample in self.metadata if sample.general.bestassemblyfile])):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.align, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        reads = (('CorrectedLeftReads', 'm1'), ('CorrectedRightReads', 'm2'), ('CorrectedSingleReads', 'U'))
-        for sample in self.metadata:
-            main = lambda (x, y): (y, ",".join(getattr(sample.general, x))) if hasattr(sample.general, x) else None
-            # Initialise the bowtie command and version
-            sample.software.Bowtie2 = self.bowversion
-            sample.software.SAMtools = self.samversion
-            sagen = sample.general
-            if sagen.bestassemblyfile != "NA":
-                sagen.QualimapResults = '{}/qualimap_results'.format(sagen.outputdirectory)
-                make_path(sagen.QualimapResults)
-                sagen.bowtie2results = os.path.join(sagen.QualimapResults, sample.name)
-                # Use fancy new bowtie2 wrapper
-                sample.commands.Bowtie2Build = Bowtie2BuildCommandLine(reference=sagen.bestassemblyfile,
-                                                                       bt2=sagen.bowtie2results)
-                sample.mapping.BamFile = sagen.bowtie2results + ".sorted.bam"
-                # SAMtools sort v1.3 has different run parameters
-                if self.samversion < "1.3":
-                    samsort = SamtoolsSortCommandline(input_bam="-", out_prefix=sample.mapping.BamFile)
-                else:
-                    samsort = SamtoolsSortCommandline(input_bam=sample.mapping.BamFile, o=True, out_prefix="-")
-                samtools = [SamtoolsViewCommandline(b=True, S=True, input_file="-"), samsort]
-                indict = dict([(y, ",".join(getattr(sagen, x))) for x, y in reads if hasattr(sagen, x)])
-                sample.commands.Bowtie2Align = Bowtie2CommandLine(bt2=sagen.bowtie2results,
-                                                                  threads=self.threads,
-                                                                  samtools=samtools,
-                                                                  **indict)
-                self.bowqueue.put(sample)
+    def run(self, sample):
+        """Map the corrected reads of a single sample to its assembly, and run Qualimap on the sorted BAM file"""
+        # Reserve the default 1200 MB java heap of Qualimap along with the overhead of the JVM
+        with self.allocator.lease('qualimap', memory=1536 * 1024 ** 2) as lease:
+            self.bowtie(sample, lease.cores)
+            if sample.general.bestassemblyfile != "NA":
+                self.align(sample)
+                self.qualimap(sample, lease.cores)
             else:
-                sample.commands.Bowtie2Align = "NA"
-                sample.commands.Bowtie2Build = "NA"
-                sample.commands.SAMtools = "NA"
-        self.bowqueue.join()
+                sample.commands.Qualimap = "NA"
 
-    def align(self):
-        while True:
-            sample = self.bowqueue.get()
-            if not os.path.isfile(sample.mapping.BamFile) and sample.general.bestassemblyfile != 'NA':
-                stdout = StringIO()
-                for func in sample.commands.Bowtie2Build, sample.commands.Bowtie2Align:
-                    stdout.close()
-                    # Use cStringIO streams to handle bowtie output
-                    stdout, stderr = map(StringIO, func(cwd=sample.general.QualimapResults))
-                    if stderr:
-                        # Write the standard error to log, bowtie2 puts alignmentsummary here
-                        with open(os.path.join(sample.general.QualimapResults, "bowtie_samtools.log"), "ab+") as log:
-                            log.writelines(logstr(func, stderr.getvalue(), stdout.getvalue()))
-                    stderr.close()
-                    # stdout will be the SAM file from alignment
-            # For different alignment
-            sam = sample.general.bowtie2results + ".sam"
-            if os.path.isfile(sam):
-                # PIPE stdout to stdin of samtools view then sort (only outputing sorted bam)
-                # SAMtools sort v1.3 has different run parameters
-                if self.samversion < "1.3":
-                    samsort = SamtoolsSortCommandline(input_bam="-", out_prefix=sample.mapping.BamFile[:-4])
-                else:
-                    samsort = SamtoolsSortCommandline(input_bam=sample.mapping.BamFile, o=True, out_prefix="-")
-                # Use cStringIO streams to handle bowtie output
-                stdout = StringIO()
-                for func in [SamtoolsViewCommandline(b=True, S=True, input_file=sample.mapping.BamFile), samsort]:
-                    # Use closing contextmanager for handle __exit__() as close()
-                    stdout, stderr = map(StringIO, func(stdin=stdout.getvalue()))
-                    # Write the standard error to log
-                    with open(os.path.join(sample.general.QualimapResults, "samtools.log"), "ab+") as log:
-                        log.writelines(logstr(func, stderr.getvalue()))
-                    stderr.close()
-                stdout.close()
-            # Signal to the queue that the job is done
-            self.bowqueue.task_done()
+    def bowtie(self, sample, threads):
+        """Create the Bowtie2 and SAMtools system calls for a single sample
+        :param sample: sample metadata object
+        :param threads: number of threads granted to Bowtie2
+        """
+        reads = (('CorrectedLeftReads', 'm1'), ('CorrectedRightReads', 'm2'), ('CorrectedSingleReads', 'U'))
+        # Initialise the bowtie command and version
+        sample.software.Bowtie2 = self.bowversion
+        sample.software.SAMtools = self.samversion
+        sagen = sample.general
+        if sagen.bestassemblyfile != "NA":
+            sagen.QualimapResults = '{}/qualimap_results'.format(sagen.outputdirectory)
+            make_path(sagen.QualimapResults)
+            sagen.bowtie2results = os.path.join(sagen.QualimapResults, sample.name)
+            # Use fancy new bowtie2 wrapper
+            sample.commands.Bowtie2Build = Bowtie2BuildCommandLine(reference=sagen.bestassemblyfile,
+                                                                   bt2=sagen.bowtie2results)
+            sample.mapping.BamFile = sagen.bowtie2results + ".sorted.bam"
+            # SAMtools sort v1.3 has different run parameters
+            if self.samversion < "1.3":
+                samsort = SamtoolsSortCommandline(input_bam="-", out_prefix=sample.mapping.BamFile)
+            else:
+                samsort = SamtoolsSortCommandline(input_bam=sample.mapping.BamFile, o=True, out_prefix="-")
+            samtools = [SamtoolsViewCommandline(b=True, S=True, input_file="-"), samsort]
+            indict = dict([(y, ",".join(getattr(sagen, x))) for x, y in reads if hasattr(sagen, x)])
+            # Profiles may map only the first reads, which is enough for the insert size and error rate, though the
+            # coverage is then that of the mapped reads
+            if settings(sample)['reads']:
+                indict['qupto'] = int(settings(sample)['reads'])
+            sample.commands.Bowtie2Align = Bowtie2CommandLine(bt2=sagen.bowtie2results,
+                                                              threads=threads,
+                                                              samtools=samtools,
+                                                              **indict)
+        else:
+            sample.commands.Bowtie2Align = "NA"
+            sample.commands.Bowtie2Build = "NA"
+            sample.commands.SAMtools = "NA"
 
-    def __call__(self):
-        """Exectute Qualimap on call"""
-        from threading import Thread
-        printtime('Reading BAM file for Qualimap output', self.start)
-        for i in range(len([sample.general for sample in self.metadata if sample.general.bestassemblyfile != "NA"])):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.mapper, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.metadata:
-            if sample.general.bestassemblyfile != "NA":
-                sample.software.Qualimap = self.version
-                sample.commands.Qualimap = 'qualimap bamqc -bam {} -outdir {}'. \
-                    format(sample.mapping.BamFile, sample.general.QualimapResults)
-                self.qqueue.put(sample)
+    def align(self, sample):
+        """Build the Bowtie2 index, and map the reads to create a sorted BAM file"""
+        if sample.general.bestassemblyfile != 'NA':
+            sagen = sample.general
+            # The assembly and the corrected reads are the inputs of the alignment
+            reads = [read for x in ('CorrectedLeftReads', 'CorrectedRightReads', 'CorrectedSingleReads')
+                     if hasattr(sagen, x) for read in getattr(sagen, x)]
+            command = '{} && {}'.format(sample.commands.Bowtie2Build, sample.commands.Bowtie2Align)
+            # Map the reads unless the sorted BAM file of the same assembly and reads is current or cached
+            self.cache.run(sample, 'bowtie2', lambda: self.bowtie2(sample), [sagen.bestassemblyfile] + reads, command,
+                           '{} {}'.format(self.bowversion, self.samversion), sagen.QualimapResults,
+                           [os.path.basename(sample.mapping.BamFile)], ['bowtie_samtools.log'])
+        # For different alignment
+        sam = sample.general.bowtie2results + ".sam"
+        if os.path.isfile(sam):
+            # PIPE stdout to stdin of samtools view then sort (only outputing sorted bam)
+            # SAMtools sort v1.3 has different run parameters
+            if self.samversion < "1.3":
+                samsort = SamtoolsSortCommandline(input_bam="-", out_prefix=sample.mapping.BamFile[:-4])
             else:
-                sample.commands.Qualimap = "NA"
-        self.qqueue.join()
+                samsort = SamtoolsSortCommandline(input_bam=sample.mapping.BamFile, o=True, out_prefix="-")
+            # Use cStringIO streams to handle bowtie output
+            stdout = StringIO()
+            for func in [SamtoolsViewCommandline(b=True, S=True, input_file=sample.mapping.BamFile), samsort]:
+                # Use closing contextmanager for handle __exit__() as close()
+                stdout, stderr = map(StringIO, func(stdin=stdout.getvalue()))
+                # Write the standard error to log
+                with open(os.path.join(sample.general.QualimapResults, "samtools.log"), "ab+") as log:
+                    log.writelines(logstr(func, stderr.getvalue()))
+                stderr.close()
+            stdout.close()
 
-    def mapper(self):
-        while True:
-            sample = self.qqueue.get()
-            if sample.general.bestassemblyfile != "NA":
-                log = os.path.join(sample.general.QualimapResults, "qualimap.log")
-                reportfile = os.path.join(sample.general.QualimapResults, 'genome_results.txt')
-                if not os.path.isfile(reportfile):
-                    execute(sample.commands.Qualimap, log)
-                qdict = dict()
-                if os.path.isfile(reportfile):
-                    with open(reportfile) as report:
-                        for line in report:
-                            key, value = self.analyze(line)
-                            if all((key, value)):
-                                qdict[key] = value
-                if qdict:
-                    # Make new category for Qualimap results
-                    setattr(sample, "mapping", GenObject(qdict))
-            self.qqueue.task_done()
+    @staticmethod
+    def bowtie2(sample):
+        """Run the Bowtie2 index and alignment commands of a single sample"""
+        log = os.path.join(sample.general.QualimapResults, "bowtie_samtools.log")
+        for func in sample.commands.Bowtie2Build, sample.commands.Bowtie2Align:
+            with open(log, "ab+") as handle:
+                handle.writelines(logstr(func))
+            # Write the standard error to log, bowtie2 puts alignmentsummary here. SAMtools writes the sorted BAM file
+            execute(str(func), log, sample=sample, key='bowtie2', shell=True, cwd=sample.general.QualimapResults)
+
+    def qualimap(self, sample, threads):
+        """Run Qualimap on the sorted BAM file, and parse the report"""
+        sample.software.Qualimap = self.version
+        sample.commands.Qualimap = 'qualimap bamqc -bam {} -outdir {} -nt {}'. \
+            format(sample.mapping.BamFile, sample.general.QualimapResults, threads)
+        log = os.path.join(sample.general.QualimapResults, "qualimap.log")
+        reportfile = os.path.join(sample.general.QualimapResults, 'genome_results.txt')
+        # Run Qualimap unless the report of the same BAM file is current or cached
+        self.cache.run(sample, 'qualimap', lambda: execute(sample.commands.Qualimap, log, sample, 'qualimap'),
+                       [sample.mapping.BamFile], sample.commands.Qualimap, self.version, sample.general.QualimapResults,
+                       [os.path.basename(reportfile)], ['qualimapReport.html', 'css', 'images_qualimapReport',
+                                                        'raw_data_qualimapReport', os.path.basename(log)])
+        qdict = dict()
+        if os.path.isfile(reportfile):
+            with open(reportfile) as report:
+                for line in report:
+                    key, value = self.analyze(line)
+                    if all((key, value)):
+                        qdict[key] = value
+        if qdict:
+            # Make new category for Qualimap results
+            setattr(sample, "mapping", GenObject(qdict))
 
     @staticmethod
     def analyze(line):
@@ -168,6 +168,9 @@ if __name__ == '__main__':
     metadata.samples = [GenObject({'name': '2015-SEQ-1283'})]
     # metadata.cpus = cpu_count()
     metadata.cpus = 4
+    metadata.allocator = ResourceAllocator(metadata.cpus)
+    metadata.cache = StageCache()
+    metadata.tools = ToolRegistry()
     metadata.starttime = time()
     metadata.runmetadata.samples = MetadataReader(metadata).samples
     QualiMap(metadata)()
@@ -1,190 +1,204 @@
 #!/usr/bin/env python
+import json
 import os
-from threading import Thread
-from Queue import Queue
-import time
+import re
 from accessoryFunctions import *
+from profiles import settings
 
 __author__ = 'adamkoziol,mikeknowles'
 
 
 class Quality(object):
-    def fastqcthreader(self, level):
-        printtime('Running quality control on {} fastq files'.format(level), self.start)
-        version = get_version(['fastqc', '-v']).rstrip()
-        for sample in self.metadata:
-            if type(sample.general.fastqfiles) is list:
-                # Create and start threads for each fasta file in the list
-                # Send the threads to bbduker. :args is empty as I'm using
-                threads = Thread(target=self.fastqc, args=())
-                # Set the daemon to true - something to do with thread management
-                threads.setDaemon(True)
-                # Start the threading
-                threads.start()
-        # Iterate through strains with fastq files to set variables to add to the multithreading queue
-        for sample in self.metadata:
-            fastqccall = ""
-            # Check to see if the fastq files exist
-            if level == 'Trimmed':
-                # Try except loop to allow for missing samples
-                try:
-                    fastqfiles = sample.general.trimmedfastqfiles
-                except KeyError:
-                    fastqfiles = ""
-                    pass
-            else:
-                fastqfiles = sample.general.fastqfiles
-            # As the metadata can be populated with 'NA' (string) if there are no fastq files, only process if
-            # :fastqfiles is a list
-            if type(fastqfiles) is list:
-                # Set the output directory location
-                sample.general.FastQCoutput = os.path.join(sample.general.outputdirectory, 'fastqc')
-                outdir = '{}/fastqc/fastqc{}'.format(os.path.split(fastqfiles[0])[0], level)
+    """FastQC and bbduk on the reads of a single sample, shared by the FastQC and Trim stages"""
+
+    def fastqc(self, sample, level):
+        """Run FastQC on either the raw or the trimmed fastq files of a single sample"""
+        fastqccall = ""
+        # Check to see if the fastq files exist
+        if level == 'Trimmed':
+            # Try except loop to allow for missing samples
+            try:
+                fastqfiles = sample.general.trimmedfastqfiles
+            except KeyError:
+                fastqfiles = ""
+                pass
+        else:
+            fastqfiles = sample.general.fastqfiles
+        # As the metadata can be populated with 'NA' (string) if there are no fastq files, only process if
+        # :fastqfiles is a list
+        if type(fastqfiles) is list:
+            # Set the output directory location
+            sample.general.FastQCoutput = os.path.join(sample.general.outputdirectory, 'fastqc')
+            outdir = '{}/fastqc/fastqc{}'.format(os.path.split(fastqfiles[0])[0], level)
+            # FastQC processes one file per thread, and each thread uses 250 MB of memory
+            with self.allocator.lease('fastqc', maxcores=len(fastqfiles),
+                                      memory=len(fastqfiles) * 250 * 1024 ** 2) as lease:
                 # Separate system calls for paired and unpaired fastq files
                 if len(fastqfiles) == 2:
                     # Call fastqc with -q (quiet), -o (output directory), -d (where to store temp files) flags, and
                     # -t (number of threads) flags
-                    fastqccall = "fastqc {} {} -q -o {} -t 12 --extract".format(fastqfiles[0], fastqfiles[1], outdir)
+                    fastqccall = "fastqc {} {} -q -o {} -t {} --extract".format(fastqfiles[0], fastqfiles[1], outdir,
+                                                                                lease.cores)
                 elif len(fastqfiles) == 1:
-                    fastqccall = "fastqc {} -q -o {} -t 12 --extract".format(fastqfiles[0], outdir)
-                # Record FastQC commands
-                sample.commands.FastQC = fastqccall
+                    fastqccall = "fastqc {} -q -o {} -t {} --extract".format(fastqfiles[0], outdir, lease.cores)
+                # Record FastQC commands. The raw and trimmed reads are checked by stages that may run at the same
+                # time, so each level is recorded under a key of its own
+                setattr(sample.commands, 'FastQC' + level, fastqccall)
                 # Record FastQC version
-                sample.software.FastQC = version
-                # Add the arguments to the queue
-                fastqfile = os.path.basename(fastqfiles[0]).split('.')[0]
-                fastqcfolder = os.path.join(outdir, fastqfile + '_fastqc')
-                self.qcqueue.put((fastqccall, fastqcfolder, outdir))
-        # Wait on the trimqueue until everything has been processed
-        self.qcqueue.join()
-        self.qcqueue = Queue()
-
-    def fastqc(self):
-        """Run fastqc system calls"""
-        from accessoryFunctions import make_path
-        while True:  # while daemon
-            # Unpack the variables from the queue
-            (systemcall, fastqcfolder, outputdir) = self.qcqueue.get()
-            # Check to see if the output directory already exists
-            if not os.path.isdir(fastqcfolder):
+                sample.software.FastQC = self.fastqcversion
+                # FastQC creates a folder, a zip file and a report for each fastq file
+                reports = [os.path.basename(fastq).split('.')[0] + '_fastqc' for fastq in fastqfiles]
                 # Make the output directory
-                make_path(outputdir)
-                # Run the system call
-                execute(systemcall)
-                # call(systemcall, shell=True, stdout=devnull, stderr=devnull)
-            # Signal to qcqueue that job is done
-            self.qcqueue.task_done()
-
-    def trimquality(self):
-        """Uses bbduk from the bbmap tool suite to quality and adapter trim"""
-        version = get_version(['bbduk.sh', '-version']).split('\n')[-3].split()[-1]
+                make_path(outdir)
+                # Run the system call unless the reports of the same reads are current or cached
+                self.cache.run(sample, 'fastqc' + level,
+                               lambda: execute(fastqccall, sample=sample, key='fastqc' + level), fastqfiles,
+                               fastqccall, self.fastqcversion, outdir, reports,
+                               [report + extension for report in reports for extension in ('.zip', '.html')])
+
+    def trimsample(self, sample):
+        """Quality and adapter trim a single sample with bbduk, run FastQC on the trimmed reads, and re-trim the reads
+        if the FastQC report shows excess variation at the ends of the reads. Profiles without retrim only trim once"""
         from glob import glob
-        print "\r[{:}] Trimming fastq files".format(time.strftime("%H:%M:%S"))
-        # Create and start threads for each strain with fastq files
-        for sample in self.metadata:
-            if type(sample.general.fastqfiles) is list:
-                # Create and start threads for each fasta file in the list
-                # Send the threads to bbduker. :args is empty as I'm using
-                threads = Thread(target=self.bbduker, args=())
-                # Set the daemon to true - something to do with thread management
-                threads.setDaemon(True)
-                # Start the threading
-                threads.start()
-        # Iterate through strains with fastq files to set variables to add to the multithreading queue
-        for sample in self.metadata:
-            # As the metadata can be populated with 'NA' (string) if there are no fastq files, only process if
-            # :fastqfiles is a list
-            if type(sample.general.fastqfiles) is list:
-                # Check to see if the fastq files exist
-                fastqfiles = sorted(sample.general.fastqfiles)
-                # Define the output directory
-                outputdir = sample.general.outputdirectory
-                # Define the name of the forward trimmed fastq file
-                fastqfiles.append('{}/{}_R1_trimmed.fastq'.format(outputdir, sample.name))
-                # Separate system calls for paired and unpaired fastq files
-                bbdukcall = "bbduk.sh -Xmx1g qtrim=w trimq=25 ktrim=r minlength=50 ftl=10" \
-                            " k=25 mink=11 ref={}/resources/adapters.fa hdist=1 ".format(self.bbduklocation)
-                # http://seqanswers.com/forums/showthread.php?t=42776
-                if len(sample.general.fastqfiles) == 2:
-                    fastqfiles.append('{}/{}_R2_trimmed.fastq'.format(outputdir, sample.name))
-                    bbdukcall += "in1={} in2={} out1={} out2={} tpe tbo".format(*fastqfiles)
-                elif len(sample.general.fastqfiles) == 1:
-                    bbdukcall += "in={} out={}".format(*fastqfiles)
-                else:
-                    bbdukcall = ""
-                # Record bbMap commands
-                sample.commands.bbduk = bbdukcall if bbdukcall else "NA"
-                # Record FastQC version
-                sample.software.bbduk = version
-                # Add the arguments to the queue
-                self.trimqueue.put((bbdukcall, fastqfiles[2]))
-        # Wait on the trimqueue until everything has been processed
-        self.trimqueue.join()
-        # Add all the trimmed files to the metadata
-        for sample in self.metadata:
-            # Define the output directory
-            outputdir = sample.general.outputdirectory
-            # Add the trimmed fastq files to a list
-            trimmedfastqfiles = glob('{}/*trimmed.fastq'.format(outputdir, sample.name))
-            # Populate the metadata if the files exist
-            sample.general.trimmedfastqfiles = trimmedfastqfiles if trimmedfastqfiles else 'NA'
-        print "\r[{:}] Fastq files trimmed".format(time.strftime("%H:%M:%S"))
-        self.fastqcthreader('Trimmed')
         import shutil
-        printtime('Performing secondary trimming', self.start)
-        print "\r[{:}] Trimming fastq files".format(time.strftime("%H:%M:%S"))
-        for sample in self.metadata:
-            m = int(sample.run.forwardlength) - 50
-            if sample.general.trimmedfastqfiles != 'NA':
-                bbcall = sample.commands.bbduk
-                for fastq in sample.general.trimmedfastqfiles:
-                    folder = os.path.join(sample.general.FastQCoutput,
-                                          "fastqcTrimmed",
-                                          os.path.splitext(os.path.basename(fastq))[0] + '_fastqc')
-                    with open(os.path.join(folder, 'fastqc_data.txt')) as summary:
-                        newm = maxcut(summary, int(sample.run.forwardlength)) + 10
-                    m = newm if newm < m else m
-                    if m < (int(sample.run.forwardlength) - 50) and not os.path.isdir("{0:s}_fail".format(folder)):
-                        shutil.move(folder, "{0:s}_fail".format(folder))
-                        if 'ftr' not in sample.commands.bbduk:
-                            bbcall = bbcall.replace('ftl=10', 'ftl=10 ftr=' + str(m))
-                        else:
-                            import re
-                            bbcall = re.sub('ftr=\d+', 'ftr=' + str(m), bbcall)
-                if sample.commands.bbduk != bbcall:
-                    bbcall = bbcall.replace('hdist=1', 'hdist=2')
+        # Define the output directory
+        outputdir = sample.general.outputdirectory
+        # Create and run the bbduk system call
+        first, retrimmed = self.bbduk(sample)
+        # Add all the trimmed files to the metadata
+        trimmedfastqfiles = sorted(glob('{}/*trimmed.fastq'.format(outputdir)))
+        # Populate the metadata if the files exist
+        sample.general.trimmedfastqfiles = trimmedfastqfiles if trimmedfastqfiles else 'NA'
+        profile = settings(sample)
+        if not profile['retrim']:
+            return
+        self.fastqc(sample, 'Trimmed')
+        if retrimmed:
+            return
+        # Perform secondary trimming
+        m = int(sample.run.forwardlength) - 50
+        if sample.general.trimmedfastqfiles != 'NA':
+            bbcall = sample.commands.bbduk
+            for fastq in sample.general.trimmedfastqfiles:
+                folder = os.path.join(sample.general.FastQCoutput,
+                                      "fastqcTrimmed",
+                                      os.path.splitext(os.path.basename(fastq))[0] + '_fastqc')
+                with open(os.path.join(folder, 'fastqc_data.txt')) as summary:
+                    newm = maxcut(summary, int(sample.run.forwardlength)) + 10
+                m = newm if newm < m else m
+                if m < (int(sample.run.forwardlength) - 50):
+                    # Keep the report of the first pass, in place of that of an earlier run
+                    if os.path.isdir("{0:s}_fail".format(folder)):
+                        shutil.rmtree("{0:s}_fail".format(folder))
+                    shutil.move(folder, "{0:s}_fail".format(folder))
+                    if 'ftr' not in bbcall:
+                        bbcall = bbcall.replace('ftl=10', 'ftl=10 ftr=' + str(m))
+                    else:
+                        bbcall = re.sub('ftr=\d+', 'ftr=' + str(m), bbcall)
+            if sample.commands.bbduk != bbcall:
+                # Match the adapters of the second pass with up to two mismatches
+                bbcall = re.sub('hdist=\d+', 'hdist={}'.format(max(2, profile['hdist'])), bbcall)
+                with self.allocator.lease('trim', memory=self.memory(profile)) as lease:
+                    # The second pass runs with the threads of its own lease rather than those of the first pass
+                    bbcall = re.sub(r'\bt=\d+', 't={}'.format(lease.cores), bbcall)
                     sample.commands.bbduk = bbcall
-                    map(os.unlink, sample.general.trimmedfastqfiles)
-                    self.trimqueue.put((sample.commands.bbduk, sample.general.trimmedfastqfiles[0]))
+                    key = self.cache.run(sample, 'bbduk',
+                                         lambda: execute(bbcall, sample=sample, key='bbduk', shell=True),
+                                         sorted(sample.general.fastqfiles), bbcall, self.bbdukversion, outputdir,
+                                         [os.path.basename(fastq) for fastq in sample.general.trimmedfastqfiles])
+                # Record the retrim with the first pass it followed, so a later run keeps the retrimmed reads
+                with open(self.cache.stampfile(outputdir, 'retrim'), 'wb') as record:
+                    json.dump({'first': first, 'retrim': key, 'command': bbcall}, record)
+                # Run FastQC on the re-trimmed files
+                self.fastqc(sample, 'Trimmed')
+
+    def bbduk(self, sample):
+        """Create and run the bbduk system call for a single sample
+        :return: the cache key of the trimming, and True if the trimmed reads are those the same trimming was retrimmed
+        to in an earlier run
+        """
+        # Check to see if the fastq files exist
+        fastqfiles = sorted(sample.general.fastqfiles)
+        # Define the output directory
+        outputdir = sample.general.outputdirectory
+        # Define the name of the forward trimmed fastq file
+        fastqfiles.append('{}/{}_R1_trimmed.fastq'.format(outputdir, sample.name))
+        profile = settings(sample)
+        # The java heap of bbduk is reserved along with the overhead of the JVM
+        with self.allocator.lease('trim', memory=self.memory(profile)) as lease:
+            # Separate system calls for paired and unpaired fastq files
+            # The heap is given in GB when it is a whole number of GB e.g. -Xmx1g
+            heap = '{}g'.format(profile['heap'] // 1024) if not profile['heap'] % 1024 else \
+                '{}m'.format(profile['heap'])
+            bbdukcall = "bbduk.sh -Xmx{} t={} qtrim=w trimq=25 ktrim=r minlength=50 ftl=10 k=25 mink=11" \
+                        " ref={}/resources/adapters.fa hdist={} ".format(heap, lease.cores, self.bbduklocation,
+                                                                       profile['hdist'])
+            # http://seqanswers.com/forums/showthread.php?t=42776
+            if len(sample.general.fastqfiles) == 2:
+                fastqfiles.append('{}/{}_R2_trimmed.fastq'.format(outputdir, sample.name))
+                bbdukcall += "in1={} in2={} out1={} out2={} tpe tbo".format(*fastqfiles)
+            elif len(sample.general.fastqfiles) == 1:
+                bbdukcall += "in={} out={}".format(*fastqfiles)
             else:
-                self.trimqueue.put(("NA", "NA"))
-        # Wait on the trimqueue until everything has been processed
-        self.trimqueue.join()
+                bbdukcall = ""
+            # Record bbMap commands
+            sample.commands.bbduk = bbdukcall if bbdukcall else "NA"
+            # Record bbduk version
+            sample.software.bbduk = self.bbdukversion
+            if not bbdukcall:
+                return None, False
+            rawfiles = len(sample.general.fastqfiles)
+            inputs, outputs = fastqfiles[:rawfiles], [os.path.basename(fastq) for fastq in fastqfiles[rawfiles:]]
+            # Restoring the reads of this trimming would overwrite the reads it was retrimmed to in an earlier run,
+            # which are kept while they are current
+            key = self.cache.key(inputs, bbdukcall, self.bbdukversion, outputdir)
+            try:
+                with open(self.cache.stampfile(outputdir, 'retrim')) as record:
+                    retrim = json.load(record)
+            except (IOError, ValueError):
+                retrim = dict()
+            if profile['retrim'] and retrim.get('first') == key and \
+                    self.cache.current(outputdir, 'bbduk', retrim.get('retrim'), outputs):
+                sample.commands.bbduk = retrim['command']
+                self.cache.record(sample, 'bbduk', 'current')
+                return key, True
+            # Trim the reads unless the trimmed reads of the same command are current or cached
+            return self.cache.run(sample, 'bbduk', lambda: execute(bbdukcall, sample=sample, key='bbduk', shell=True),
+                                  inputs, bbdukcall, self.bbdukversion, outputdir, outputs), False
 
-        # Add all the trimmed files to the metadata
-        self.fastqcthreader('Trimmed')
+    def memory(self, profile):
+        """Bytes of memory leased by bbduk: the java heap of the profile, and the overhead of the JVM"""
+        return profile['heap'] * 1024 ** 2 + self.jvmoverhead
 
+    def __init__(self, inputobject):
+        self.trim = inputobject.trim
+        self.allocator = inputobject.allocator
+        self.cache = inputobject.cache
+        self.jvmoverhead = 512 * 1024 ** 2
+        self.fastqcversion = inputobject.tools.version('fastqc')
+        # Find the location of the bbduk.sh script. This will be used in finding the adapter file
+        self.bbduklocation = os.path.dirname(inputobject.tools.path('bbduk'))
+        self.bbdukversion = inputobject.tools.version('bbduk') if self.trim else ""
 
 
-    def bbduker(self):
-        """Run bbduk system calls"""
-        while True:  # while daemon
-            # Unpack the variables from the queue
-            (systemcall, forwardname) = self.trimqueue.get()
-            # Check to see if the forward file already exists
-            if not os.path.isfile(forwardname) and systemcall != "NA" and systemcall:
-                execute(systemcall, shell=True)
-            # Signal to trimqueue that job is done
-            self.trimqueue.task_done()
+class FastQC(object):
+    """Pipeline stage running FastQC on the raw reads of a sample"""
 
-    def __init__(self, inputobject):
-        self.metadata = inputobject.runmetadata.samples
-        self.qcqueue = Queue()
-        self.trimqueue = Queue()
-        self.correctqueue = Queue()
-        self.start = inputobject.starttime
-        # Find the location of the bbduk.sh script. This will be used in finding the adapter file
-        self.bbduklocation = os.path.dirname(which('bbduk.sh'))
+    def __init__(self, qualityobject):
+        self.quality = qualityobject
+
+    def run(self, sample):
+        self.quality.fastqc(sample, 'Raw')
+
+
+class Trim(object):
+    """Pipeline stage trimming the reads of a sample with bbduk, and running FastQC on the trimmed reads"""
+
+    def __init__(self, qualityobject):
+        self.quality = qualityobject
+
+    def run(self, sample):
+        self.quality.trimsample(sample)
 
 
 def maxcut(summary, full):
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 from accessoryFunctions import *
+from profiles import settings
+from progress import board
 import os
 import quast
 
@@ -7,59 +9,56 @@ __author__ = 'mikeknowles,akoziol'
 
 
 class Quast(object):
-    def quastprocess(self):
-        from threading import Thread
-        # Find the fasta files for each sample
-        # Only make as many threads are there are samples with fasta files
-        for i in range(len([sample.general for sample in self.metadata if sample.general.bestassemblyfile != "NA"])):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.analyze, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.metadata:
-            # Initialise the quast command and version
-            sample.software.Quast = self.version
-            if sample.general.bestassemblyfile != "NA":
-                sample.general.quastresults = '{}/quast_results'.format(sample.general.outputdirectory)
-                if os.path.isdir("{0:s}/referencegenome".format(self.path)):
-                    from glob import glob
-                    referencegenome = glob("{0:s}/referencegenome/*".format(self.path))
-                    sample.commands.Quast = "quast.py -R {0:s} --gage {1:s} -o {2:s}". \
-                        format(referencegenome[0], sample.general.bestassemblyfile, sample.general.quastresults)
-                else:
-                    sample.commands.Quast = "quast.py {0:s} -o {1:s}". \
-                        format(sample.general.bestassemblyfile, sample.general.quastresults)
-                self.qqueue.put(sample)
-            else:
-                sample.commands.Quast = "NA"
-        self.qqueue.join()
+    def __call__(self):
+        """Run QUAST on every assembled sample in a multi-threaded fashion"""
+        printtime('Running Quast {} for assembly metrics'.format(self.version.split(",")[0]), self.start)
+        # Run QUAST on each sample in the pool
+        with WorkerPool(self.allocator.cores) as pool:
+            pool.map(self.run, self.metadata)
 
-    def analyze(self):
-        """Run the quast command in a multi-threaded fashion"""
-        while True:
-            sample = self.qqueue.get()
-            if sample.general.bestassemblyfile != 'NA' \
-                    and not os.path.isfile('{}/report.tsv'.format(sample.general.quastresults)):
-                log = os.path.join(sample.general.quastresults, 'stdout.log')
-                # sys.stdout, sys.stderr = out, err
-                execute(sample.commands.Quast)
+    def run(self, sample):
+        """Create and run the quast command for a single sample, and parse the results"""
+        # Initialise the quast command and version
+        sample.software.Quast = self.version
+        if sample.general.bestassemblyfile != "NA":
+            sample.general.quastresults = '{}/quast_results'.format(sample.general.outputdirectory)
+            inputs = [sample.general.bestassemblyfile]
+            if os.path.isdir("{0:s}/referencegenome".format(self.path)):
+                from glob import glob
+                referencegenome = glob("{0:s}/referencegenome/*".format(self.path))
+                inputs.append(referencegenome[0])
+                # The GAGE metrics are only computed under the profiles that ask for them
+                sample.commands.Quast = "quast.py -R {0:s} {1:s}{2:s} -o {3:s}". \
+                    format(referencegenome[0], '--gage ' if settings(sample)['gage'] else '',
+                           sample.general.bestassemblyfile, sample.general.quastresults)
+            else:
+                sample.commands.Quast = "quast.py {0:s} -o {1:s}". \
+                    format(sample.general.bestassemblyfile, sample.general.quastresults)
+            # Run QUAST unless the report of the same assembly is current or cached
+            self.cache.run(sample, 'quast', lambda: self.quast(sample), inputs, sample.commands.Quast, self.version,
+                           sample.general.quastresults, ['report.tsv'], '*')
             if os.path.isfile('{}/report.tsv'.format(sample.general.quastresults)):
                 self.metaparse(sample)
-            # Signal to the queue that the job is done
-            self.qqueue.task_done()
+        else:
+            sample.commands.Quast = "NA"
+
+    def quast(self, sample):
+        """Run the quast command of a single sample with the granted threads"""
+        with self.allocator.lease('quast', memory=1024 ** 3) as lease:
+            sample.commands.Quast += " -t {}".format(lease.cores)
+            execute(sample.commands.Quast, sample=sample, key='quast')
 
     def metaparse(self, sample):
         repls = ('>=', 'Over'), ('000 Bp', 'kbp'), ('#', 'Num'), \
                 ("'", ''), ('(', ''), (')', ''), (' ', ''), ('>', 'Less'), ('Gc%', 'GC%')
         if not os.path.isfile("%s/report.tsv" % sample.general.quastresults):
-            print "There was an issue getting the metadata from {0:s}".format(sample.name)
+            board.message("There was an issue getting the metadata from {0:s}".format(sample.name))
         else:
             quast = dict()
+            # A GAGE report left by an earlier run with --gage is not read
             resfile = "{0:s}/gage_report.tsv".format(sample.general.quastresults) \
-                if os.path.isfile("{0:s}/gage_report.tsv".format(sample.general.quastresults)) \
-                else "{0:s}/report.tsv".format(sample.general.quastresults)
+                if os.path.isfile("{0:s}/gage_report.tsv".format(sample.general.quastresults)) and \
+                '--gage' in sample.commands.Quast else "{0:s}/report.tsv".format(sample.general.quastresults)
             with open(resfile) as report:
                 report.next()
                 for line in report:
@@ -68,18 +67,14 @@ class Quast(object):
                     k, v = [reduce(lambda a, kv: a.replace(*kv), repls, s.title()) for s in line.rstrip().split('\t')]
                     quast[k] = v
             sample.assembly = GenObject(quast)
-            sample.assembly.kmers = self.kmers
+            sample.assembly.kmers = settings(sample)['kmers']
 
     def __init__(self, inputobject):
-        from Queue import Queue
         # Find quast version
         from libs.qconfig import quast_version
         self.version = quast_version()
         self.metadata = inputobject.runmetadata.samples
         self.start = inputobject.starttime
-        self.kmers = inputobject.kmers
-        self.threads = inputobject.cpus
+        self.allocator = inputobject.allocator
+        self.cache = inputobject.cache
         self.path = inputobject.path
-        self.qqueue = Queue()
-        printtime('Running Quast {} for assembly metrics'.format(self.version.split(",")[0]), self.start)
-        self.quastprocess()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+from accessoryFunctions import printtime, priority, rank, StalledError, stagetimer, WorkerPool
+from profiler import StageProfiler
+from progress import board
+from threading import Condition
+import traceback
+
+__author__ = 'mike knowles'
+
+
+class Stage(object):
+    """A pipeline step that is run once per sample"""
+
+    def __init__(self, name, setup, requires=(), condition=None, tools=()):
+        """
+        :param name: name of the stage e.g. 'spades'
+        :param setup: callable that returns the stage object. The object must have a run(sample) method
+        :param requires: names of the stages that must be finished for a sample before this stage can start
+        :param condition: optional callable that receives the sample, and returns False if the stage should be skipped
+        :param tools: names of the tools in the ToolRegistry that the stage runs
+        """
+        self.name = name
+        self.setup = setup
+        self.requires = list(requires)
+        self.condition = condition if condition else lambda sample: True
+        self.tools = list(tools)
+        self.runner = None
+
+
+class Scheduler(object):
+    """Dependency-graph scheduler where each (sample, stage) is a node. A node starts as soon as the stages it requires
+    are finished for its own sample, so a slow sample does not hold back the remaining samples. The most urgent samples
+    are started first, and within a priority class the samples predicted to finish soonest, which minimises the mean
+    time to the results of a sample"""
+
+    # Node states, and the outcome of a node whose command was killed for making no progress
+    pending, running, done, skipped, failed = 'pending', 'running', 'done', 'skipped', 'failed'
+    stalled = 'stalled'
+    # Number of times a node is run again after its command stalled, before it fails
+    retries = 1
+
+    def resolve(self, selection):
+        """Find the stages to run from the selection, adding any stages that are required by the selected stages
+        :param selection: list of stage names
+        :return: list of stage names in the order that the stages were registered
+        """
+        resolved = set()
+
+        def visit(name):
+            assert name in self.stages, u'Unknown stage {0!r:s}. Choose from: {1:s}' \
+                .format(name, ", ".join(self.order))
+            if name not in resolved:
+                resolved.add(name)
+                for requirement in self.stages[name].requires:
+                    visit(requirement)
+        for stage in selection:
+            visit(stage)
+        return [name for name in self.order if name in resolved]
+
+    def ready(self):
+        """Find the pending nodes whose required stages are finished"""
+        for node in self.nodes:
+            sample, stage = node
+            if self.state[node] == self.pending:
+                states = [self.state[(sample, requirement)] for requirement in self.stages[stage].requires
+                          if (sample, requirement) in self.state]
+                if self.failed in states:
+                    # Propagate failures to the downstream stages of the sample
+                    self.leave(node, self.failed)
+                    printtime('{}: {} not run as a required stage failed'.format(self.samples[sample].name, stage),
+                              self.start)
+                elif all(state in (self.done, self.skipped) for state in states):
+                    yield node
+
+    def leave(self, node, state):
+        """Move a node out of the pending state"""
+        self.state[node] = state
+        if self.allocator:
+            # The node is no longer waiting for resources
+            self.allocator.demand(node[1], -1)
+        self.record(node, state)
+
+    def record(self, node, state, error=None):
+        """Record the transition of a node in the journal"""
+        sample, stage = node
+        if self.journal:
+            # The metadata of the sample are only recorded once no other stage of the sample is modifying them
+            idle = not any(self.state[(sample, other)] == self.running for other in self.selected)
+            self.journal.transition(self.samples[sample], stage, state, error, snapshot=idle)
+        if state not in (self.pending, self.running) and \
+                all(self.state[(sample, other)] not in (self.pending, self.running) for other in self.selected):
+            # Every stage of the sample is finished
+            board.completed(self.samples[sample].name)
+
+    def key(self, node):
+        """Key that orders the nodes by the priority class, then the predicted runtime of their samples"""
+        return self.ranks[node[0]], self.estimates[node[0]]
+
+    def plan(self):
+        """Simulate the rest of the run with the core-seconds predicted by the runtime model. Nodes are started in the
+        order of the dispatcher once the stages they require are finished and a core is free, with the share of the
+        free cores the allocator would grant them, and run for their core-seconds divided by their cores. Memory is not
+        simulated, every stage is assumed to run, and stages that were never run before take no time
+        :return: dictionary of node: (start, end) in seconds from now
+        """
+        import heapq
+        cores = self.allocator.cores if self.allocator else self.jobs
+        state = dict(self.state)
+        pending = [node for node in self.nodes if state[node] == self.pending]
+        free, now, spans, running = cores, 0.0, dict(), []
+        while pending:
+            ready = sorted([node for node in pending if all(state.get((node[0], requirement), self.done) in
+                                                            (self.done, self.skipped)
+                                                            for requirement in self.stages[node[1]].requires)],
+                           key=self.key)
+            for node in ready:
+                if free < 1 or len(running) >= self.jobs:
+                    break
+                sample, stage = node
+                # Share the free cores with the other nodes of the stage that are waiting, as the allocator does
+                share = len([x for x in pending if x[1] == stage])
+                granted = max(1, min(free // share, (self.model.maxcores(stage) if self.model else None) or cores))
+                work = (self.model.predict(self.samples[sample], stage) if self.model else None) or 0
+                heapq.heappush(running, (now + work / granted, node, granted))
+                pending.remove(node)
+                free -= granted
+                spans[node] = (now, None)
+            if not running:
+                break
+            now, node, granted = heapq.heappop(running)
+            free += granted
+            state[node] = self.done
+            spans[node] = (spans[node][0], now)
+        for end, node, _ in running:
+            spans[node] = (spans[node][0], end)
+        return spans
+
+    def printplan(self):
+        """Print the planned start and finish of every sample, and the predicted wall time of the rest of the run"""
+        spans = self.plan()
+        hms = lambda seconds: '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600), int(seconds % 3600 // 60),
+                                                           int(seconds % 60))
+        print '{:<30} {:<8} {:>10} {:>10}  {}'.format('Sample', 'Priority', 'Start', 'Finish', 'Stages')
+        samples = sorted(set(sample for sample, _ in spans), key=lambda x: max(spans[node][1] for node in spans
+                                                                                if node[0] == x))
+        for sample in samples:
+            nodes = sorted([node for node in spans if node[0] == sample], key=lambda x: spans[x][0])
+            print '{:<30} {:<8} {:>10} {:>10}  {}'.format(
+                self.samples[sample].name, dict(self.samples[sample].general).get('priority', 'routine'),
+                hms(spans[nodes[0]][0]), hms(max(spans[node][1] for node in nodes)),
+                ', '.join('{} {}'.format(node[1], hms(spans[node][1] - spans[node][0])) for node in nodes))
+        print 'Predicted wall time: {}, mean time to the results of a sample: {}'.format(
+            hms(max([end for _, end in spans.values()] + [0])),
+            hms(sum(max(spans[node][1] for node in spans if node[0] == x) for x in samples) / max(1, len(samples))))
+        unknown = [name for name in self.selected if not self.model or self.model.maxcores(name) is None]
+        if unknown:
+            print 'Stages without previous runs, planned as taking no time: {}'.format(', '.join(unknown))
+
+    def started(self):
+        """Find the running nodes"""
+        return [node for node in self.nodes if self.state[node] == self.running]
+
+    def suspended(self):
+        """Number of jobs the allocator suspended for the jobs of more urgent samples"""
+        if not self.allocator:
+            return 0
+        with self.allocator.condition:
+            return len(self.allocator.suspended)
+
+    def worker(self, node):
+        """Run a single node, and record the outcome"""
+        sample, stage = node
+        metadata = self.samples[sample]
+        error = None
+        try:
+            with self.profiler.profile(stage), priority(metadata, self.estimates[sample]), stagetimer(metadata, stage):
+                self.stages[stage].runner.run(metadata)
+            state = self.done
+        except StalledError:
+            error = traceback.format_exc()
+            state = self.stalled
+        except Exception:
+            error = traceback.format_exc()
+            state = self.failed
+        self.finish(node, state, error)
+
+    def finish(self, node, state, error=None):
+        """Record the outcome of a node that was run on this host, or by a worker of the queue. A node whose command
+        stalled is returned to pending until it runs out of retries"""
+        if state == self.stalled:
+            self.attempts[node] = self.attempts.get(node, 0) + 1
+            if self.attempts[node] <= self.retries:
+                printtime('{}: {} stalled, and is run again\n{}'.format(self.samples[node[0]].name, node[1], error),
+                          self.start)
+                with self.condition:
+                    self.state[node] = self.pending
+                    if self.allocator:
+                        # The node is waiting for resources again
+                        self.allocator.demand(node[1], 1)
+                    self.record(node, state, error)
+                    self.active -= 1
+                    self.condition.notify()
+                board.finished(self.samples[node[0]].name, node[1], state)
+                return
+            state = self.failed
+        if state == self.failed:
+            printtime('{}: {} failed\n{}'.format(self.samples[node[0]].name, node[1], error), self.start)
+        elif state == self.done and self.model:
+            # Refine the runtime model with the runtime of the stage
+            self.model.observe(self.samples[node[0]], node[1])
+        with self.condition:
+            self.state[node] = state
+            self.record(node, state, error)
+            self.active -= 1
+            self.condition.notify()
+        board.finished(self.samples[node[0]].name, node[1], state)
+
+    def run(self):
+        """Dispatch nodes as they become ready until every node is finished"""
+        if self.journal:
+            # Record the samples, and queue the nodes that are not finished
+            self.journal.queue(self.samples, self.selected)
+        # Create the stage objects for the stages to run. With a queue, the workers create them instead
+        for name in self.selected:
+            if not self.queue:
+                with self.profiler.profile(name):
+                    self.stages[name].runner = self.stages[name].setup()
+            if self.allocator:
+                # Every sample that has not finished this stage is waiting for resources for it
+                self.allocator.demand(name, len([node for node in self.nodes
+                                                 if node[1] == name and self.state[node] == self.pending]))
+        if self.queue:
+            # Discard the jobs of a previous coordinator, and collect the results of the workers
+            self.queue.open()
+        board.expect(len(set(node[0] for node in self.nodes if self.state[node] == self.pending)))
+        try:
+            # The condition is released before the pool waits for its workers to exit. The number of running nodes is
+            # limited by the scheduler rather than the pool, as nodes of urgent samples may exceed it
+            with WorkerPool(len(self.nodes)) as pool, self.condition:
+                while any(state in (self.pending, self.running) for state in self.state.values()):
+                    # Start the nodes of the most urgent, then the shortest, samples first
+                    for node in sorted(self.ready(), key=self.key):
+                        # A node of a sample more urgent than a running node may exceed the number of jobs, as its
+                        # jobs may suspend those of the less urgent samples. The nodes beyond the number of jobs are
+                        # limited to the jobs that were suspended, and a single node that may suspend another
+                        if self.active >= self.jobs and (self.active >= self.jobs + 1 + self.suspended() or
+                                                         not any(self.ranks[sample] > self.ranks[node[0]]
+                                                                 for sample, _ in self.started())):
+                            break
+                        sample, stage = node
+                        # Skip stages that should not be run on the sample e.g. no assembly was created
+                        if not self.stages[stage].condition(self.samples[sample]):
+                            self.leave(node, self.skipped)
+                            continue
+                        self.leave(node, self.running)
+                        self.active += 1
+                        # The predicted core-seconds of the stage give its ETA on the progress board
+                        board.started(self.samples[sample].name, stage,
+                                      self.model.predict(self.samples[sample], stage) if self.model else None)
+                        if self.queue:
+                            printtime('{}: queued {}'.format(self.samples[sample].name, stage), self.start)
+                            self.queue.submit(stage, self.samples[sample],
+                                              lambda state, error, node=node: self.finish(node, state, error))
+                        else:
+                            printtime('{}: starting {}'.format(self.samples[sample].name, stage), self.start)
+                            pool.submit(self.worker, node)
+                    # Wait for a node to finish if no more nodes can be started
+                    if self.active and (self.active >= self.jobs or not any(True for _ in self.ready())):
+                        # The timeout keeps the main thread responsive to signals such as KeyboardInterrupt
+                        self.condition.wait(1)
+        finally:
+            if self.queue:
+                # Tell the workers that the run is finished
+                self.queue.close()
+        return self.state
+
+    def __init__(self, samples, stages, selection=None, jobs=1, start=0, allocator=None, journal=None,
+                 profiler=None, queue=None, model=None):
+        """
+        :param samples: list of sample metadata objects
+        :param stages: list of Stage objects in the order they should be preferred
+        :param selection: optional list of stage names to run. Required stages are added automatically
+        :param jobs: maximum number of nodes to run at once
+        :param start: starting time of the analysis
+        :param allocator: optional ResourceAllocator to inform of the number of nodes of each stage waiting to start
+        :param journal: optional Journal to record the transitions of the nodes in. Nodes that were finished by a
+        previous run are not run again
+        :param profiler: optional StageProfiler to profile the Python code of each stage with
+        :param queue: optional WorkQueue to run the nodes with workers on other hosts, rather than on this host. Every
+        node is queued as soon as it is ready, and jobs is ignored
+        :param model: optional RuntimeModel to order the samples of the same priority by their predicted runtime, and
+        to refine with the runtime of every stage
+        """
+        self.samples = samples
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.order = [stage.name for stage in stages]
+        self.selected = self.resolve(selection if selection else self.order)
+        self.jobs = max(1, len(samples) * len(self.selected) if queue else int(jobs))
+        self.start = start
+        self.allocator = allocator
+        self.active = 0
+        self.condition = Condition()
+        # Order the nodes by sample, so the downstream stages of a sample are preferred over starting new samples
+        self.nodes = [(sample, stage) for sample in range(len(samples)) for stage in self.selected]
+        self.state = dict((node, self.pending) for node in self.nodes)
+        # Number of times the command of each node stalled
+        self.attempts = dict()
+        # Rank of the priority class of each sample, from 0 for the most urgent
+        self.ranks = [rank(sample) for sample in samples]
+        self.model = model
+        # Predicted runtime of each sample, without a model the samples are in the order they were given
+        self.estimates = [model.estimate(sample, self.selected) if model else 0 for sample in samples]
+        self.journal = journal
+        self.profiler = profiler if profiler else StageProfiler()
+        self.queue = queue
+        if journal:
+            finished = journal.finished()
+            for node in self.nodes:
+                self.state[node] = finished.get((samples[node[0]].name, node[1]), self.pending)
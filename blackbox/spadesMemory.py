@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+from accessoryFunctions import blackboxhome, make_path
+from threading import Lock
+import json
+import os
+import re
+import time
+
+__author__ = 'mike knowles'
+
+# Peak memory reported on each line of spades.log e.g.
+# 0:02:07.605   144M / 9G    INFO    General (pair_info_count.cpp : 191) Insert size = 240.514, ...
+logmemory = re.compile(r'^\s*\d+:\d+:\d+\.\d+\s+\d+[KMGT]?\s*/\s*(\d+)([KMGT]?)\s')
+units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def peakmemory(logfile):
+    """Find the peak memory in bytes printed in a spades.log file
+    :param logfile: path of the spades.log file
+    :return: peak memory in bytes, or 0 if there were no memory values in the log
+    """
+    peak = 0
+    if os.path.isfile(logfile):
+        with open(logfile) as spadeslog:
+            for line in spadeslog:
+                match = logmemory.match(line)
+                if match:
+                    peak = max(peak, int(match.group(1)) * units[match.group(2)])
+    return peak
+
+
+def fastqstats(fastqfiles, records=10000):
+    """Estimate the number of bases, and find the longest read in fastq files without reading the entire files. The
+    bases in the first records of each file are extrapolated to the size of the file
+    :param fastqfiles: list of (optionally gzipped) fastq files
+    :param records: number of records to read from each file
+    :return: estimated number of bases, length of the longest read
+    """
+    import gzip
+    bases, readlength = 0, 0
+    for fastq in fastqfiles:
+        with open(fastq, 'rb') as raw:
+            handle = gzip.GzipFile(fileobj=raw) if fastq.endswith('.gz') else raw
+            sampled, count = 0, 0
+            for count, line in enumerate(handle):
+                # The sequence is on the second line of each four line record
+                if count % 4 == 1:
+                    sampled += len(line.rstrip())
+                    readlength = max(readlength, len(line.rstrip()))
+                if count >= records * 4:
+                    break
+            else:
+                # The entire file was read
+                bases += sampled
+                continue
+            # Extrapolate the sampled bases with the fraction of the (compressed) file that was read
+            bases += int(sampled * float(os.path.getsize(fastq)) / max(1, raw.tell()))
+    return bases, readlength
+
+
+class MemoryModel(object):
+    """Predicts the peak memory of a SPAdes assembly before it is launched. The peak memory is modelled as a linear
+    function of the number of k-mers in the reads at the smallest k. The model is refined with the peak memory printed
+    in the spades.log files of previous assemblies"""
+
+    # Gigabytes of memory used by SPAdes regardless of the input, and per billion k-mers until the model is refined
+    intercept = 1.0
+    slope = 4.0
+    # Margin added to the predicted peak memory
+    safety = 1.25
+    # Assemblies kept in the history, the most recent first
+    limit = 500
+
+    @staticmethod
+    def kmerinstances(bases, readlength, kmers):
+        """Billions of k-mers in the reads at the smallest k, which determines the size of the de Bruijn graph"""
+        kmin = min(int(kmer) for kmer in kmers)
+        readlength = max(readlength, kmin)
+        return bases * float(readlength - kmin + 1) / readlength / 1e9
+
+    def fit(self):
+        """Fit the intercept and slope of the model to the previous assemblies with least squares. Previous assemblies
+        of a single number of k-mers only scale the default model"""
+        observations = [(entry['kmers'], entry['peak'] / 1024.0 ** 3) for entry in self.history.values()]
+        if len(set(x for x, _ in observations)) >= 2:
+            n = float(len(observations))
+            meanx = sum(x for x, _ in observations) / n
+            meany = sum(y for _, y in observations) / n
+            sxx = sum((x - meanx) ** 2 for x, _ in observations)
+            sxy = sum((x - meanx) * (y - meany) for x, y in observations)
+            slope = sxy / sxx
+            if slope > 0:
+                self.slope = slope
+                self.intercept = max(0.5, meany - slope * meanx)
+                # Cover the largest under-prediction of the fitted model
+                self.safety = max(MemoryModel.safety,
+                                  max(y / (self.intercept + self.slope * x) for x, y in observations))
+        elif observations:
+            # Scale the default model to the largest of the previous assemblies, which have the same number of k-mers
+            ratio = max(y / (MemoryModel.intercept + MemoryModel.slope * x) for x, y in observations)
+            self.intercept, self.slope = MemoryModel.intercept * ratio, MemoryModel.slope * ratio
+
+    def predict(self, sample, fastqfiles, kmers):
+        """Predict the peak memory of the assembly of a sample
+        :param sample: sample metadata object
+        :param fastqfiles: list of fastq files that will be assembled
+        :param kmers: list of k-mer sizes used in the assembly
+        :return: predicted peak memory in bytes
+        """
+        bases, readlength = fastqstats(fastqfiles)
+        instances = self.kmerinstances(bases, readlength, kmers)
+        with self.lock:
+            self.features[sample.name] = instances
+            gigabytes = (self.intercept + self.slope * instances) * self.safety
+        # Record the prediction
+        sample.general.inputbases = bases
+        sample.general.predictedmemory = '{:.1f}G'.format(gigabytes)
+        return int(gigabytes * 1024 ** 3)
+
+    def observe(self, sample, logfile):
+        """Refine the model with the peak memory printed in the spades.log of an assembly
+        :param sample: sample metadata object that was passed to predict
+        :param logfile: path of the spades.log of the assembly
+        """
+        peak = peakmemory(logfile)
+        if peak and sample.name in self.features:
+            sample.general.spadespeakmemory = '{:.1f}G'.format(peak / 1024.0 ** 3)
+            with self.lock:
+                self.observed[os.path.abspath(logfile)] = {'kmers': self.features[sample.name], 'peak': peak,
+                                                           'time': time.time()}
+                # The history is merged with the assemblies other runs saved in the meantime before it is fitted
+                self.save()
+                self.fit()
+
+    def save(self):
+        """Add the assemblies observed in this run to the history of previous assemblies on file"""
+        if not self.observed:
+            return
+        # Keep the assemblies saved by other runs since the history was read
+        history = self.load()
+        history.update(self.observed)
+        # Drop the oldest assemblies beyond the limit. Assemblies saved without a time are the oldest
+        for key in sorted(history, key=lambda x: history[x].get('time', 0), reverse=True)[self.limit:]:
+            del history[key]
+        make_path(os.path.dirname(self.historyfile))
+        temporary = self.historyfile + '.tmp{}'.format(os.getpid())
+        with open(temporary, 'wb') as historyfile:
+            json.dump(history, historyfile, sort_keys=True, indent=4, separators=(',', ': '))
+        # Replace the history atomically so concurrent pipelines never read a partial file
+        os.rename(temporary, self.historyfile)
+        self.history = history
+        self.observed = dict()
+
+    def load(self):
+        """Read the history of previous assemblies"""
+        try:
+            with open(self.historyfile) as historyfile:
+                return json.load(historyfile)
+        except (IOError, ValueError):
+            return dict()
+
+    def __init__(self, historyfile=None):
+        """
+        :param historyfile: JSON file of the peak memory of previous assemblies. Shared between runs by default
+        """
+        self.historyfile = historyfile if historyfile else os.path.join(blackboxhome(), 'spadesmemory.json')
+        self.lock = Lock()
+        self.features = dict()
+        # Assemblies of this run that are not saved yet
+        self.observed = dict()
+        self.history = self.load()
+        self.fit()
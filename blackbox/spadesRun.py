@@ -1,204 +1,350 @@
 #!/usr/bin/env python
-from accessoryFunctions import printtime, execute
+from accessoryFunctions import printtime, execute, WorkerPool
+from profiles import settings
+from spadesMemory import MemoryModel
 import os
+import re
+import shutil
 
 __author__ = 'adamkoziol,mikeknowles'
 
+# Errors in spades.log of an assembly that ran out of memory: an allocation failed at the memory limit of SPAdes or of
+# the job, or a step of SPAdes was killed e.g. by the kernel OOM killer
+memoryerrors = re.compile(r'bad_alloc|Cannot allocate memory|MemoryError|err code: -9\b')
+
 
 class Spades(object):
-    def spades(self):
-        from threading import Thread
-        import spades
-        # __file__ returns pyc!
-        spadespath = spades.__file__
-        if spadespath.endswith('.pyc') and os.path.exists(spadespath[:-1]):
-            spadespath = spadespath[:-1]
-        # Find the fastq files for each sample
-        # Only make as many threads are there are samples with fastq files
-        for i in range(len([sample.general for sample in self.metadata if type(sample.general.fastqfiles) is list])):
-            # Send the threads to the merge method. :args is empty as I'm using
-            threads = Thread(target=self.assemble, args=())
-            # Set the daemon to true - something to do with thread management
-            threads.setDaemon(True)
-            # Start the threading
-            threads.start()
-        for sample in self.metadata:
-            # Initialise the spades command
-            spadescommand = ''
-            # Split the string of the provided kmer argument
-            kmerlist = self.kmers.split(',')
-            # Regenerate the list of kmers to use if the kmer is less than the readlength
-            sample.general.kmers = ','.join([kmer for kmer in kmerlist if int(kmer) <= sample.run.forwardlength])
-            # Initialise the fastqfiles variable - will store trimmed fastq file names if they exist, and raw fastq
-            # file names if trimmed fastq files were not created for whatever reason
-            if type(sample.general.trimmedfastqfiles) is list:
-                fastqfiles = sorted(sample.general.trimmedfastqfiles)
-            elif type(sample.general.fastqfiles) is list:
-                fastqfiles = sorted(sample.general.fastqfiles)
-            else:
-                fastqfiles = ''
-            # Only proceed if fastq files exists
-
-            if fastqfiles:
-                # Set the the forward fastq files
-                forward = fastqfiles[0]
-                # Set the output directory
-                sample.general.spadesoutput = '{}/spades_output'.format(sample.general.outputdirectory)
-                spadescommand = '-k {} --careful -o {} -t {} '.format(sample.general.kmers, sample.general.spadesoutput,
-                                                                     self.threads)
-                # If a previous assembly was partially completed, continue from the most recent checkpoint
-                if os.path.isdir(sample.general.spadesoutput):
-                    spadescommand += ' --continue '
-                # If there are two fastq files
-                if self.yaml:
-                    # TODO: implement complex yaml input for spades
-                    yaml = os.path.join(self.path, sample.name + '.yml')
-
-                    if os.path.isfile(yaml):
-                        spadescommand += '--dataset {} '.format(yaml)
-                        sample.general.dataset = yaml
-                if "dataset" not in dict(sample.general):
-                    if len(fastqfiles) == 2:
-                        if 'Mate Pair' in sample.run.Assay:
-                            spadescommand += '--mp1-1 {} --mp2-2 {} '.format(forward, fastqfiles[1])
-                        else:
-                            spadescommand += '--pe1-1 {} --pe1-2 {} '.format(forward, fastqfiles[1])
+    def __call__(self):
+        """Assemble every sample with fastq files in a multi-threaded fashion"""
+        printtime('Assembling sequences', self.start)
+        # Assemble each sample in the pool
+        with WorkerPool(self.allocator.cores) as pool:
+            pool.map(self.run, self.metadata)
+
+    # Changes made to an assembly that ran out of memory before it is run again, in order. Each attempt keeps the
+    # changes of the previous attempts: half the threads, as the error correction of SPAdes uses memory per thread, then
+    # the k-mers without the smallest, which has the most distinct k-mers, then half of the reads
+    fallbacks = ['threads', 'kmers', 'subsample']
+
+    def run(self, sample):
+        """Assemble a single sample, then filter the assembly and extract the insert size and corrected reads. An
+        assembly that runs out of memory is run again with the fallbacks, and each attempt is recorded in the attempts
+        section of the metadata"""
+        fastqfiles = self.reads(sample)
+        reads, threads, fraction, attempts = fastqfiles, None, 1.0, []
+        for fallback in [None] + self.fallbacks:
+            if fallback == 'threads':
+                if attempts[-1]['threads'] == 1:
+                    continue
+                threads = attempts[-1]['threads'] // 2
+            elif fallback == 'kmers':
+                kmers = sorted(sample.general.kmers.split(','), key=int)
+                if len(kmers) == 1:
+                    continue
+                sample.general.kmers = ','.join(kmers[1:])
+            elif fallback == 'subsample':
+                # The reads of a dataset file are not known to the pipeline
+                if "dataset" in dict(sample.general):
+                    continue
+                fraction = 0.5
+                reads = self.subsample(sample, fastqfiles, fraction)
+            if fallback:
+                # SPAdes ignores changed parameters when it continues from a checkpoint, so the assembly is started over
+                shutil.rmtree(sample.general.spadesoutput, ignore_errors=True)
+            # Predict the peak memory of the assembly, and only start the assembly once the memory is free
+            memory = self.memorymodel.predict(sample, reads, sample.general.kmers.split(',')) \
+                if reads and sample.general.kmers != 'NA' else 0
+            with self.allocator.lease('spades', maxcores=threads, memory=memory) as lease:
+                spadescommand = self.spades(sample, reads, lease.cores, lease.memory)
+                returncode = self.assembly(sample, reads, spadescommand) if spadescommand else None
+            # Nothing to record if SPAdes was not run e.g. the assembly was restored from the cache
+            if returncode is None:
+                break
+            reason = self.outofmemory(sample, returncode)
+            attempts.append({'attempt': len(attempts) + 1, 'fallback': fallback if fallback else 'none',
+                             'threads': lease.cores, 'kmers': sample.general.kmers, 'reads': fraction,
+                             'memory': '{:.1f}G'.format(lease.memory / 1024.0 ** 3), 'returncode': returncode,
+                             'outofmemory': reason})
+            if not reason:
+                break
+            printtime('{}: SPAdes ran out of memory ({})'.format(sample.name, reason), self.start)
+        else:
+            printtime('{}: SPAdes ran out of memory with every fallback'.format(sample.name), self.start)
+        if attempts:
+            sample.attempts.spades = attempts
+        # The peak memory of an assembly that was killed understates the memory it needed
+        if memory and returncode == 0:
+            # Refine the memory model with the peak memory of this assembly
+            self.memorymodel.observe(sample, '{}/spades.log'.format(sample.general.spadesoutput))
+        # Filter contigs shorter than 1000 bp, and rename remaining contigs with sample.name
+        self.filter(sample)
+        self.insertsize(sample)
+        self.parse(sample)
+
+    def assembly(self, sample, fastqfiles, spadescommand):
+        """Run SPAdes unless an assembly of the same reads and parameters is current or cached
+        :return: the exit code of SPAdes, or None if SPAdes was not run
+        """
+        outdir = sample.general.spadesoutput
+        inputs = fastqfiles + ([sample.general.dataset] if "dataset" in dict(sample.general) else [])
+        key = self.cache.key(inputs, spadescommand, self.version, outdir)
+        outputs, extras = ['contigs.fasta', 'spades.log'], ['scaffolds.fasta', 'params.txt', 'corrected']
+        if self.cache.current(outdir, 'spades', key, outputs):
+            self.cache.record(sample, 'spades', 'current')
+            return None
+        elif self.cache.restore(key, outdir, outputs):
+            self.cache.stamp(outdir, 'spades', key)
+            self.cache.record(sample, 'spades', 'restored')
+            return None
+        else:
+            # The checkpoints of an assembly with different reads or parameters cannot be continued
+            if self.cache.stamped(outdir, 'spades') != key and os.path.isdir(outdir):
+                shutil.rmtree(outdir)
+            # If a previous assembly of the same reads and parameters was partially completed, continue from the most
+            # recent checkpoint
+            if os.path.isdir(outdir):
+                spadescommand += ' --continue'
+            self.cache.stamp(outdir, 'spades', key)
+            returncode = execute(spadescommand, sample=sample, key='spades')
+            self.cache.store(key, outdir, outputs, extras)
+            self.cache.record(sample, 'spades', 'computed')
+            return returncode
+
+    @staticmethod
+    def outofmemory(sample, returncode):
+        """Find whether an assembly failed for running out of memory, from the signal that ended SPAdes, or the errors
+        in its log
+        :return: the reason, or an empty string if the assembly did not run out of memory
+        """
+        if returncode == 0:
+            return ''
+        # SIGKILL is sent by the kernel OOM killer, and by the ProcessMonitor once the job exceeds its memory ceiling
+        if returncode in (-9, 137):
+            return 'killed by SIGKILL'
+        logfile = '{}/spades.log'.format(sample.general.spadesoutput)
+        if os.path.isfile(logfile):
+            with open(logfile) as spadeslog:
+                for line in spadeslog:
+                    match = memoryerrors.search(line)
+                    if match:
+                        return '{} in spades.log'.format(match.group(0))
+        return ''
+
+    @staticmethod
+    def subsample(sample, fastqfiles, fraction):
+        """Write a fraction of the reads of a sample to the subsampled folder of the sample. The same records are kept
+        from every file, so the pairs of paired files stay together
+        :param sample: sample metadata object
+        :param fastqfiles: list of (optionally gzipped) fastq files
+        :param fraction: fraction of the reads to keep
+        :return: list of the subsampled fastq files
+        """
+        from accessoryFunctions import make_path
+        from itertools import izip
+        import gzip
+        outdir = os.path.join(sample.general.outputdirectory, 'subsampled')
+        make_path(outdir)
+        subsampled = [os.path.join(outdir, os.path.basename(fastq).replace('.gz', '')) for fastq in fastqfiles]
+        inputs = [gzip.open(fastq) if fastq.endswith('.gz') else open(fastq) for fastq in fastqfiles]
+        outputs = [open(fastq, 'wb') for fastq in subsampled]
+        try:
+            # Every record is four lines. A record is kept each time the kept fraction of the records read reaches the
+            # next whole record, which spreads the kept records evenly through the files
+            for count, lines in enumerate(izip(*inputs)):
+                if int((count // 4 + 1) * fraction) > int(count // 4 * fraction):
+                    for output, line in zip(outputs, lines):
+                        output.write(line)
+        finally:
+            for handle in inputs + outputs:
+                handle.close()
+        return subsampled
+
+    def reads(self, sample):
+        """Find the fastq files and the kmers to use in the assembly of a single sample"""
+        # Split the string of the kmers of the profile of the sample
+        kmerlist = settings(sample)['kmers'].split(',')
+        # Regenerate the list of kmers to use if the kmer is less than the readlength
+        sample.general.kmers = ','.join([kmer for kmer in kmerlist if int(kmer) <= sample.run.forwardlength])
+        # Initialise the fastqfiles variable - will store trimmed fastq file names if they exist, and raw fastq
+        # file names if trimmed fastq files were not created for whatever reason
+        if type(dict(sample.general).get('trimmedfastqfiles')) is list:
+            fastqfiles = sorted(sample.general.trimmedfastqfiles)
+        elif type(sample.general.fastqfiles) is list:
+            fastqfiles = sorted(sample.general.fastqfiles)
+        else:
+            fastqfiles = ''
+        return fastqfiles
+
+    def spades(self, sample, fastqfiles, threads, memory):
+        """Create the SPAdes system call for a single sample
+        :param sample: sample metadata object
+        :param fastqfiles: list of fastq files to assemble
+        :param threads: number of threads granted to the assembly
+        :param memory: bytes of memory granted to the assembly. Used as the SPAdes memory limit if set
+        """
+        from math import ceil
+        # Initialise the spades command
+        spadescommand = ''
+        # Only proceed if fastq files exists
+        if fastqfiles:
+            # Set the the forward fastq files
+            forward = fastqfiles[0]
+            # Set the output directory
+            sample.general.spadesoutput = '{}/spades_output'.format(sample.general.outputdirectory)
+            spadescommand = '-k {} {}-o {} -t {} '.format(sample.general.kmers,
+                                                         '--careful ' if settings(sample)['careful'] else '',
+                                                         sample.general.spadesoutput, threads)
+            # Limit the memory of SPAdes (in GB) to the memory reserved for the assembly
+            if memory:
+                spadescommand += '-m {} '.format(int(ceil(float(memory) / 1024 ** 3)))
+            # If there are two fastq files
+            if self.yaml:
+                # TODO: implement complex yaml input for spades
+                yaml = os.path.join(self.path, sample.name + '.yml')
+
+                if os.path.isfile(yaml):
+                    spadescommand += '--dataset {} '.format(yaml)
+                    sample.general.dataset = yaml
+            if "dataset" not in dict(sample.general):
+                if len(fastqfiles) == 2:
+                    if 'Mate Pair' in sample.run.Assay:
+                        spadescommand += '--mp1-1 {} --mp2-2 {} '.format(forward, fastqfiles[1])
                     else:
-                        if 'Mate Pair' in sample.run.Assay:
-                            spadescommand += '--mp1-12 {} --mp2-2 {} '.format(forward, fastqfiles[1])
-                        else:
-                            spadescommand += '--s1 {} '.format(forward)
-                # SPAdes 3.6.2 supports python 3.5
-                if self.version >= "3.6.2":
-                    spadescommand = "python3 {} {}".format(spadespath, spadescommand.rstrip())
+                        spadescommand += '--pe1-1 {} --pe1-2 {} '.format(forward, fastqfiles[1])
                 else:
-                    spadescommand = "spades.py " + spadescommand.strip()
-            # If there are no fastq files, populate the metadata appropriately
+                    if 'Mate Pair' in sample.run.Assay:
+                        spadescommand += '--mp1-12 {} --mp2-2 {} '.format(forward, fastqfiles[1])
+                    else:
+                        spadescommand += '--s1 {} '.format(forward)
+            # SPAdes 3.6.2 supports python 3.5
+            if self.version >= "3.6.2":
+                spadescommand = "python3 {} {}".format(self.spadespath, spadescommand.rstrip())
             else:
-                sample.general.spadesoutput = 'NA'
-            # Put the arguments to pass to the assemble method into the queue
-            self.assemblequeue.put((spadescommand, sample.general.spadesoutput))
-            # Add the command to the metadata
-            sample.commands.spadescall = spadescommand
-            # Record SPAdes version
-            sample.software.SPAdes = self.version
-        # Join the threads
-        self.assemblequeue.join()
-        # Filter contigs shorter than 1000 bp, and rename remaining contigs with sample.name
-        printtime('Filtering sequences', self.start)
-        self.filter()
-        self.insertsize()
-        self.parse()
-
-    def assemble(self):
-        """Run the assembly command in a multi-threaded fashion"""
-        while True:
-            command, output = self.assemblequeue.get()
-            if command and not os.path.isfile('{}/contigs.fasta'.format(output)):
-                execute(command)
-            # Signal to the queue that the job is done
-            self.assemblequeue.task_done()
-
-    def filter(self):
-        """Filter contigs greater than 1000 bp in length, and copy the filtered files to a common assemblies folder"""
+                spadescommand = "spades.py " + spadescommand.strip()
+        # If there are no fastq files, populate the metadata appropriately
+        else:
+            sample.general.spadesoutput = 'NA'
+        # Add the command to the metadata
+        sample.commands.spadescall = spadescommand
+        # Record SPAdes version
+        sample.software.SPAdes = self.version
+        return spadescommand
+
+    def filter(self, sample):
+        """Filter contigs greater than 1000 bp in length, and copy the filtered file to a common assemblies folder"""
         from accessoryFunctions import make_path
+        import Bio
+        import filecmp
+        # Set the name of the unfiltered spades assembly output file
+        contigsfile = '{}/contigs.fasta'.format(sample.general.spadesoutput)
+        # Set the name of the filtered assembly file
+        filteredfile = '{}/{}.fasta'.format(sample.general.outputdirectory, sample.name)
+        # Only run on samples that have been processed with spades. The filtered file is only rewritten if the contigs
+        # changed, so the downstream stages of an identical assembly are not recomputed
+        if os.path.isfile(contigsfile):
+            self.cache.run(sample, 'filter', lambda: self.filtercontigs(sample, contigsfile, filteredfile),
+                           [contigsfile], 'filter {} 1000 {}'.format(contigsfile, sample.name), Bio.__version__,
+                           sample.general.outputdirectory, [os.path.basename(filteredfile)])
+        # If the filtered file was successfully created, copy it to the BestAssemblies folder
+        if os.path.isfile(filteredfile):
+            # Set the assemblies path
+            sample.general.bestassembliespath = '{}BestAssemblies'.format(self.path)
+            # Make the path (if necessary)
+            make_path(sample.general.bestassembliespath)
+            # Set the name of the file in the best assemblies folder
+            bestassemblyfile = '{}/{}.fasta'.format(sample.general.bestassembliespath, sample.name)
+            # Add the name and path of the best assembly file to the metadata
+            sample.general.bestassemblyfile = bestassemblyfile
+            # Copy the filtered file to the BestAssemblies folder if it is missing or differs from the filtered file
+            if not os.path.isfile(bestassemblyfile) or not filecmp.cmp(filteredfile, bestassemblyfile, shallow=False):
+                shutil.copyfile(filteredfile, bestassemblyfile)
+        else:
+            sample.general.bestassemblyfile = ''
+
+    @staticmethod
+    def filtercontigs(sample, contigsfile, filteredfile):
+        """Write the contigs of at least 1000 bp to the filtered file, renamed with sample.name"""
         from Bio import SeqIO
-        import shutil
-        for sample in self.metadata:
-            # Set the name of the unfiltered spades assembly output file
-            contigsfile = '{}/contigs.fasta'.format(sample.general.spadesoutput)
-            # Set the name of the filtered assembly file
-            filteredfile = '{}/{}.fasta'.format(sample.general.outputdirectory, sample.name)
-            # Only run on samples that have been processed with spades
-            if os.path.isfile(contigsfile) and not os.path.isfile(filteredfile):
-                # http://biopython.org/wiki/SeqIO#Input.2FOutput_Example_-_Filtering_by_sequence_length
-                over1000bp = []
-                for record in SeqIO.parse(open(contigsfile, "rU"), "fasta"):
-                    # Include only contigs greater than 1000 bp in length
-                    if len(record.seq) >= 1000:
-                        # Replace 'NODE' in the fasta header with the sample name
-                        # >NODE_1_length_705814_cov_37.107_ID_4231
-                        # newid = re.sub("NODE", sample.name, record.id)
-                        record.id = record.id.replace('NODE', sample.name)
-                        # record.id = newid
-                        # Clear the name and description attributes of the record
-                        record.name = ''
-                        record.description = ''
-                        # Add this record to our list
-                        over1000bp.append(record)
-                # Open the filtered assembly file
-                with open(filteredfile, 'wb') as formatted:
-                    # Write the records in the list to the file
-                    SeqIO.write(over1000bp, formatted, 'fasta')
-            # If the filtered file was successfully created, copy it to the BestAssemblies folder
-            if os.path.isfile(filteredfile):
-                # Set the assemblies path
-                sample.general.bestassembliespath = '{}BestAssemblies'.format(self.path)
-                # Make the path (if necessary)
-                make_path(sample.general.bestassembliespath)
-                # Set the name of the file in the best assemblies folder
-                bestassemblyfile = '{}/{}.fasta'.format(sample.general.bestassembliespath, sample.name)
-                # Add the name and path of the best assembly file to the metadata
-                sample.general.bestassemblyfile = bestassemblyfile
-                # Copy the filtered file to the BestAssemblies folder
-                if not os.path.isfile(bestassemblyfile):
-                    shutil.copyfile(filteredfile, bestassemblyfile)
-            else:
-                sample.general.bestassemblyfile = ''
+        # http://biopython.org/wiki/SeqIO#Input.2FOutput_Example_-_Filtering_by_sequence_length
+        over1000bp = []
+        for record in SeqIO.parse(open(contigsfile, "rU"), "fasta"):
+            # Include only contigs greater than 1000 bp in length
+            if len(record.seq) >= 1000:
+                # Replace 'NODE' in the fasta header with the sample name
+                # >NODE_1_length_705814_cov_37.107_ID_4231
+                # newid = re.sub("NODE", sample.name, record.id)
+                record.id = record.id.replace('NODE', sample.name)
+                # record.id = newid
+                # Clear the name and description attributes of the record
+                record.name = ''
+                record.description = ''
+                # Add this record to our list
+                over1000bp.append(record)
+        # Open the filtered assembly file
+        with open(filteredfile, 'wb') as formatted:
+            # Write the records in the list to the file
+            SeqIO.write(over1000bp, formatted, 'fasta')
 
-    def insertsize(self):
+    def insertsize(self, sample):
         """Extracts the insert size and its deviation from the spades.log file"""
-        for sample in self.metadata:
-            # Only look if the spades output folder exists, and if there are two fastq files (can't find the insert
-            # size of single reads
-            if os.path.isdir(sample.general.spadesoutput) and len(sample.general.fastqfiles) == 2:
-                # Set the name of the log file
-                spadeslogfile = '{}/spades.log'.format(sample.general.spadesoutput)
-                # Open the log file
-                with open(spadeslogfile, 'rb') as spadeslog:
-                    # Iterate through the file
-                    for line in spadeslog:
-                        # Find the line with the insert size on it. Will look something like this:
-                        """
-                        0:02:07.605   144M / 9G    INFO    General (pair_info_count.cpp : 191) \
-                        Insert size = 240.514, deviation = 105.257, left quantile = 142, right quantile = 384, \
-                        read length = 301
-                        """
-                        if 'Insert size =' in line:
-                            # Extract the relevant data and add it to the metadata
-                            sample.general.insertsize = line.split('= ')[1].split(',')[0]
-                            sample.general.insertsizestandarddev = line.split('= ')[2].split(',')[0]
-            # Otherwise, populate with NA
-            else:
-                sample.general.insertsize = 'NA'
-                sample.general.insertsizestandarddev = 'NA'
+        # Only look if the spades output folder exists, and if there are two fastq files (can't find the insert
+        # size of single reads
+        if os.path.isdir(sample.general.spadesoutput) and len(sample.general.fastqfiles) == 2:
+            # Set the name of the log file
+            spadeslogfile = '{}/spades.log'.format(sample.general.spadesoutput)
+            # Open the log file
+            with open(spadeslogfile, 'rb') as spadeslog:
+                # Iterate through the file
+                for line in spadeslog:
+                    # Find the line with the insert size on it. Will look something like this:
+                    """
+                    0:02:07.605   144M / 9G    INFO    General (pair_info_count.cpp : 191) \
+                    Insert size = 240.514, deviation = 105.257, left quantile = 142, right quantile = 384, \
+                    read length = 301
+                    """
+                    if 'Insert size =' in line:
+                        # Extract the relevant data and add it to the metadata
+                        sample.general.insertsize = line.split('= ')[1].split(',')[0]
+                        sample.general.insertsizestandarddev = line.split('= ')[2].split(',')[0]
+        # Otherwise, populate with NA
+        else:
+            sample.general.insertsize = 'NA'
+            sample.general.insertsizestandarddev = 'NA'
 
-    def parse(self):
+    def parse(self, sample):
+        """Add the SPAdes corrected reads to the metadata"""
         import yaml
-        for sample in self.metadata:
-            yamlfile = os.path.join(sample.general.spadesoutput, 'corrected', 'corrected.yaml')
-            if os.path.isfile(yamlfile):
-                with open(yamlfile) as spades:
-                    for seq in yaml.load(spades):
-                        for group in seq:
-                            main = lambda x: getattr(sample.general, x).extend(seq[group]) \
-                                if hasattr(sample.general, x) else setattr(sample.general, x, seq[group])
-                            if group.startswith('interlaced'):
-                                main('CorrectedSingleReads')
-                            elif group.endswith('reads'):
-                                main('Corrected' + group.title().replace(" ", ""))
+        yamlfile = os.path.join(sample.general.spadesoutput, 'corrected', 'corrected.yaml')
+        # Path of a corrected read file in the corrected folder of this assembly
+        local = lambda read: os.path.join(os.path.dirname(yamlfile), os.path.basename(read))
+        if os.path.isfile(yamlfile):
+            with open(yamlfile) as spades:
+                for seq in yaml.load(spades):
+                    for group in seq:
+                        # The corrected reads may have been restored from the cache, where the paths in the yaml file
+                        # point to the folder of the assembly that was cached, so use the reads in this folder
+                        if isinstance(seq[group], list):
+                            seq[group] = [local(read) if os.path.isfile(local(read)) else read for read in seq[group]]
+                        main = lambda x: getattr(sample.general, x).extend(seq[group]) \
+                            if hasattr(sample.general, x) else setattr(sample.general, x, seq[group])
+                        if group.startswith('interlaced'):
+                            main('CorrectedSingleReads')
+                        elif group.endswith('reads'):
+                            main('Corrected' + group.title().replace(" ", ""))
 
     def __init__(self, inputobject):
-        from Queue import Queue
+        import spades
+        import spades_init
         self.metadata = inputobject.runmetadata.samples
         self.start = inputobject.starttime
-        self.kmers = inputobject.kmers
-        self.threads = inputobject.cpus
+        self.allocator = inputobject.allocator
+        self.cache = inputobject.cache
+        self.memorymodel = MemoryModel()
         self.path = inputobject.path
-        self.assemblequeue = Queue()
-        printtime('Assembling sequences', self.start)
-        import spades_init
+        # __file__ returns pyc!
+        self.spadespath = spades.__file__
+        if self.spadespath.endswith('.pyc') and os.path.exists(self.spadespath[:-1]):
+            self.spadespath = self.spadespath[:-1]
         spades_init.init()
         self.version = spades_init.spades_version.rstrip()
         self.yaml = inputobject.dataset
-        self.spades()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+from accessoryFunctions import blackboxhome, held, make_path
+from threading import Lock
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+
+__author__ = 'mike knowles'
+
+# Options setting the threads and memory of a command. These do not change the results, so they are removed from the
+# command before it is used in a cache key e.g. -t 8 (SPAdes, FastQC, QUAST), -m 12 (SPAdes), t=8 (bbduk),
+# -nt 8 (Qualimap), --threads=8 (Bowtie2), --cpu 8 (ITSx) and --continue (SPAdes)
+resourceoptions = re.compile(r'\s(?:-t|-m|-nt|-p|--threads|--cpu|-c)(?:\s+|=)\d+|\st=\d+|\s--continue')
+
+
+class StageCache(object):
+    """Cache of stage outputs shared across runs. Outputs are stored under a key made from the content of the input
+    files, the command (without its paths, threads and memory options) and the version of the tool. Outputs are
+    restored from the cache by hardlink. As the keys are made from the content of the inputs, a rebuilt intermediate
+    file that is byte-identical to the previous one leaves the keys of the downstream stages unchanged, so the
+    downstream stages are not recomputed"""
+
+    def fingerprint(self, path):
+        """SHA-1 digest of the content of a file, or of the names and content of the files in a folder. Digests are
+        remembered by path, size and modification time so unchanged files are only read once. New digests are written
+        to file by save()"""
+        path = os.path.realpath(path)
+        if os.path.isdir(path):
+            digest = hashlib.sha1()
+            for root, folders, files in os.walk(path):
+                folders.sort()
+                for name in sorted(files):
+                    filename = os.path.join(root, name)
+                    digest.update(os.path.relpath(filename, path))
+                    digest.update(self.fingerprint(filename))
+            return digest.hexdigest()
+        stat = os.stat(path)
+        with self.lock:
+            known = self.fingerprints.get(path)
+            if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+                return known['sha1']
+        digest = hashlib.sha1()
+        with open(path, 'rb') as contents:
+            for block in iter(lambda: contents.read(1024 ** 2), b''):
+                digest.update(block)
+        with self.lock:
+            self.fingerprints[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': digest.hexdigest()}
+            self.unsaved = True
+        return digest.hexdigest()
+
+    def key(self, inputs, command, version, outdir):
+        """Create the cache key of a stage
+        :param inputs: list of input files (or folders) of the stage
+        :param command: the command recorded in sample.commands
+        :param version: the version of the tool recorded in sample.software
+        :param outdir: the output folder of the stage. Removed from the command so the key is the same between runs
+        :return: hex digest of the key
+        """
+        fingerprints = [(path, self.fingerprint(path)) for path in inputs]
+        # The digests of every input, and of the files of input folders, are written to file together
+        self.save()
+        command = resourceoptions.sub('', ' ' + str(command)).strip()
+        # Replace the paths of the inputs with their content, and the output folder with a placeholder. Longer paths are
+        # replaced first, as they may contain the shorter paths
+        replacements = fingerprints + [(outdir.rstrip('/'), '<outdir>')]
+        for path, replacement in sorted(replacements, key=lambda x: len(x[0]), reverse=True):
+            command = command.replace(path, replacement)
+        return hashlib.sha1(json.dumps([sorted(digest for _, digest in fingerprints), command, str(version)])) \
+            .hexdigest()
+
+    def entry(self, key):
+        """Folder of the cache entry with the key"""
+        return os.path.join(self.path, key[:2], key)
+
+    @staticmethod
+    def stampfile(outdir, name):
+        return os.path.join(outdir, '.blackbox.{}'.format(name))
+
+    def stamped(self, outdir, name):
+        """Find the key of the outputs of a stage that are currently in the output folder"""
+        try:
+            with open(self.stampfile(outdir, name)) as stamp:
+                return stamp.read().strip()
+        except IOError:
+            return ''
+
+    def stamp(self, outdir, name, key):
+        """Record the key of the outputs of a stage in the output folder"""
+        make_path(outdir)
+        with open(self.stampfile(outdir, name), 'wb') as stamp:
+            stamp.write(key)
+
+    @staticmethod
+    def present(outdir, outputs):
+        return all(os.path.exists(os.path.join(outdir, output)) for output in outputs)
+
+    def current(self, outdir, name, key, outputs):
+        """The outputs in the output folder were created with the same key"""
+        return self.stamped(outdir, name) == key and self.present(outdir, outputs)
+
+    @staticmethod
+    def contents(outdir):
+        """Everything in an output folder except the stamps"""
+        return [name for name in os.listdir(outdir) if not name.startswith('.blackbox.')] \
+            if os.path.isdir(outdir) else []
+
+    @staticmethod
+    def link(source, destination):
+        """Hardlink a file or folder, copying files if hardlinks are not possible e.g. across filesystems"""
+        if os.path.isdir(source):
+            make_path(destination)
+            for name in os.listdir(source):
+                StageCache.link(os.path.join(source, name), os.path.join(destination, name))
+        else:
+            try:
+                os.link(source, destination)
+            except OSError as exception:
+                if exception.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                shutil.copy2(source, destination)
+
+    @staticmethod
+    def clear(outdir, outputs):
+        """Remove stale outputs. Files are unlinked rather than overwritten, as they may be hardlinks to the cache"""
+        for output in outputs:
+            path = os.path.join(outdir, output)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.unlink(path)
+
+    def restore(self, key, outdir, outputs):
+        """Hardlink the outputs stored under the key into the output folder
+        :return: True if the outputs were restored
+        """
+        entry = self.entry(key)
+        if not self.enabled or not self.present(entry, outputs):
+            return False
+        make_path(outdir)
+        for name in os.listdir(entry):
+            self.clear(outdir, [name])
+            self.link(os.path.join(entry, name), os.path.join(outdir, name))
+        return True
+
+    def store(self, key, outdir, outputs, extras=()):
+        """Hardlink the outputs of a stage into the cache
+        :param key: cache key of the stage
+        :param outdir: output folder of the stage
+        :param outputs: list of outputs (relative to outdir) that must be present
+        :param extras: list of optional outputs to store if they are present, or '*' to store the entire folder
+        """
+        if not self.enabled or not self.present(outdir, outputs) or os.path.isdir(self.entry(key)):
+            return
+        if extras == '*':
+            extras = self.contents(outdir)
+        temporary = os.path.join(self.path, 'tmp', '{}.{}.{}'.format(key, os.getpid(), id(outputs)))
+        make_path(temporary)
+        for output in set(list(outputs) + [extra for extra in extras if os.path.exists(os.path.join(outdir, extra))]):
+            self.link(os.path.join(outdir, output), os.path.join(temporary, output))
+        make_path(os.path.dirname(self.entry(key)))
+        try:
+            # Move the complete entry into place, so partial entries are never restored
+            os.rename(temporary, self.entry(key))
+        except OSError:
+            # The entry was stored by another job in the meantime
+            shutil.rmtree(temporary)
+
+    def run(self, sample, name, function, inputs, command, version, outdir, outputs, extras=()):
+        """Run a stage unless its outputs for the same inputs, command and version are already in the output folder,
+        or can be restored from the cache
+        :param sample: sample metadata object. The outcome is recorded in sample.cache
+        :param name: name of the stage in the output folder e.g. 'spades'
+        :param function: callable that creates the outputs
+        :param inputs: list of input files of the stage
+        :param command: the command recorded in sample.commands
+        :param version: the version of the tool recorded in sample.software
+        :param outdir: output folder of the stage
+        :param outputs: list of outputs (relative to outdir) that the stage must create
+        :param extras: list of optional outputs, or '*' for the entire folder
+        :return: the key of the stage
+        """
+        key = self.key(inputs, command, version, outdir)
+        if self.current(outdir, name, key, outputs):
+            outcome = 'current'
+        elif self.restore(key, outdir, outputs):
+            self.stamp(outdir, name, key)
+            outcome = 'restored'
+        else:
+            # Remove the outputs created with a different key before creating them again. Tools that append to their
+            # logs would otherwise write into the files of the cache
+            self.clear(outdir, list(outputs) + (self.contents(outdir) if extras == '*' else list(extras)))
+            function()
+            # The runtime of the stage is recorded, even if the outputs were created without running a command
+            held.computed = getattr(held, 'computed', 0) + 1
+            if self.present(outdir, outputs):
+                self.store(key, outdir, outputs, extras)
+                self.stamp(outdir, name, key)
+            outcome = 'computed'
+        self.record(sample, name, outcome)
+        return key
+
+    def record(self, sample, name, outcome):
+        """Record whether the outputs of a stage were current, restored from the cache, or computed"""
+        # Other stages of the sample may be recording at the same time
+        with self.lock:
+            setattr(sample.cache, name, outcome)
+
+    def save(self):
+        """Write the remembered fingerprints to file, if digests were added since they were last written"""
+        with self.lock:
+            if self.enabled and self.unsaved:
+                make_path(self.path)
+                temporary = self.indexfile + '.tmp{}'.format(os.getpid())
+                with open(temporary, 'wb') as index:
+                    json.dump(self.fingerprints, index)
+                os.rename(temporary, self.indexfile)
+                self.unsaved = False
+
+    def __init__(self, path=None, enabled=True):
+        """
+        :param path: folder of the cache. Defaults to ~/.blackbox/cache (or $BLACKBOX_HOME/cache)
+        :param enabled: False to only skip stages whose outputs are current, without storing or restoring outputs
+        """
+        self.path = path if path else os.path.join(blackboxhome(), 'cache')
+        self.enabled = enabled
+        self.indexfile = os.path.join(self.path, 'fingerprints.json')
+        self.lock = Lock()
+        self.fingerprints = dict()
+        # Digests added since the fingerprints were last written to file
+        self.unsaved = False
+        try:
+            with open(self.indexfile) as index:
+                self.fingerprints = json.load(index)
+        except (IOError, ValueError):
+            pass
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+from accessoryFunctions import blackboxhome, GenObject, make_path, WorkerPool
+from spadesMemory import fastqstats
+from threading import Lock
+import json
+import os
+import time
+
+__author__ = 'mike knowles'
+
+
+def fitline(points):
+    """Fit a line to (x, y) points with least squares
+    :param points: list of (x, y)
+    :return: intercept and slope. With fewer than two distinct x, or a line that falls with x, the line through the
+    origin and the mean of the points, or the mean if x is 0
+    """
+    n = float(len(points))
+    meanx = sum(x for x, _ in points) / n
+    meany = sum(y for _, y in points) / n
+    sxx = sum((x - meanx) ** 2 for x, _ in points)
+    if sxx > 0:
+        slope = sum((x - meanx) * (y - meany) for x, y in points) / sxx
+        if slope > 0:
+            return meany - slope * meanx, slope
+    return (0.0, meany / meanx) if meanx > 0 else (meany, 0.0)
+
+
+class RuntimeModel(object):
+    """Predicts the core-seconds of each stage of a sample before the run, from the bases and the read length of its
+    reads, the k-mer sizes of the assembly and the BUSCO clade. Each stage is a line fitted to the same stage of
+    previous runs, with the work of the stage as the variable: billions of k-mers over every k-mer size for SPAdes, and
+    billions of bases for the other stages. The line of the clade is used once enough stages were run with it. The
+    runtimes of the stages are kept in ~/.blackbox/runtimes.json (or $BLACKBOX_HOME) so they are shared between runs.
+    Stages without previous runs are not predicted"""
+
+    # Observations of the same stage and clade needed to use the line of the clade rather than that of the stage
+    minimum = 3
+    # Observations kept for each stage, the most recent first
+    limit = 500
+
+    def work(self, stage, sample):
+        """Work of a stage of a sample, the variable of the line of the stage"""
+        bases, readlength = self.features.get(sample.name, (0, 0))
+        if stage == 'spades' and readlength:
+            return sum(bases * float(max(readlength - int(kmer) + 1, 0)) / readlength for kmer in self.kmers) / 1e9
+        return bases / 1e9
+
+    def measure(self, samples):
+        """Estimate the bases and find the read length of the reads of every sample, in parallel"""
+        def stats(sample):
+            fastqfiles = dict(sample.general).get('fastqfiles')
+            try:
+                features = fastqstats(fastqfiles) if isinstance(fastqfiles, list) else (0, 0)
+            except (IOError, OSError):
+                # e.g. the reads were moved since the journal recorded them
+                features = (0, 0)
+            with self.lock:
+                self.features[sample.name] = features
+        with WorkerPool() as pool:
+            pool.map(stats, [sample for sample in samples if sample.name not in self.features])
+
+    def fit(self):
+        """Fit the line of each stage, and of each stage and clade, to the previous runs"""
+        groups = dict()
+        self.cores = dict()
+        for entry in self.history.values():
+            # Runtimes are modelled in core-seconds, as each run of a stage may be granted a different number of cores
+            point = (entry['work'], entry['seconds'] * entry['cores'])
+            groups.setdefault((entry['stage'], None), []).append(point)
+            groups.setdefault((entry['stage'], entry['clade']), []).append(point)
+            self.cores[entry['stage']] = max(self.cores.get(entry['stage'], 1), entry['cores'])
+        self.lines = dict((key, (fitline(points), len(points))) for key, points in groups.items())
+
+    def predict(self, sample, stage):
+        """Predict the core-seconds of a stage of a sample
+        :return: core-seconds, or None if the stage was not run before
+        """
+        key = (stage, self.clade)
+        if self.lines.get(key, (None, 0))[1] < self.minimum:
+            key = (stage, None)
+        if key not in self.lines:
+            return None
+        intercept, slope = self.lines[key][0]
+        return max(1.0, intercept + slope * self.work(stage, sample))
+
+    def estimate(self, sample, stages):
+        """Key to order the samples by their predicted core-seconds over the stages, and then by their bases for the
+        stages that were not run before"""
+        predictions = [self.predict(sample, stage) for stage in stages]
+        return sum(x for x in predictions if x), self.features.get(sample.name, (0, 0))[0]
+
+    def maxcores(self, stage):
+        """Largest number of cores a stage was granted in previous runs, or None if it was not run before"""
+        return self.cores.get(stage)
+
+    def observe(self, sample, stage):
+        """Refine the model with the runtime of a stage of a sample, as recorded in the runtime section of its metadata
+        :param sample: sample metadata object
+        :param stage: name of the stage
+        """
+        runtime = sample.datastore.get('runtime')
+        runtime = dict(runtime).get(stage) if isinstance(runtime, GenObject) else None
+        # Stages restored from the cache run no commands, and have no runtime
+        if not isinstance(runtime, dict) or not self.features.get(sample.name, (0, 0))[0]:
+            return
+        with self.lock:
+            self.observed['{} {} {}'.format(stage, self.path, sample.name)] = {
+                'stage': stage, 'clade': self.clade, 'work': self.work(stage, sample), 'seconds': runtime['seconds'],
+                'cores': max(1, runtime['cores']), 'time': time.time()}
+            self.history.update(self.observed)
+            self.fit()
+
+    def save(self):
+        """Add the runtimes observed in this run to the history of previous runs on file"""
+        with self.lock:
+            if not self.observed:
+                return
+            # Keep the runtimes saved by other runs since the history was read
+            history = self.load()
+            history.update(self.observed)
+            # Drop the oldest runtimes of each stage beyond the limit
+            for stage in set(entry['stage'] for entry in history.values()):
+                entries = sorted([key for key, entry in history.items() if entry['stage'] == stage],
+                                 key=lambda x: history[x]['time'], reverse=True)
+                for key in entries[self.limit:]:
+                    del history[key]
+            make_path(os.path.dirname(self.historyfile))
+            temporary = self.historyfile + '.tmp{}'.format(os.getpid())
+            with open(temporary, 'wb') as historyfile:
+                json.dump(history, historyfile, sort_keys=True, indent=4, separators=(',', ': '))
+            # Replace the history atomically so concurrent pipelines never read a partial file
+            os.rename(temporary, self.historyfile)
+            self.observed = dict()
+
+    def load(self):
+        """Read the history of previous runs"""
+        try:
+            with open(self.historyfile) as historyfile:
+                return json.load(historyfile)
+        except (IOError, ValueError):
+            return dict()
+
+    def __init__(self, path, kmers, clade, historyfile=None):
+        """
+        :param path: folder of the run, to tell its runtimes from those of other runs
+        :param kmers: list of k-mer sizes of the assemblies
+        :param clade: BUSCO clade of the run
+        :param historyfile: JSON file of the runtimes of previous runs. Shared between runs by default
+        """
+        self.path = os.path.abspath(path)
+        self.kmers = [int(kmer) for kmer in kmers]
+        self.clade = clade
+        self.historyfile = historyfile if historyfile else os.path.join(blackboxhome(), 'runtimes.json')
+        self.lock = Lock()
+        # Bases and read length of the reads of each sample
+        self.features = dict()
+        # Runtimes of this run that are not saved yet
+        self.observed = dict()
+        self.history = self.load()
+        self.lines = dict()
+        self.cores = dict()
+        self.fit()
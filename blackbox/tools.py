@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+from accessoryFunctions import blackboxhome, get_version, make_path, which, WorkerPool
+from threading import Lock
+import json
+import os
+
+__author__ = 'mike knowles'
+
+
+def itsxversion(script):
+    """Find the version recorded in the ITSx script e.g. $app_version = "1.0.11";"""
+    for line in script.split('\n'):
+        if line.startswith("$app_version"):
+            return line.split('=')[1].strip()[1:-2]
+
+
+# Tools known to the registry: name: (executable, arguments of the version probe, parser of the output of the probe).
+# Tools without probe arguments are not run, and their version is parsed from the text of the executable instead
+tools = {
+    'fastqc': ('fastqc', ['-v'], lambda output: output.rstrip()),
+    'bbduk': ('bbduk.sh', ['-version'], lambda output: output.split('\n')[-3].split()[-1]),
+    'bowtie2': ('bowtie2', ['--version'], lambda output: output.split('\n')[0].split()[-1]),
+    'samtools': ('samtools', ['--version'], lambda output: output.split('\n')[0].split()[1]),
+    'qualimap': ('qualimap', ['--help'], lambda output: output.split('\n')[3].split()[1]),
+    'itsx': ('ITSx', None, itsxversion),
+    'augustus': ('augustus', ['--version'], lambda output: " ".join(output.split()[:2])),
+    'blastn': ('blastn', ['-version'], lambda output: output.replace('\n', ' ').rstrip()),
+    'python3': ('python3', ['-c', 'import sys; print(sys.version)'], lambda output: output.rstrip()),
+}
+
+
+class ToolRegistry(object):
+    """Executables and versions of the external tools, resolved once per run. Versions are probed in parallel, and
+    cached between runs under the path, modification time and size of the executable, so tools that start a JVM to
+    report their version are only probed again once they are updated"""
+
+    def resolve(self, names=None):
+        """Find the executables of tools, and probe the versions that are not cached, in parallel
+        :param names: names of the tools to resolve. Defaults to every known tool
+        """
+        names = [name for name in (names if names else sorted(tools)) if name not in self.resolved]
+        if names:
+            with WorkerPool(len(names)) as pool:
+                pool.map(self.probe, names)
+            self.save()
+
+    def probe(self, name):
+        """Find the executable and the version of a single tool"""
+        executable, arguments, parse = tools[name]
+        path, version = which(executable), None
+        if path:
+            realpath = os.path.realpath(path)
+            stat = os.stat(realpath)
+            with self.lock:
+                cached = self.cache.get(realpath, {})
+            if (cached.get('mtime'), cached.get('size'), cached.get('arguments')) == \
+                    (stat.st_mtime, stat.st_size, arguments):
+                version = cached['version']
+            else:
+                if arguments is None:
+                    with open(path) as script:
+                        version = parse(script.read())
+                else:
+                    version = parse(get_version([path] + arguments))
+                with self.lock:
+                    self.cache[realpath] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'arguments': arguments,
+                                            'version': version}
+                    self.changed = True
+        with self.lock:
+            self.resolved[name] = (path, version)
+
+    def path(self, name):
+        """Path of the executable of a tool. The tool is resolved if it was not already"""
+        if name not in self.resolved:
+            self.resolve([name])
+        path = self.resolved[name][0]
+        assert path, u'Could not find {0!r:s} on the PATH'.format(tools[name][0])
+        return path
+
+    def version(self, name):
+        """Version of a tool. The tool is resolved if it was not already"""
+        self.path(name)
+        return self.resolved[name][1]
+
+    def save(self):
+        """Write the cached versions to file"""
+        with self.lock:
+            if not self.changed:
+                return
+            make_path(os.path.dirname(self.cachefile))
+            temporary = self.cachefile + '.tmp{}'.format(os.getpid())
+            with open(temporary, 'wb') as cache:
+                json.dump(self.cache, cache, sort_keys=True, indent=4, separators=(',', ': '))
+            # Replace the cache atomically so concurrent pipelines never read a partial file
+            os.rename(temporary, self.cachefile)
+            self.changed = False
+
+    def __init__(self, cachefile=None):
+        """
+        :param cachefile: JSON file of the versions of the tools. Shared between runs by default
+        """
+        self.cachefile = cachefile if cachefile else os.path.join(blackboxhome(), 'tools.json')
+        self.lock = Lock()
+        self.resolved = dict()
+        self.changed = False
+        self.cache = dict()
+        try:
+            with open(self.cachefile) as cache:
+                self.cache = json.load(cache)
+        except (IOError, ValueError):
+            pass
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+from accessoryFunctions import printtime
+import json
+import os
+
+__author__ = 'mike knowles'
+
+
+class Span(object):
+    """A stage of a sample, or a command, that ran between two times"""
+
+    def __init__(self, sample, name, start, end, **args):
+        self.sample = sample
+        self.name = name
+        self.start = start
+        self.end = end
+        self.args = args
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+class Trace(object):
+    """Timeline of a run in the trace event format, which opens in chrome://tracing or https://ui.perfetto.dev. Each
+    sample is a process, with a thread for each stage holding the span of the stage and the spans of its commands.
+    Counters show the cores, memory and jobs in use over time, and the critical path of the run has its own lane"""
+
+    def stagespans(self):
+        """Find the spans of the stages run in this run from the transitions in the journal"""
+        started, spans = dict(), dict()
+        for sample, stage, state, time in self.journal.transitions(self.start):
+            if state == 'running':
+                started[(sample, stage)] = time
+            elif state in ('done', 'failed') and (sample, stage) in started:
+                # Keep the last attempt of each stage
+                spans[(sample, stage)] = Span(sample, stage, started.pop((sample, stage)), time, state=state)
+        return spans
+
+    def commandspans(self):
+        """Find the spans of the commands run in this run from the log of commands"""
+        spans = []
+        for logfile in self.logfile if isinstance(self.logfile, list) else [self.logfile]:
+            if not logfile or not os.path.isfile(logfile):
+                continue
+            # The pids of the commands are only unique within the log of a single host
+            started = dict()
+            with open(logfile) as log:
+                for line in log:
+                    record = json.loads(line)
+                    if record['time'] < self.start:
+                        continue
+                    if record['event'] == 'start':
+                        started[record['pid']] = record['time']
+                    elif record['event'] == 'finish' and record['pid'] in started:
+                        usage = dict((field, record[field]) for field in ('command', 'cpu', 'maxrss', 'readbytes',
+                                                                          'writebytes', 'suspended', 'returncode')
+                                     if field in record)
+                        spans.append(Span(record.get('sample', ''), record.get('key') or 'command',
+                                          started.pop(record['pid']), record['time'], **usage))
+        return spans
+
+    def criticalpath(self):
+        """Find the chain of stages that decided the wall time of the run. The chain ends with the stage that finished
+        last, and each stage is preceded by the stage it required that finished last
+        :return: list of (span, wait) from the first stage to the last, where wait is the time between the required
+        stage finishing (or the start of the run) and the stage starting
+        """
+        if not self.spans:
+            return []
+        span = max(self.spans.values(), key=lambda x: x.end)
+        path = []
+        while span:
+            required = [self.spans[(span.sample, requirement)] for requirement in self.requires.get(span.name, [])
+                        if (span.sample, requirement) in self.spans]
+            previous = max(required, key=lambda x: x.end) if required else None
+            path.append((span, span.start - (previous.end if previous else self.start)))
+            span = previous
+        return path[::-1]
+
+    def events(self):
+        """Create the trace events of the run"""
+        us = lambda time: int((time - self.start) * 1e6)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': 0, 'args': {'name': 'Run'}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': 0, 'args': {'name': 'Critical path'}}]
+        samples = sorted(set(span.sample for span in self.spans.values()))
+        stages = sorted(set(span.name for span in self.spans.values()), key=lambda x: self.order.index(x)
+                        if x in self.order else len(self.order))
+        for pid, sample in enumerate(samples, 1):
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': sample}})
+            for tid, stage in enumerate(stages):
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': stage}})
+        critical = set((span.sample, span.name) for span, _ in self.criticalpath())
+        for span in self.spans.values():
+            events.append({'name': span.name, 'cat': 'stage', 'ph': 'X', 'ts': us(span.start), 'dur': us(span.end) -
+                           us(span.start), 'pid': samples.index(span.sample) + 1, 'tid': stages.index(span.name),
+                           'args': dict(span.args, critical=(span.sample, span.name) in critical)})
+            if (span.sample, span.name) in critical:
+                events.append({'name': '{} {}'.format(span.sample, span.name), 'cat': 'critical', 'ph': 'X',
+                               'ts': us(span.start), 'dur': us(span.end) - us(span.start), 'pid': 0, 'tid': 0})
+        for command in self.commands:
+            # Place each command in the lane of the stage of its sample that was running when it started
+            stage = [span for span in self.spans.values()
+                     if span.sample == command.sample and span.start <= command.start <= span.end]
+            if stage:
+                events.append({'name': command.name, 'cat': 'command', 'ph': 'X', 'ts': us(command.start),
+                               'dur': us(command.end) - us(command.start), 'pid': samples.index(command.sample) + 1,
+                               'tid': stages.index(stage[0].name), 'args': command.args})
+        for time, cores, memory, jobs in self.history:
+            if time >= self.start:
+                events.append({'name': 'cores', 'ph': 'C', 'ts': us(time), 'pid': 0,
+                               'args': {'busy': cores, 'idle': self.cores - cores}})
+                events.append({'name': 'jobs', 'ph': 'C', 'ts': us(time), 'pid': 0, 'args': {'running': jobs}})
+                events.append({'name': 'memory (GB)', 'ph': 'C', 'ts': us(time), 'pid': 0,
+                               'args': {'reserved': round(memory / 1024.0 ** 3, 2)}})
+        return events
+
+    def write(self, tracefile):
+        """Write the trace events to file"""
+        with open(tracefile, 'wb') as trace:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, trace)
+
+    def report(self):
+        """Print the critical path of the run"""
+        path = self.criticalpath()
+        if not path:
+            return
+        hms = lambda seconds: '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600), int(seconds % 3600 // 60),
+                                                           int(seconds % 60))
+        total = path[-1][0].end - self.start
+        waited = sum(wait for _, wait in path)
+        lines = ['Critical path ({} of wall time, {} waiting for cores, memory or a free job slot):'
+                 .format(hms(total), hms(waited))]
+        for span, wait in path:
+            lines.append('  {:<30} {:<10} {:>9} {}'.format(span.sample, span.name, hms(span.duration),
+                                                           '(waited {})'.format(hms(wait)) if wait >= 1 else ''))
+        printtime('\n'.join(lines), self.start)
+
+    def __init__(self, journal, stages, allocator, logfile, start):
+        """
+        :param journal: Journal of the run
+        :param stages: list of scheduler Stage objects, to find the stages each stage requires
+        :param allocator: ResourceAllocator of the run
+        :param logfile: JSON lines file of the commands run, or a list of them e.g. one per worker of a queue
+        :param start: starting time of the run
+        """
+        self.journal = journal
+        self.requires = dict((stage.name, stage.requires) for stage in stages)
+        self.order = [stage.name for stage in stages]
+        self.cores = allocator.cores
+        self.history = list(allocator.history)
+        self.logfile = logfile
+        self.start = start
+        self.spans = self.stagespans()
+        self.commands = self.commandspans()
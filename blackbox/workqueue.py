@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+from accessoryFunctions import (GenObject, loadmetadata, make_path, printtime, priority, rank, StalledError, stagetimer,
+                                WorkerPool)
+from copy import deepcopy
+from glob import glob
+from itertools import count
+from profiler import StageProfiler
+from progress import board
+from threading import Condition, Lock, Thread
+import errno
+import json
+import os
+import shutil
+import socket
+import time
+import traceback
+
+__author__ = 'mike knowles'
+
+# Placeholder for keys missing from the metadata of a sample
+missing = object()
+
+
+def changes(before, after):
+    """Find the metadata of a sample that a stage added or changed
+    :param before: dictionary of the metadata of the sample before the stage was run
+    :param after: dictionary of the metadata of the sample after the stage was run
+    :return: dictionary of the changed categories, holding only the changed keys of each category
+    """
+    changed = dict()
+    for attr, value in after.items():
+        if isinstance(value, dict) and isinstance(before.get(attr), dict):
+            keys = dict((key, item) for key, item in value.items() if before[attr].get(key, missing) != item)
+            if keys:
+                changed[attr] = keys
+        elif before.get(attr, missing) != value:
+            changed[attr] = value
+    return changed
+
+
+def merge(sample, changed):
+    """Apply the metadata changed by a stage on another host to the metadata of a sample. Only the changed keys are
+    set, so the stages of a sample that ran at the same time on different hosts do not overwrite each other"""
+    for attr, value in changed.items():
+        category = getattr(sample, attr) if isinstance(value, dict) else None
+        if isinstance(category, GenObject):
+            for key, item in value.items():
+                setattr(category, key, item)
+        else:
+            loadmetadata({attr: value}, sample)
+
+
+def writejson(data, folder, filename, temporary):
+    """Write a file atomically: it is written in the temporary folder, then renamed into the folder, so a reader on
+    any host never sees it partially written"""
+    partial = os.path.join(temporary, '{}.{}.{}'.format(filename, socket.gethostname(), os.getpid()))
+    with open(partial, 'wb') as jsonfile:
+        json.dump(data, jsonfile, sort_keys=True, indent=4, separators=(',', ': '))
+    os.rename(partial, os.path.join(folder, filename))
+
+
+class WorkQueue(object):
+    """Queue of (sample, stage) jobs kept in the run folder, so workers on any host that mounts the run folder can run
+    them. A job is a file in pending, which a worker claims by renaming it into claimed, where the worker refreshes its
+    modification time as a heartbeat. The worker writes the outcome, and the metadata the stage changed, to done. Jobs
+    whose worker stopped sending heartbeats are returned to pending. Renames are atomic on a shared file system, so only
+    one worker claims each job"""
+
+    # Seconds between the heartbeats of a worker, and before the job of a silent worker is returned to pending
+    heartbeat, expiry = 10, 120
+    # Number of workers that may lose a job before it fails
+    attempts = 3
+
+    def clock(self):
+        """Current time of the file system, which is the same for every host while their clocks may differ"""
+        with open(self.clockfile, 'a'):
+            os.utime(self.clockfile, None)
+        return os.stat(self.clockfile).st_mtime
+
+    def submit(self, stage, sample, callback):
+        """Queue a stage of a sample
+        :param stage: name of the stage
+        :param sample: sample metadata object. The metadata changed by the stage are merged into it once it is done
+        :param callback: called with the state ('done', 'failed' or 'stalled') and the error of the job once it is
+        finished
+        """
+        # Workers claim the jobs in the order of their names, so the jobs of the most urgent samples are claimed first
+        name = '{}.{}.{:08d}.{}'.format(self.session, rank(sample), next(self.counter), stage)
+        with self.lock:
+            self.waiting[name] = (sample, callback)
+        writejson({'name': sample.name, 'stage': stage, 'metadata': dict(sample)}, self.pending, name + '.json',
+                  self.temporary)
+
+    def collect(self):
+        """Merge the results written by the workers, and return the jobs of silent workers to pending"""
+        while not self.closed:
+            try:
+                for filename in sorted(os.listdir(self.done)):
+                    name = filename[:-len('.json')]
+                    with open(os.path.join(self.done, filename)) as resultfile:
+                        result = json.load(resultfile)
+                    os.unlink(os.path.join(self.done, filename))
+                    # A job that was returned to pending as its worker was silent may have finished in the end
+                    for folder in (self.pending, self.claimed):
+                        for queued in [x for x in os.listdir(folder) if x.split('@')[0] == filename]:
+                            self.unlink(os.path.join(folder, queued))
+                    with self.lock:
+                        sample, callback = self.waiting.pop(name, (None, None))
+                    if callback:
+                        merge(sample, result['changes'])
+                        callback(result['state'], result['error'])
+                self.expire()
+            except (IOError, OSError) as error:
+                # e.g. the shared file system is briefly unavailable. The results are collected on the next pass
+                printtime('Could not collect the results of the workers: {}'.format(error), self.start)
+            time.sleep(1)
+
+    def expire(self):
+        """Return the jobs of workers that have not sent a heartbeat within the expiry to pending"""
+        now = self.clock()
+        for filename in os.listdir(self.claimed):
+            try:
+                silent = now - os.stat(os.path.join(self.claimed, filename)).st_mtime
+            except OSError:
+                # The job was finished by the worker since the folder was listed
+                continue
+            if silent > self.expiry:
+                job, worker = filename.split('@', 1)
+                name = job[:-len('.json')]
+                self.requeued[name] = self.requeued.get(name, 0) + 1
+                if self.requeued[name] >= self.attempts:
+                    self.unlink(os.path.join(self.claimed, filename))
+                    with self.lock:
+                        sample, callback = self.waiting.pop(name, (None, None))
+                    if callback:
+                        callback('failed', 'The job was lost by {} workers. The last was {}'
+                                 .format(self.requeued[name], worker))
+                    continue
+                printtime('{} stopped sending heartbeats, so {} is queued again'.format(worker, name), self.start)
+                try:
+                    os.rename(os.path.join(self.claimed, filename), os.path.join(self.pending, job))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def unlink(filename):
+        try:
+            os.unlink(filename)
+        except OSError as exception:
+            if exception.errno != errno.ENOENT:
+                raise
+
+    def open(self):
+        """Discard the jobs left by a previous coordinator of the run, and start collecting results"""
+        for folder in (self.pending, self.claimed, self.done):
+            shutil.rmtree(folder)
+            make_path(folder)
+        self.unlink(self.finishedfile)
+        if self.commandline is not None:
+            writejson(self.commandline, self.path, os.path.basename(self.argumentsfile), self.temporary)
+        # Jobs are named after the session, so the results of the workers of a previous coordinator are not mistaken for
+        # the results of this one
+        self.session = '{:x}'.format(int(time.time()))
+        self.closed = False
+        self.collector = Thread(target=self.collect)
+        self.collector.daemon = True
+        self.collector.start()
+
+    def close(self):
+        """Tell the workers that the run is finished"""
+        self.closed = True
+        if self.collector:
+            self.collector.join()
+        with open(self.finishedfile, 'w'):
+            pass
+
+    def finished(self):
+        return os.path.isfile(self.finishedfile)
+
+    def logfiles(self):
+        """Logs of the commands run by the workers, one per worker"""
+        return sorted(glob(os.path.join(self.path, 'commands.*.jsonl')))
+
+    def arguments(self):
+        """Command line arguments of the coordinator of the run"""
+        assert os.path.isfile(self.argumentsfile), u'No run was started with --queue in {0!r:s}'.format(self.path)
+        with open(self.argumentsfile) as argumentsfile:
+            return json.load(argumentsfile)
+
+    def __init__(self, path, start=0, commandline=None):
+        """
+        :param path: folder of the run. The queue is kept in the queue folder of the run
+        :param start: starting time of the analysis
+        :param commandline: command line arguments of the coordinator, which the workers run the stages with
+        """
+        self.path = os.path.join(path, 'queue')
+        self.start = start
+        self.pending = os.path.join(self.path, 'pending')
+        self.claimed = os.path.join(self.path, 'claimed')
+        self.done = os.path.join(self.path, 'done')
+        self.temporary = os.path.join(self.path, 'tmp')
+        for folder in (self.pending, self.claimed, self.done, self.temporary):
+            make_path(folder)
+        self.clockfile = os.path.join(self.path, 'clock')
+        self.finishedfile = os.path.join(self.path, 'finished')
+        self.argumentsfile = os.path.join(self.path, 'arguments.json')
+        self.commandline = commandline
+        self.session = None
+        self.counter = count()
+        self.lock = Lock()
+        # Jobs submitted by this coordinator that are not finished: name: (sample, callback)
+        self.waiting = dict()
+        # Number of times each job was returned to pending
+        self.requeued = dict()
+        self.closed = True
+        self.collector = None
+
+
+class Worker(object):
+    """Runs the jobs of a WorkQueue on this host until the coordinator of the run is finished"""
+
+    def claim(self):
+        """Claim the oldest pending job
+        :return: the name of the claimed file, or None if no job is pending
+        """
+        for filename in sorted(os.listdir(self.queue.pending)):
+            claimed = '{}@{}'.format(filename, self.name)
+            try:
+                os.rename(os.path.join(self.queue.pending, filename), os.path.join(self.queue.claimed, claimed))
+            except OSError:
+                # Another worker claimed the job first
+                continue
+            # The first heartbeat, as the claimed file keeps the time the job was queued
+            os.utime(os.path.join(self.queue.claimed, claimed), None)
+            return claimed
+
+    def beat(self):
+        """Refresh the modification time of the claimed jobs, which tells the coordinator this worker is alive"""
+        while True:
+            with self.condition:
+                claimed = list(self.running)
+            for filename in claimed:
+                try:
+                    os.utime(os.path.join(self.queue.claimed, filename), None)
+                except OSError:
+                    pass
+            time.sleep(self.queue.heartbeat)
+
+    def runner(self, stage):
+        """Create the object of a stage the first time the stage is run on this host"""
+        with self.lock:
+            if not self.stages[stage].runner:
+                self.stages[stage].runner = self.stages[stage].setup()
+            return self.stages[stage].runner
+
+    def execute(self, claimed):
+        """Run a claimed job, and write its outcome and the metadata it changed to done"""
+        try:
+            with open(os.path.join(self.queue.claimed, claimed)) as jobfile:
+                job = json.load(jobfile)
+            # GenObjects keep the dictionaries they are created from, so the sample is created from a copy, leaving the
+            # metadata as they were queued to compare with
+            sample = loadmetadata(deepcopy(job['metadata']))
+            printtime('{}: starting {}'.format(job['name'], job['stage']), self.start)
+            board.started(job['name'], job['stage'])
+            error = None
+            try:
+                runner = self.runner(job['stage'])
+                with self.profiler.profile(job['stage']), priority(sample), stagetimer(sample, job['stage']):
+                    runner.run(sample)
+                state = 'done'
+            except StalledError:
+                # The coordinator decides whether the job is run again
+                error = traceback.format_exc()
+                printtime('{}: {} stalled\n{}'.format(job['name'], job['stage'], error), self.start)
+                state = 'stalled'
+            except Exception:
+                error = traceback.format_exc()
+                printtime('{}: {} failed\n{}'.format(job['name'], job['stage'], error), self.start)
+                state = 'failed'
+            board.finished(job['name'], job['stage'], state)
+            # The metadata are compared as they are written to JSON
+            after = json.loads(json.dumps(dict(sample)))
+            writejson({'state': state, 'error': error, 'worker': self.name,
+                       'changes': changes(job['metadata'], after)}, self.queue.done, claimed.split('@')[0],
+                      self.queue.temporary)
+            WorkQueue.unlink(os.path.join(self.queue.claimed, claimed))
+        finally:
+            # Free the slot of the job, even if the job was lost e.g. its claim expired and it was removed
+            with self.condition:
+                self.running.remove(claimed)
+                self.condition.notify()
+
+    def run(self):
+        """Claim and run jobs until the coordinator is finished"""
+        heart = Thread(target=self.beat)
+        heart.daemon = True
+        heart.start()
+        printtime('Worker {} is waiting for jobs in {}'.format(self.name, self.queue.path), self.start)
+        with WorkerPool(self.jobs) as pool, self.condition:
+            while self.running or not self.queue.finished():
+                while len(self.running) < self.jobs:
+                    claimed = self.claim()
+                    if not claimed:
+                        break
+                    self.running.append(claimed)
+                    pool.submit(self.execute, claimed)
+                # Look for new jobs every second
+                self.condition.wait(1)
+        printtime('Worker {} finished'.format(self.name), self.start)
+
+    def __init__(self, queue, stages, jobs, start=0, profiler=None):
+        """
+        :param queue: WorkQueue of the run
+        :param stages: list of Stage objects of the pipeline
+        :param jobs: maximum number of jobs to run at once on this host
+        :param start: starting time of the analysis
+        :param profiler: optional StageProfiler to profile the Python code of each stage with
+        """
+        self.queue = queue
+        self.stages = dict((stage.name, stage) for stage in stages)
+        self.jobs = max(1, int(jobs))
+        self.start = start
+        self.profiler = profiler if profiler else StageProfiler()
+        self.name = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = Lock()
+        self.condition = Condition()
+        # Names of the claimed files of the jobs running on this host
+        self.running = []